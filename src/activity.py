@@ -0,0 +1,63 @@
+import time
+
+from src.config import ACTIVE_WINDOW_HOURS
+
+
+def current_hour(now: float = None) -> int:
+    """Номер часа с начала эпохи Unix (UTC)."""
+    return int((time.time() if now is None else now) // 3600)
+
+
+class ActivityWindow:
+    """
+    Скользящее окно новых выдач прокси за последние hours часов.
+    Выдачи лежат в часовых корзинах; expire() выбрасывает корзины, вышедшие из окна,
+    а totals() дает число выдач каждого прокси внутри окна (поле active_users реестра).
+    """
+
+    def __init__(self, hours: int = ACTIVE_WINDOW_HOURS):
+        self.hours = hours
+        self._buckets: dict[int, dict[int, int]] = {}
+        self._totals: dict[int, int] = {}
+
+    def first_hour(self, now: float = None) -> int:
+        return current_hour(now) - self.hours + 1
+
+    def load(self, rows, now: float = None):
+        """Заполняет окно строками (proxy_id, hour, count) из БД."""
+        self._buckets = {}
+        self._totals = {}
+        first = self.first_hour(now)
+        for proxy_id, hour, count in rows:
+            if hour >= first:
+                self.add(proxy_id, count, hour)
+
+    def add(self, proxy_id: int, delta: int = 1, hour: int = None):
+        hour = current_hour() if hour is None else hour
+        bucket = self._buckets.setdefault(hour, {})
+        bucket[proxy_id] = bucket.get(proxy_id, 0) + delta
+        self._totals[proxy_id] = self._totals.get(proxy_id, 0) + delta
+
+    def discard(self, proxy_id: int):
+        for bucket in self._buckets.values():
+            bucket.pop(proxy_id, None)
+        self._totals.pop(proxy_id, None)
+
+    def expire(self, now: float = None) -> bool:
+        """Убирает корзины старше окна. Возвращает True, если итоги изменились."""
+        first = self.first_hour(now)
+        stale = [hour for hour in self._buckets if hour < first]
+        for hour in stale:
+            for proxy_id, count in self._buckets.pop(hour).items():
+                left = self._totals.get(proxy_id, 0) - count
+                if left > 0:
+                    self._totals[proxy_id] = left
+                else:
+                    self._totals.pop(proxy_id, None)
+        return bool(stale)
+
+    def totals(self) -> dict[int, int]:
+        return dict(self._totals)
+
+
+activity = ActivityWindow()
@@ -0,0 +1,98 @@
+import random
+
+from src.config import BALANCE_STRATEGY, SCORE_FUNCTION
+from src.registry import get_load_field
+
+# RTT, при котором латентность вдвое снижает оценку прокси
+LATENCY_REF_MS = 100.0
+# usage_count или active_users, см. BALANCE_LOAD
+LOAD_FIELD = get_load_field()
+
+
+def headroom_score(proxy: dict) -> float:
+    """
+    Оценка запаса прокси: чем больше, тем лучше.
+    weight / (1 + нагрузка / capacity) / (1 + rtt_ms / LATENCY_REF_MS)
+    Прокси с большей емкостью, меньшей нагрузкой и меньшей задержкой получает больше.
+    Пока RTT не измерен, задержка не учитывается.
+    """
+    load = proxy[LOAD_FIELD] / max(proxy.get("capacity") or 1, 1)
+    rtt_ms = proxy.get("rtt_ms")
+    latency_factor = 1 / (1 + rtt_ms / LATENCY_REF_MS) if rtt_ms is not None else 1.0
+    return (proxy.get("weight") or 1.0) * latency_factor / (1 + load)
+
+
+# Функции оценки прокси: proxy (dict из реестра) -> число, больше - лучше
+SCORERS = {
+    "headroom": headroom_score,
+}
+
+
+def get_scorer(name: str = SCORE_FUNCTION):
+    try:
+        return SCORERS[name]
+    except KeyError:
+        raise ValueError(
+            f"Неизвестная функция оценки '{name}'. Доступны: {', '.join(SCORERS)}"
+        ) from None
+
+
+def least_loaded(registry):
+    """Строго наименее нагруженный прокси."""
+    return registry.least_loaded()
+
+
+def power_of_two(registry):
+    """
+    Берем два случайных активных прокси и отдаем менее нагруженный.
+    Почти так же ровно, как least_loaded, но не зависит от одного минимума.
+    """
+    ids = registry.active_ids()
+    if not ids:
+        return None
+    if len(ids) == 1:
+        return registry.get(ids[0])
+
+    first, second = random.sample(ids, 2)
+    if registry.usage(second) < registry.usage(first):
+        first = second
+    return registry.get(first)
+
+
+def weighted_random(registry):
+    """Случайный прокси с весом, обратным нагрузке: 1 / (1 + нагрузка)."""
+    ids = registry.active_ids()
+    if not ids:
+        return None
+
+    weights = [1 / (1 + registry.usage(proxy_id)) for proxy_id in ids]
+    return registry.get(random.choices(ids, weights=weights)[0])
+
+
+def best_score(registry, scorer=None):
+    """
+    Прокси с максимальной оценкой (SCORE_FUNCTION). Полный проход по выдаваемым прокси:
+    O(n) на каждую выдачу против O(log n) у least_loaded (куча в реестре). Оценка зависит
+    от емкости, веса и RTT, поэтому одной кучей по нагрузке ее не заменить; при тысячах
+    прокси и высокой нагрузке стоит выбрать least_loaded или power_of_two.
+    """
+    scorer = scorer or get_scorer()
+    best = max(registry.iter_active(), key=lambda p: (scorer(p), -p["id"]), default=None)
+    return dict(best) if best else None
+
+
+STRATEGIES = {
+    "score": best_score,
+    "least_loaded": least_loaded,
+    "power_of_two": power_of_two,
+    "weighted_random": weighted_random,
+}
+
+
+def get_strategy(name: str = BALANCE_STRATEGY):
+    try:
+        return STRATEGIES[name]
+    except KeyError:
+        raise ValueError(
+            f"Неизвестная стратегия балансировки '{name}'. Доступны: {', '.join(STRATEGIES)}"
+        ) from None
@@ -0,0 +1,189 @@
+"""
+Нагрузочный тест бота целиком: настоящий dp из src/main.py, временная SQLite
+и заглушка Bot API из src/fakes.py вместо Telegram.
+
+Запуск: python -m src.bench --users 2000 --concurrency 100
+Каждый пользователь проходит сценарий /start -> лучший прокси -> список -> подключение.
+В конце печатается пропускная способность, p50/p95/p99 и ожидание соединений с БД.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+# Модули бота здесь не импортируются: src.config читает окружение при импорте,
+# а оно готовится в run(). Иначе бот получит токен и базу из .env
+BENCH_TOKEN = "123456:bench"
+
+
+def percentile(samples: list, q: float) -> float:
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def user_scenario(user_id: int, proxy_id: int, next_update_id) -> list:
+    """Апдейты одного пользователя в том порядке, в каком он нажимает кнопки."""
+    from src.callbacks import Action, cb
+    from src.fakes import make_callback_update, make_message_update
+
+    return [
+        make_message_update(next_update_id(), user_id, "/start"),
+        make_callback_update(next_update_id(), user_id, cb(Action.BEST_PROXY)),
+        make_callback_update(next_update_id(), user_id, cb(Action.PROXY_LIST)),
+        make_callback_update(next_update_id(), user_id, cb(Action.CONNECT, proxy_id)),
+        make_callback_update(next_update_id(), user_id, cb(Action.MAIN_MENU)),
+    ]
+
+
+async def run(args) -> dict:
+    db_dir = tempfile.mkdtemp(prefix="bot-bench-")
+    api_url = f"http://127.0.0.1:{args.api_port}"
+
+    # Настройки читаются при импорте src.config, поэтому окружение готовим до импорта бота
+    os.environ.update(
+        DB_PATH=os.path.join(db_dir, "bench.db"),
+        STORAGE_PATH=os.path.join(db_dir, "bench_storage.db"),
+        BOT_TOKEN=BENCH_TOKEN,
+        BOT_API_URL=api_url,
+        ADMIN_IDS="",
+        METRICS_PORT="0",
+        HEALTH_INTERVAL="0",
+    )
+    if not args.throttle:
+        os.environ.update(THROTTLE_RATE="1000000", THROTTLE_BURST="1000000")
+
+    from aiogram.types import Update
+    from src import config
+    from src import main as bot_main
+    from src import database as db
+    from src.fakes import FakeBotAPI
+    from src.metrics import metrics
+
+    # Если src.config успели импортировать раньше, бот пойдет в настоящий Bot API с токеном из .env
+    if config.BOT_TOKEN != BENCH_TOKEN or config.BOT_API_URL != api_url:
+        raise RuntimeError("src.config загружен до подготовки окружения бенчмарка")
+    api = FakeBotAPI(port=args.api_port, delay=args.api_delay)
+
+    # Строка лога на каждый апдейт заметно искажает замер
+    logging.getLogger("aiogram").setLevel(logging.WARNING)
+
+    await api.start()
+    await db.init_db()
+    try:
+        for i in range(args.proxies):
+            await db.add_proxy_if_new(f"Bench {i}", f"10.0.{i // 256}.{i % 256}", 443, f"secret{i}")
+        proxy_ids = [p["id"] for p in await db.get_all_proxies()]
+
+        update_ids = iter(range(1, 1 << 62))
+        scenarios = [
+            user_scenario(user_id, proxy_ids[user_id % len(proxy_ids)], lambda: next(update_ids))
+            for _ in range(args.rounds)
+            for user_id in range(1, args.users + 1)
+        ]
+
+        # Замеряем только нагрузку, а не подготовку
+        metrics.histograms.clear()
+        metrics.counters.clear()
+        api.calls.clear()
+
+        latencies = []
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def play(updates):
+            async with semaphore:
+                for raw in updates:
+                    started = time.perf_counter()
+                    await bot_main.dp.feed_update(bot_main.bots[0], Update.model_validate(raw))
+                    latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(play(updates) for updates in scenarios))
+        elapsed = time.perf_counter() - started
+
+        flush_started = time.perf_counter()
+        await db.write_buffer.flush()
+        flush_elapsed = time.perf_counter() - flush_started
+    finally:
+        await bot_main.fsm_storage.close()
+        await bot_main.throttle_store.close()
+        await db.close_db()
+        await bot_main.session.close()
+        await api.stop()
+        if not args.keep_db:
+            shutil.rmtree(db_dir, ignore_errors=True)
+
+    latencies.sort()
+    report = {
+        "users": args.users,
+        "rounds": args.rounds,
+        "concurrency": args.concurrency,
+        "updates": len(latencies),
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            name: round(percentile(latencies, q) * 1000, 2)
+            for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+        },
+        "api_calls": len(api.calls),
+        "final_flush_ms": round(flush_elapsed * 1000, 2),
+        "db_wait": {},
+        "db_queries": {},
+    }
+
+    for key, histogram in metrics.histograms.get("bot_db_wait_seconds", {}).items():
+        report["db_wait"][dict(key)["role"]] = {
+            "count": histogram.count,
+            "total_ms": round(histogram.sum * 1000, 2),
+            "p99_ms": round(histogram.quantile(0.99) * 1000, 3),
+        }
+    for key, histogram in metrics.histograms.get("bot_db_query_seconds", {}).items():
+        report["db_queries"][dict(key)["query"]] = {
+            "count": histogram.count,
+            "p50_ms": round(histogram.quantile(0.5) * 1000, 3),
+            "p99_ms": round(histogram.quantile(0.99) * 1000, 3),
+        }
+    if args.keep_db:
+        report["db_path"] = os.environ["DB_PATH"]
+    return report
+
+
+def format_report(report: dict) -> str:
+    latency = report["latency_ms"]
+    lines = [
+        f"Апдейтов: {report['updates']} ({report['users']} польз. x {report['rounds']} круг., "
+        f"параллельно {report['concurrency']}) за {report['seconds']} с",
+        f"Пропускная способность: {report['updates_per_second']} апдейтов/с",
+        f"Задержка, мс: p50 {latency['p50']}, p95 {latency['p95']}, p99 {latency['p99']}",
+        f"Запросов к Bot API: {report['api_calls']}, финальный сброс буфера: {report['final_flush_ms']} мс",
+        "Ожидание соединений с БД:",
+    ]
+    for role, stats in sorted(report["db_wait"].items()):
+        lines.append(f"  {role}: {stats['count']} раз, всего {stats['total_ms']} мс, p99 {stats['p99_ms']} мс")
+    lines.append("Функции БД (p50 / p99, мс):")
+    for query, stats in sorted(report["db_queries"].items(), key=lambda item: -item[1]["count"]):
+        lines.append(f"  {query}: {stats['p50_ms']} / {stats['p99_ms']}, {stats['count']}")
+    if "db_path" in report:
+        lines.append(f"База сохранена: {report['db_path']}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на заглушке Bot API")
+    parser.add_argument("--users", type=int, default=500, help="Сколько разных пользователей")
+    parser.add_argument("--rounds", type=int, default=1, help="Сколько раз каждый пользователь проходит сценарий")
+    parser.add_argument("--concurrency", type=int, default=50, help="Сколько пользователей действуют одновременно")
+    parser.add_argument("--proxies", type=int, default=20, help="Сколько прокси в базе")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--api-delay", type=float, default=0, help="Задержка ответа заглушки Bot API, с")
+    parser.add_argument("--throttle", action="store_true", help="Не отключать антиспам")
+    parser.add_argument("--keep-db", action="store_true", help="Не удалять временную базу")
+    parser.add_argument("--json", action="store_true", help="Вывести отчет в JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2) if args.json else format_report(result))
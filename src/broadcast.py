@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+    TelegramNotFound, TelegramRetryAfter, TelegramServerError,
+)
+
+from src import database as db
+from src.config import BROADCAST_RATE, BROADCAST_CONCURRENCY
+from src.metrics import metrics
+from src.responses import fingerprints
+
+logger = logging.getLogger(__name__)
+
+# Сколько пользователей берем из БД за раз; после каждой страницы сохраняем контрольную точку
+PAGE_SIZE = 200
+# Сколько раз повторяем отправку одному пользователю после RetryAfter / сетевой ошибки
+MAX_ATTEMPTS = 3
+# Как часто обновляем сообщение с прогрессом у админа (секунды)
+PROGRESS_INTERVAL = 3.0
+# Пауза перед повтором после временной ошибки (сеть, 5xx), умножается на номер попытки
+TRANSIENT_DELAY = 1.0
+
+# Итог отправки одному пользователю (метка status в bot_broadcast_messages_total)
+SENT = "sent"
+FORBIDDEN = "forbidden"            # бот заблокирован или аккаунт удален
+CHAT_NOT_FOUND = "chat_not_found"  # чат не существует или недоступен боту
+RETRY_AFTER = "retry_after"        # flood control, повторяем после паузы
+TRANSIENT = "transient"            # сеть или 5xx, повторяем
+FAILED = "failed"                  # остальное: не повторяем, пользователь остается активным
+# Ошибки, после которых пользователь помечается неактивным до следующего /start
+PERMANENT = (FORBIDDEN, CHAT_NOT_FOUND)
+
+
+def classify_send_error(error: Exception) -> str:
+    if isinstance(error, TelegramRetryAfter):
+        return RETRY_AFTER
+    if isinstance(error, TelegramForbiddenError):
+        return FORBIDDEN
+    if isinstance(error, (TelegramBadRequest, TelegramNotFound)) and "chat not found" in error.message.lower():
+        return CHAT_NOT_FOUND
+    if isinstance(error, (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError)):
+        return TRANSIENT
+    return FAILED
+
+
+class TokenBucket:
+    """
+    Глобальный ограничитель скорости отправки: rate сообщений в секунду, всплеск до capacity.
+    pause() останавливает всех отправителей, когда Telegram ответил RetryAfter.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastEngine:
+    """
+    Фоновая рассылка сообщений всем пользователям.
+
+    Задания хранятся в таблице broadcasts и выполняются по очереди.
+    Каждое задание рассылается одним ботом его пользователям; лимит скорости у каждого бота свой.
+    Пользователи читаются страницами по user_id; страница рассылается пулом
+    из concurrency отправителей, после чего в БД сохраняется контрольная точка.
+    После рестарта незавершенное задание продолжается с последней контрольной точки
+    (страница, прерванная на середине, может быть отправлена повторно).
+    """
+
+    def __init__(
+        self, bots: list[Bot], rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY,
+        poll_interval: float = None,
+    ):
+        self.bots = {bot.id: bot for bot in bots}
+        self.buckets = {bot_id: TokenBucket(rate) for bot_id in self.bots}
+        self.concurrency = concurrency
+        # Задания, поставленные другими воркерами, будят только опросом очереди раз в poll_interval секунд
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        """Запускает обработчик очереди (подхватит и прерванные рассылки)."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def submit(
+        self, text: str, parse_mode: str = "HTML", report_chat_id: int = None, report_message_id: int = None,
+        report_bot_id: int = None,
+    ):
+        """
+        Ставит рассылку в очередь для пользователей всех ботов (по заданию на бота) и сразу возвращает их id.
+        Прогресс пишется в сообщение report_message_id только заданием бота report_bot_id
+        (по умолчанию первого): редактировать сообщение может лишь бот, который его отправил.
+        """
+        report_bot_id = report_bot_id or next(iter(self.bots))
+        broadcast_ids = []
+        for bot_id in self.bots:
+            report = (report_chat_id, report_message_id) if bot_id == report_bot_id else (None, None)
+            broadcast_ids.append(await db.create_broadcast(text, parse_mode, *report, bot_id=bot_id))
+        self._wakeup.set()
+        return broadcast_ids
+
+    async def _run(self):
+        while True:
+            # Сбрасываем флаг до запроса, чтобы не потерять submit() во время чтения из БД
+            self._wakeup.clear()
+            job = await db.get_next_broadcast()
+            if job is None:
+                try:
+                    async with asyncio.timeout(self.poll_interval):
+                        await self._wakeup.wait()
+                except TimeoutError:
+                    pass
+                continue
+            try:
+                await self._process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Контрольная точка уже в БД, попробуем продолжить позже
+                logger.exception("Рассылка #%s прервана ошибкой", job["id"])
+                await asyncio.sleep(5)
+
+    async def _process(self, job):
+        broadcast_id = job["id"]
+        last_user_id, sent, failed = job["last_user_id"], job["sent"], job["failed"]
+        bot = self.bots.get(job["bot_id"])
+        if bot is None:
+            # Токен бота убрали из BOT_TOKEN - отправлять некому
+            logger.warning("Рассылка #%s пропущена: бот %s не запущен", broadcast_id, job["bot_id"])
+            await db.save_broadcast_progress(broadcast_id, last_user_id, sent, failed, status="done")
+            return
+
+        total = await db.get_all_users_count(active_only=True, bot_id=bot.id)
+        reported_at = 0.0
+        logger.info("Рассылка #%s (бот %s): старт с user_id > %s", broadcast_id, bot.id, last_user_id)
+
+        async for user_ids in db.iter_user_id_pages(PAGE_SIZE, after_user_id=last_user_id, bot_id=bot.id):
+            results = await self._send_page(bot, user_ids, job["text"], job["parse_mode"])
+            page_sent = results.count(SENT)
+            sent += page_sent
+            failed += len(results) - page_sent
+            last_user_id = user_ids[-1]
+            inactive = [(user_id, result) for user_id, result in zip(user_ids, results) if result in PERMANENT]
+            if inactive:
+                await db.mark_users_inactive(inactive, bot_id=bot.id)
+            await db.save_broadcast_progress(broadcast_id, last_user_id, sent, failed)
+
+            if time.monotonic() - reported_at >= PROGRESS_INTERVAL:
+                reported_at = time.monotonic()
+                await self._report(bot, job, f"⏳ Рассылка #{broadcast_id}: отправлено {sent}, ошибок {failed} (всего юзеров: {total})")
+
+        await db.save_broadcast_progress(broadcast_id, last_user_id, sent, failed, status="done")
+        logger.info("Рассылка #%s завершена: отправлено %s, ошибок %s", broadcast_id, sent, failed)
+        await self._report(bot, job, f"✅ Рассылка #{broadcast_id} завершена. Отправлено: {sent}, ошибок: {failed}.")
+
+    async def _send_page(self, bot: Bot, user_ids, text, parse_mode):
+        results = [FAILED] * len(user_ids)
+        positions = iter(range(len(user_ids)))
+
+        async def sender():
+            for i in positions:
+                results[i] = await self._send(bot, user_ids[i], text, parse_mode)
+
+        await asyncio.gather(*(sender() for _ in range(min(self.concurrency, len(user_ids)))))
+        return results
+
+    async def _send(self, bot: Bot, user_id: int, text: str, parse_mode: str) -> str:
+        """Отправляет сообщение с повторами. Возвращает итог: SENT или класс последней ошибки."""
+        result = FAILED
+        bucket = self.buckets[bot.id]
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            await bucket.acquire()
+            try:
+                await bot.send_message(user_id, text, parse_mode=parse_mode)
+                result = SENT
+                break
+            except (TelegramAPIError, asyncio.TimeoutError) as e:
+                result = classify_send_error(e)
+                if result == RETRY_AFTER:
+                    logger.warning("Flood control: пауза %s с", e.retry_after)
+                    metrics.inc("bot_broadcast_messages_total", status="retry")
+                    bucket.pause(e.retry_after)
+                elif result == TRANSIENT:
+                    logger.debug("Временная ошибка отправки пользователю %s: %s", user_id, e)
+                    if attempt < MAX_ATTEMPTS:
+                        await asyncio.sleep(TRANSIENT_DELAY * attempt)
+                else:
+                    logger.debug("Не удалось отправить пользователю %s (%s): %s", user_id, result, e)
+                    break
+        metrics.inc("bot_broadcast_messages_total", status=result)
+        return result
+
+    async def _report(self, bot: Bot, job, text: str):
+        if not job["report_chat_id"]:
+            return
+        # Сообщение теперь показывает прогресс, его прежний отпечаток неактуален
+        fingerprints.forget((bot.id, job["report_chat_id"], job["report_message_id"]))
+        try:
+            await bot.edit_message_text(
+                text, chat_id=job["report_chat_id"], message_id=job["report_message_id"]
+            )
+        except TelegramAPIError:
+            pass # Прогресс не изменился или сообщение удалено
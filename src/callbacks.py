@@ -0,0 +1,160 @@
+import inspect
+import logging
+from enum import Enum
+from functools import lru_cache
+from typing import NamedTuple
+
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import CallbackQuery
+
+from src import responses
+
+logger = logging.getLogger(__name__)
+
+# Версия формата callback_data. При несовместимом изменении увеличивается,
+# а старый формат разбирается в decode, чтобы кнопки в старых сообщениях продолжали работать.
+CALLBACK_VERSION = 1
+
+
+class Action(str, Enum):
+    BEST_PROXY = "best"
+    PROXY_LIST = "list"
+    PROXY_LIST_PREV = "lsp"
+    CONNECT = "conn"
+    MAIN_MENU = "menu"
+    ADMIN_PANEL = "adm"
+    ADD_PROXY = "add"
+    NOTIFY = "ntf"
+    IMPORT = "imp"
+    IMPORT_NOTIFY = "intf"
+    MANAGE_LIST = "mgl"
+    MANAGE_LIST_PREV = "mgp"
+    MANAGE_FILTER = "mgf"
+    MANAGE_SEARCH = "mgs"
+    MANAGE_SEARCH_RESET = "mgr"
+    MANAGE = "mp"
+    TOGGLE = "tg"
+    DELETE_ASK = "dla"
+    DELETE = "dl"
+    RESET_ASK = "rsa"
+    RESET = "rs"
+    EDIT_LOCATION = "el"
+    EDIT_LINK = "ek"
+    EDIT_CAPACITY = "ec"
+
+
+class ActionData(CallbackData, prefix=f"v{CALLBACK_VERSION}"):
+    """
+    callback_data вида "v1:mp:42": действие и числовой аргумент
+    (id прокси, курсор страницы, 1/0 для да/нет, код фильтра).
+    """
+    a: Action
+    id: int = 0
+
+
+class Payload(NamedTuple):
+    action: Action
+    id: int
+
+
+def cb(action: Action, id: int = 0) -> str:
+    return ActionData(a=action, id=id).pack()
+
+
+# Формат до версии 1: "manage_proxy_42", "get_best_proxy" и т.п.
+LEGACY_EXACT = {
+    "get_best_proxy": Payload(Action.BEST_PROXY, 0),
+    "get_all_proxies": Payload(Action.PROXY_LIST, 0),
+    "start_menu": Payload(Action.MAIN_MENU, 0),
+    "admin_panel": Payload(Action.ADMIN_PANEL, 0),
+    "admin_add_proxy": Payload(Action.ADD_PROXY, 0),
+    "admin_import_proxies": Payload(Action.IMPORT, 0),
+    "admin_manage_proxies": Payload(Action.MANAGE_LIST, 0),
+    "notify_yes": Payload(Action.NOTIFY, 1),
+    "notify_no": Payload(Action.NOTIFY, 0),
+    "import_notify_yes": Payload(Action.IMPORT_NOTIFY, 1),
+    "import_notify_no": Payload(Action.IMPORT_NOTIFY, 0),
+}
+LEGACY_PREFIXES = (
+    ("user_connect_", Action.CONNECT),
+    ("manage_proxy_", Action.MANAGE),
+    ("toggle_proxy_", Action.TOGGLE),
+    ("delete_proxy_confirm_", Action.DELETE_ASK),
+    ("delete_proxy_final_", Action.DELETE),
+    ("confirm_reset_stats_", Action.RESET),
+    ("reset_stats_", Action.RESET_ASK),
+    ("edit_loc_", Action.EDIT_LOCATION),
+    ("edit_link_", Action.EDIT_LINK),
+    ("edit_capacity_", Action.EDIT_CAPACITY),
+)
+
+
+@lru_cache(maxsize=4096)
+def decode(data: str):
+    """Payload из callback_data или None, если данные не распознаны."""
+    if not data:
+        return None
+    try:
+        parsed = ActionData.unpack(data)
+        return Payload(parsed.a, parsed.id)
+    except (ValueError, TypeError):
+        pass
+
+    legacy = LEGACY_EXACT.get(data)
+    if legacy:
+        return legacy
+    for prefix, action in LEGACY_PREFIXES:
+        if data.startswith(prefix):
+            tail = data[len(prefix):]
+            return Payload(action, int(tail)) if tail.isdigit() else None
+    return None
+
+
+class CallbackRouter:
+    """
+    Таблица действие -> хендлер. В aiogram регистрируется один хендлер callback-запросов,
+    который разбирает callback_data и находит хендлер по коду действия за O(1),
+    вместо последовательной проверки фильтров F.data.startswith(...).
+
+    Хендлер получает только те аргументы, которые объявил: callback, payload, state и т.п.
+    Действия с admin_only=True отклоняются для всех, кроме админов.
+    На каждый callback отвечается ровно один раз: если хендлер не вызвал responses.answer,
+    пустой ответ отправляется после него.
+    """
+
+    def __init__(self, is_admin):
+        self.is_admin = is_admin
+        self._routes: dict[Action, tuple] = {}
+
+    def route(self, action: Action, admin_only: bool = False):
+        def decorator(func):
+            if action in self._routes:
+                raise ValueError(f"Действие {action!r} уже зарегистрировано")
+            params = set(inspect.signature(func).parameters)
+            self._routes[action] = (func, params, admin_only)
+            return func
+        return decorator
+
+    async def dispatch(self, callback: CallbackQuery, **data):
+        payload = decode(callback.data)
+        route = self._routes.get(payload.action) if payload else None
+        if route is None:
+            logger.debug("Неизвестный callback_data: %r", callback.data)
+            await callback.answer("Кнопка устарела", show_alert=True)
+            return
+
+        func, params, admin_only = route
+        if admin_only and not self.is_admin(callback.from_user.id):
+            await callback.answer("Нет прав", show_alert=True)
+            return
+
+        # Для метрик (src/metrics.py) записываем настоящий хендлер, а не диспетчер
+        metrics_route = data.get("metrics_route")
+        if metrics_route is not None:
+            metrics_route[0] = func.__name__
+
+        kwargs = {"callback": callback, "payload": payload, **data}
+        try:
+            return await func(**{name: value for name, value in kwargs.items() if name in params})
+        finally:
+            await responses.finish(callback)
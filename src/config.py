@@ -3,10 +3,98 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Один или несколько токенов через запятую: все боты работают в одном процессе,
+# с общей базой, реестром прокси и HTTP-сессией, но у каждого свои пользователи и рассылки
+BOT_TOKENS = [token.strip() for token in os.getenv("BOT_TOKEN", "").split(",") if token.strip()]
+BOT_TOKEN = BOT_TOKENS[0] if BOT_TOKENS else None
+
+def bot_id_from_token(token: str) -> int:
+    """id бота - число перед двоеточием в токене."""
+    prefix = token.split(":", 1)[0]
+    return int(prefix) if prefix.isdigit() else 0
+
+# Основной бот: к нему относятся пользователи и рассылки, созданные до поддержки нескольких ботов
+PRIMARY_BOT_ID = bot_id_from_token(BOT_TOKEN) if BOT_TOKEN else 0
+# Свой сервер Bot API (например, заглушка из src/fakes.py). Пусто - api.telegram.org
+BOT_API_URL = os.getenv("BOT_API_URL", "")
 admin_ids_str = os.getenv("ADMIN_IDS", "")
 ADMIN_IDS = [int(x) for x in admin_ids_str.split(",") if x.strip().isdigit()]
 
+# Стратегия выбора прокси: score, least_loaded, power_of_two или weighted_random
+BALANCE_STRATEGY = os.getenv("BALANCE_STRATEGY", "score")
+# Функция оценки для стратегии score (см. src/balancer.py)
+SCORE_FUNCTION = os.getenv("SCORE_FUNCTION", "headroom")
+
+# Чем измерять нагрузку прокси при выборе: lifetime - все выдачи за всё время (usage_count),
+# window - выдачи за последние ACTIVE_WINDOW_HOURS часов (active_users)
+BALANCE_LOAD = os.getenv("BALANCE_LOAD", "lifetime")
+ACTIVE_WINDOW_HOURS = int(os.getenv("ACTIVE_WINDOW_HOURS", "24"))
+
+# Связи пользователь-прокси старше RELATION_RETENTION_DAYS дней (0 - хранить всегда) сворачиваются
+# в почасовую статистику proxy_usage_hourly пачками по RETENTION_BATCH строк раз в RETENTION_INTERVAL секунд
+RELATION_RETENTION_DAYS = int(os.getenv("RELATION_RETENTION_DAYS", "90"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "600"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "5000"))
+
+# Закрепление прокси: повторный запрос "лучшего прокси" возвращает прежний прокси пользователя без записи в БД.
+# Новый выбирается, только если прежний выключен, недоступен, удален или нагружен сверх
+# STICKY_MAX_LOAD * capacity (и есть менее нагруженный). STICKY_CACHE_SIZE - сколько пользователей держим в памяти
+STICKY_ASSIGNMENT = os.getenv("STICKY_ASSIGNMENT", "0").lower() in ("1", "true", "yes")
+STICKY_CACHE_SIZE = int(os.getenv("STICKY_CACHE_SIZE", "100000"))
+STICKY_MAX_LOAD = float(os.getenv("STICKY_MAX_LOAD", "1.0"))
+
+# Рассылки: лимит Telegram ~30 сообщений в секунду на бота
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+
+# Антиспам: токенов в секунду на пользователя, размер всплеска и сколько пользователей держим в памяти
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "0.5"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "4"))
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "100000"))
+
+# Где хранятся состояния диалогов (FSM) и ведра антиспама: memory - в памяти процесса,
+# sqlite - файл STORAGE_PATH, общий для всех процессов на машине, redis - сервер REDIS_URL.
+# При WEB_WORKERS > 1 антиспам тоже стоит вынести в sqlite или redis
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+THROTTLE_STORAGE = os.getenv("THROTTLE_STORAGE", "memory")
+STORAGE_PATH = os.getenv("STORAGE_PATH", "bot_storage.db")
+REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+# Сколько секунд живет незавершенный диалог, как часто (секунды) изменения FSM пишутся в SQLite
+# и как часто удаляются устаревшие записи
+FSM_TTL = int(os.getenv("FSM_TTL", "86400"))
+STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "0.05"))
+STORAGE_CLEANUP_INTERVAL = float(os.getenv("STORAGE_CLEANUP_INTERVAL", "600"))
+
+# Проверка доступности прокси: период (0 - выключить), таймаут подключения и число параллельных проверок
+HEALTH_INTERVAL = float(os.getenv("HEALTH_INTERVAL", "60"))
+HEALTH_TIMEOUT = float(os.getenv("HEALTH_TIMEOUT", "3"))
+HEALTH_CONCURRENCY = int(os.getenv("HEALTH_CONCURRENCY", "20"))
+
+# Буфер записи: как часто (секунды) и при скольких накопленных записях сбрасывать его в БД
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "0.5"))
+WRITE_FLUSH_SIZE = int(os.getenv("WRITE_FLUSH_SIZE", "500"))
+
+# Сколько секунд живет кэш списка прокси, если сами прокси не менялись (обновляет счетчики)
+RENDER_CACHE_TTL = float(os.getenv("RENDER_CACHE_TTL", "30"))
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (по умолчанию 0 - выключены).
+# При нескольких воркерах каждый слушает METRICS_PORT + номер воркера
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")  # публичный https-адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", "8080"))
+# Несколько процессов на одном порту (SO_REUSEPORT, только Linux)
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+MULTI_WORKER = BOT_MODE == "webhook" and WEB_WORKERS > 1
+# Как часто воркеры проверяют чужие изменения прокси и очередь рассылок (секунды, только при MULTI_WORKER)
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", "2"))
+
 # Список начальных прокси. 
 # Теперь прокси хранятся в базе данных. Вы можете добавлять новые через админку /admin
 # Этот список можно оставить пустым.
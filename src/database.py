@@ -1,77 +1,365 @@
 import aiosqlite
 import asyncio
 import os
-from src.config import get_proxy_link
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from src.config import get_proxy_link, PRIMARY_BOT_ID, STICKY_ASSIGNMENT, STICKY_MAX_LOAD
+from src.registry import registry
+from src.activity import activity
+from src.sticky import sticky
+from src.balancer import get_strategy
+from src.writebuffer import WriteBuffer
+from src.migrations import migrate, get_schema_version, SCHEMA_VERSION
+from src.metrics import metrics
 
 # Если задана переменная окружения DB_PATH, используем её, иначе файл в корне
 DB_NAME = os.getenv("DB_PATH", "bot_database.db")
 
-async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Таблица пользователей
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        # Таблица прокси
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS proxies (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                location TEXT,
-                server TEXT,
-                port INTEGER,
-                secret TEXT,
-                usage_count INTEGER DEFAULT 0,
-                unique_identifier TEXT UNIQUE,
-                is_active BOOLEAN DEFAULT 1
-            )
-        """)
-        
-        # Миграция: добавляем столбец is_active, если его нет (для старых баз)
+# Сколько соединений держим для чтения (писатель всегда один)
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+
+# Размер кэша подготовленных выражений sqlite3 на одно соединение.
+# Соединения живут всё время работы бота, поэтому запросы компилируются один раз.
+STATEMENT_CACHE_SIZE = 256
+
+PRAGMAS = (
+    # busy_timeout первым: переход в WAL берет эксклюзивную блокировку, и процессы,
+    # открывающие базу одновременно, должны ждать друг друга, а не падать с "database is locked"
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",  # 256 МБ
+    "PRAGMA cache_size=-16000",  # ~16 МБ на соединение
+)
+
+
+async def apply_pragmas(conn, timeout: float = 5.0):
+    """
+    Выполняет PRAGMAS на новом соединении. Переключение новой базы в WAL при одновременном
+    открытии несколькими процессами может вернуть "database is locked" сразу, не дожидаясь
+    busy_timeout, - такую прагму повторяем до timeout секунд.
+    """
+    deadline = time.monotonic() + timeout
+    for pragma in PRAGMAS:
+        while True:
+            try:
+                await conn.execute(pragma)
+                break
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or time.monotonic() >= deadline:
+                    raise
+                await asyncio.sleep(0.05)
+
+class ConnectionPool:
+    """
+    Долгоживущие соединения с SQLite.
+    Несколько соединений для чтения (WAL позволяет читать параллельно)
+    и одно соединение для записи, доступ к которому сериализован замком.
+    """
+
+    def __init__(self, path: str, readers: int = DB_READERS, role_prefix: str = ""):
+        self.path = path
+        self.readers_count = max(1, readers)
+        # Префикс метки role в bot_db_wait_seconds, чтобы отличать пулы разных файлов
+        self.role_prefix = role_prefix
+        self._readers: asyncio.Queue | None = None
+        self._connections: list[aiosqlite.Connection] = []
+        self._writer: aiosqlite.Connection | None = None
+        self._write_lock = asyncio.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = aiosqlite.Row
+        await apply_pragmas(conn)
+        self._connections.append(conn)
+        return conn
+
+    async def open(self):
+        if self.is_open:
+            return
+        # Писатель открывается первым: он переводит базу в режим WAL
+        self._writer = await self._connect()
+        self._readers = asyncio.Queue()
+        # Читатели открываются параллельно: каждое соединение - отдельный поток aiosqlite
+        readers = await asyncio.gather(*(self._connect() for _ in range(self.readers_count)))
+        for conn in readers:
+            self._readers.put_nowait(conn)
+
+    async def close(self):
+        connections, self._connections = self._connections, []
+        self._writer = None
+        self._readers = None
+        for conn in connections:
+            await conn.close()
+
+    @asynccontextmanager
+    async def read(self):
+        """Выдает свободное соединение для чтения и возвращает его в пул."""
+        started = time.perf_counter()
+        conn = await self._readers.get()
+        metrics.observe("bot_db_wait_seconds", time.perf_counter() - started, role=f"{self.role_prefix}reader")
         try:
-            await db.execute("ALTER TABLE proxies ADD COLUMN is_active BOOLEAN DEFAULT 1")
-        except Exception:
-            pass 
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        """Единственное соединение для записи. Коммитит при успехе, откатывает при ошибке."""
+        started = time.perf_counter()
+        async with self._write_lock:
+            metrics.observe("bot_db_wait_seconds", time.perf_counter() - started, role=f"{self.role_prefix}writer")
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+pool = ConnectionPool(DB_NAME)
+
+# Выбор прокси и увеличение счетчика в реестре идут без await между ними (см. record_usage),
+# поэтому параллельные запросы видят уже увеличенные счетчики друг друга без общего замка
+_pick_proxy = get_strategy()
+
+# Размер части пакетного импорта (add_proxies_bulk): между частями цикл событий обслуживает апдейты
+BULK_BATCH = 500
+
+# Новые пользователи и выдачи прокси пишутся пачками (см. src/writebuffer.py)
+write_buffer = WriteBuffer(pool)
+
+def _apply_usage(proxy_id: int, delta: int = 1):
+    # Счетчик за всё время и окно активных выдач меняются вместе
+    registry.add_usage(proxy_id, delta)
+    activity.add(proxy_id, delta)
+
+write_buffer.on_usage_correction = _apply_usage
 
-        # Таблица связей (кто какой прокси взял)
-        # Хранит историю, чтобы не накручивать счетчик одним юзером
+async def close_db():
+    # Сначала дописываем буфер, потом закрываем соединения
+    await write_buffer.stop()
+    if pool.is_open:
+        async with pool.write() as db:
+            await db.execute("PRAGMA optimize")
+    await pool.close()
+
+async def init_db():
+    await pool.open()
+    await ensure_schema()
+    await warm_up()
+    write_buffer.start()
+
+async def ensure_schema() -> int:
+    """
+    Схема создается и обновляется пошаговыми миграциями (src/migrations.py).
+    Если версия уже актуальна, хватает одного чтения PRAGMA user_version без замка записи.
+    Возвращает число выполненных шагов.
+    """
+    async with pool.read() as db:
+        if await get_schema_version(db) == SCHEMA_VERSION:
+            return 0
+    async with pool.write() as db:
+        return await migrate(db)
+
+async def warm_up():
+    """Загружает в память реестр прокси и окно активных выдач."""
+    await load_registry()
+    await load_activity()
+
+async def load_registry():
+    """Загружает таблицу proxies (вместе с результатами проверок доступности) в реестр в памяти."""
+    async with pool.read() as db:
+        async with db.execute("""
+            SELECT p.*, h.rtt_ms, COALESCE(h.success_rate, 1) AS success_rate,
+                   COALESCE(h.is_healthy, 1) AS is_healthy
+            FROM proxies p LEFT JOIN proxy_health h ON h.proxy_id = p.id
+        """) as cursor:
+            registry.load(await cursor.fetchall())
+
+async def get_proxies_version() -> int:
+    """Версия списка прокси (триггеры m010): меняется, когда прокси правят в любом процессе."""
+    async with pool.read() as db:
+        async with db.execute("SELECT value FROM stats WHERE name = 'proxies_version'") as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else 0
+
+async def reload_registry():
+    """Перечитывает реестр из БД (изменения, сделанные другими воркерами)."""
+    # Пока читаем, буфер не пишет: в прочитанных счетчиках нет ровно тех выдач, что еще в буфере
+    async with write_buffer.flushed():
+        await load_registry()
+        for proxy_id, count in write_buffer.pending_usage().items():
+            registry.add_usage(proxy_id, count)
+    registry.set_active_users(activity.totals())
+
+async def load_activity():
+    """
+    Заполняет окно активных выдач (src/activity.py) из связей и почасовой статистики
+    за последние ACTIVE_WINDOW_HOURS часов и переносит итоги в реестр.
+    """
+    first_hour = activity.first_hour()
+    async with pool.read() as db:
+        async with db.execute("""
+            SELECT proxy_id, CAST(strftime('%s', timestamp) AS INTEGER) / 3600 AS hour, COUNT(*)
+            FROM user_proxy_relations
+            WHERE timestamp >= datetime(?, 'unixepoch')
+            GROUP BY proxy_id, hour
+            UNION ALL
+            SELECT proxy_id, hour, assignments FROM proxy_usage_hourly WHERE hour >= ?
+        """, (first_hour * 3600, first_hour)) as cursor:
+            activity.load(await cursor.fetchall())
+    registry.set_active_users(activity.totals())
+
+def expire_activity():
+    """Сдвигает окно активных выдач; вызывается периодически (src/retention.py)."""
+    if activity.expire():
+        registry.set_active_users(activity.totals())
+
+async def compact_relations(older_than_days: int, batch_size: int) -> int:
+    """
+    Сворачивает до batch_size самых старых связей (старше older_than_days дней)
+    в почасовую статистику proxy_usage_hourly и удаляет их. Возвращает число свернутых строк.
+    Пользователь, чья связь свернута, при следующей выдаче этого прокси будет посчитан заново.
+    """
+    async with pool.write() as db:
         await db.execute("""
-            CREATE TABLE IF NOT EXISTS user_proxy_relations (
-                user_id INTEGER,
-                proxy_id INTEGER,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user_id, proxy_id)
+            CREATE TEMP TABLE IF NOT EXISTS compact_batch (
+                user_id INTEGER, proxy_id INTEGER, hour INTEGER, PRIMARY KEY (user_id, proxy_id)
             )
         """)
+        cursor = await db.execute("""
+            INSERT INTO compact_batch (user_id, proxy_id, hour)
+            SELECT user_id, proxy_id, CAST(strftime('%s', timestamp) AS INTEGER) / 3600
+            FROM user_proxy_relations
+            WHERE timestamp < datetime('now', ?)
+            ORDER BY timestamp
+            LIMIT ?
+        """, (f"-{older_than_days} days", batch_size))
+        moved = cursor.rowcount
+        if moved:
+            await db.execute("""
+                INSERT INTO proxy_usage_hourly (proxy_id, hour, assignments)
+                SELECT proxy_id, hour, COUNT(*) FROM compact_batch WHERE true GROUP BY proxy_id, hour
+                ON CONFLICT (proxy_id, hour) DO UPDATE SET assignments = assignments + excluded.assignments
+            """)
+            await db.execute("""
+                DELETE FROM user_proxy_relations
+                WHERE (user_id, proxy_id) IN (SELECT user_id, proxy_id FROM compact_batch)
+            """)
+            await db.execute("DELETE FROM compact_batch")
+    return moved
 
-        await db.commit()
+async def add_user(user_id: int, username: str = None, bot_id: int = PRIMARY_BOT_ID):
+    # Запись в users произойдет при ближайшем сбросе буфера
+    write_buffer.add_user(bot_id, user_id, username)
 
-async def add_user(user_id: int, username: str = None):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
-            (user_id, username)
-        )
-        await db.commit()
+def _sql_timestamp(value):
+    # joined_at хранится как CURRENT_TIMESTAMP: 'YYYY-MM-DD HH:MM:SS' в UTC
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+async def get_user_ids_page(
+    after_user_id: int = 0, limit: int = 500, joined_after=None, joined_before=None,
+    include_inactive: bool = False, bot_id: int = PRIMARY_BOT_ID,
+):
+    """
+    Страница id пользователей бота bot_id по возрастанию, начиная после after_user_id (keyset-пагинация).
+    joined_after / joined_before - необязательные фильтры по дате регистрации (datetime в UTC или строка).
+    Неактивные пользователи (заблокировали бота) пропускаются, если не указан include_inactive.
+    """
+    if include_inactive:
+        query = "SELECT user_id FROM users WHERE bot_id = ? AND user_id > ?"
+    else:
+        # Частичный индекс idx_users_active содержит только активных; после ANALYZE планировщик
+        # выбирает первичный ключ с проверкой каждой строки, поэтому индекс указан явно
+        query = "SELECT user_id FROM users INDEXED BY idx_users_active WHERE bot_id = ? AND is_active = 1 AND user_id > ?"
+    params = [bot_id, after_user_id]
+    if joined_after is not None:
+        query += " AND joined_at > ?"
+        params.append(_sql_timestamp(joined_after))
+    if joined_before is not None:
+        query += " AND joined_at < ?"
+        params.append(_sql_timestamp(joined_before))
+    query += " ORDER BY user_id LIMIT ?"
+    params.append(limit)
 
-async def get_all_users():
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT user_id FROM users") as cursor:
+    async with pool.read() as db:
+        async with db.execute(query, params) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+async def iter_user_id_pages(page_size: int = 500, after_user_id: int = 0, **filters):
+    """
+    Асинхронный генератор страниц id пользователей.
+    Соединение берется из пула только на время чтения одной страницы,
+    поэтому память и соединения не зависят от размера таблицы users.
+    """
+    while True:
+        page = await get_user_ids_page(after_user_id, page_size, **filters)
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        after_user_id = page[-1]
+
+async def _get_user_counters(bot_id: int = None) -> dict:
+    """
+    Счетчики users:<bot_id> и inactive_users:<bot_id> из таблицы stats (их ведут триггеры, миграция m009),
+    без COUNT(*) по users. bot_id=None - сумма по всем ботам.
+    """
+    async with pool.read() as db:
+        if bot_id is None:
+            query, params = "SELECT name, value FROM stats WHERE name LIKE 'users:%' OR name LIKE 'inactive_users:%'", ()
+        else:
+            query, params = "SELECT name, value FROM stats WHERE name IN (?, ?)", (f"users:{bot_id}", f"inactive_users:{bot_id}")
+        async with db.execute(query, params) as cursor:
             rows = await cursor.fetchall()
-            return [row[0] for row in rows]
 
-async def get_all_users_count():
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT COUNT(*) FROM users") as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row else 0
+    counters = {"users": 0, "inactive_users": 0}
+    for name, value in rows:
+        counters[name.split(":", 1)[0]] += value
+    return counters
+
+async def get_all_users_count(active_only: bool = False, bot_id: int = None):
+    counters = await _get_user_counters(bot_id)
+    if active_only:
+        return counters["users"] - counters["inactive_users"]
+    return counters["users"]
+
+async def mark_users_inactive(failures, bot_id: int = PRIMARY_BOT_ID):
+    """
+    Помечает неактивными пользователей бота bot_id, которым сообщение больше не доставить.
+    failures - пары (user_id, причина). Уже неактивные не трогаем, чтобы сохранить inactive_since.
+    Возвращает число помеченных.
+    """
+    failures = list(failures)
+    if not failures:
+        return 0
+    async with pool.write() as db:
+        cursor = await db.executemany("""
+            UPDATE users SET is_active = 0, inactive_since = CURRENT_TIMESTAMP, inactive_reason = ?
+            WHERE bot_id = ? AND user_id = ? AND is_active = 1
+        """, [(reason, bot_id, user_id) for user_id, reason in failures])
+        return cursor.rowcount
+
+async def get_stats(bot_id: int = None) -> dict:
+    """
+    Итоги для админки за O(1): пользователи бота bot_id (None - всех ботов) из stats,
+    прокси и выдачи (общие для всех ботов) из реестра.
+    """
+    return {**await _get_user_counters(bot_id), **registry.counts()}
 
 async def add_proxy_if_new(location, server, port, secret):
     unique_id = f"{server}:{port}"
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with pool.write() as db:
         try:
             # Пытаемся добавить новый прокси
             cursor = await db.execute(
@@ -81,81 +369,162 @@ async def add_proxy_if_new(location, server, port, secret):
                 """,
                 (location, server, port, secret, unique_id)
             )
-            await db.commit()
-            return True # Успешно добавлен (новый)
         except aiosqlite.IntegrityError:
             return False # Уже существует
 
+    registry.upsert({
+        "id": cursor.lastrowid, "location": location, "server": server, "port": port,
+        "secret": secret, "usage_count": 0, "unique_identifier": unique_id, "is_active": 1,
+        "capacity": 100, "weight": 1.0,
+        "rtt_ms": None, "success_rate": 1, "is_healthy": 1,
+    })
+    return True # Успешно добавлен (новый)
+
+async def add_proxies_bulk(proxies: list) -> list:
+    """
+    Добавляет пачку прокси одной транзакцией (executemany частями по BULK_BATCH строк).
+    Ожидает dict с location, server, port, secret и unique_identifier.
+    Уже существующие unique_identifier пропускаются. Возвращает добавленные прокси.
+    """
+    if not proxies:
+        return []
+
+    async with pool.write() as db:
+        # Замок записи берется до чтения MAX(id): другой воркер WEB_WORKERS не вставит
+        # свои строки между этим чтением и нашими INSERT
+        await db.execute("BEGIN IMMEDIATE")
+        async with db.execute("SELECT COALESCE(MAX(id), 0) FROM proxies") as cursor:
+            last_id = (await cursor.fetchone())[0]
+        # Один executemany или fetchall на сотни тысяч строк надолго забирает GIL у цикла событий
+        for start in range(0, len(proxies), BULK_BATCH):
+            await db.executemany(
+                """
+                INSERT OR IGNORE INTO proxies (location, server, port, secret, usage_count, unique_identifier, is_active)
+                VALUES (?, ?, ?, ?, 0, ?, 1)
+                """,
+                [
+                    (p['location'], p['server'], p['port'], p['secret'], p['unique_identifier'])
+                    for p in proxies[start:start + BULK_BATCH]
+                ]
+            )
+        # До коммита других писателей нет, поэтому все id больше last_id - только что добавленные строки
+        added = []
+        async with db.execute("SELECT * FROM proxies WHERE id > ? ORDER BY id", (last_id,)) as cursor:
+            while rows := await cursor.fetchmany(BULK_BATCH):
+                added.extend(dict(row) for row in rows)
+
+    for start in range(0, len(added), BULK_BATCH):
+        for proxy in added[start:start + BULK_BATCH]:
+            registry.upsert({**proxy, "rtt_ms": None, "success_rate": 1, "is_healthy": 1})
+        await asyncio.sleep(0)
+    return added
+
 async def get_all_proxies(only_active=True):
-    query = "SELECT * FROM proxies"
-    if only_active:
-        query += " WHERE is_active = 1"
-    query += " ORDER BY location"
-    
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(query) as cursor:
-            return await cursor.fetchall()
+    # Прокси читаются из реестра в памяти, отсортированными по локации
+    return registry.all(only_active)
+
+async def _sticky_proxy_id(user_id: int):
+    """
+    Закрепленный прокси пользователя: из кэша, иначе из последней связки, которая еще ждет
+    записи в буфере, иначе последний взятый по user_proxy_relations.
+    """
+    proxy_id = sticky.get(user_id)
+    if proxy_id is None:
+        proxy_id = write_buffer.latest_relation(user_id)
+        if proxy_id is not None:
+            sticky.put(user_id, proxy_id)
+            return proxy_id
+        async with pool.read() as db:
+            async with db.execute(
+                "SELECT proxy_id FROM user_proxy_relations WHERE user_id = ? ORDER BY timestamp DESC LIMIT 1",
+                (user_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+        if row is None:
+            return None
+        proxy_id = row[0]
+        sticky.put(user_id, proxy_id)
+    return proxy_id
 
 async def get_least_loaded_proxy(user_id: int):
     """
-    Возвращает прокси с наименьшим количеством использований.
+    Выбирает прокси по стратегии BALANCE_STRATEGY (по умолчанию score - максимальный запас, см. src/balancer.py).
     Если этот пользователь еще не брал этот прокси -> записываем и увеличиваем счетчик.
     Если брал -> просто возвращаем прокси, не увеличивая счетчик.
+    Выбор и увеличение счетчика в реестре атомарны относительно других вызовов:
+    между ними нет await, а проверка по БД и запись идут уже после.
+
+    В режиме STICKY_ASSIGNMENT пользователь получает свой прежний прокси без записи,
+    пока тот выдается и не перегружен; перегруженный меняется, только если есть неперегруженный.
     """
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        # Выбираем прокси, сортируем по usage_count (возрастание), берем первый активный
-        async with db.execute("SELECT * FROM proxies WHERE is_active = 1 ORDER BY usage_count ASC LIMIT 1") as cursor:
-            proxy = await cursor.fetchone()
-            
-            if proxy:
-                # Пытаемся записать использование
-                try:
-                    await db.execute(
-                        "INSERT INTO user_proxy_relations (user_id, proxy_id) VALUES (?, ?)",
-                        (user_id, proxy["id"])
-                    )
-                    # Если вставка прошла успешно (значит связи не было), увеличиваем счетчик
-                    await db.execute(
-                        "UPDATE proxies SET usage_count = usage_count + 1 WHERE id = ?",
-                        (proxy["id"],)
-                    )
-                    await db.commit()
-                except aiosqlite.IntegrityError:
-                    pass # Юзер уже получал этот прокси, счетчик не увеличиваем
-
-            return proxy
+    current = previous = None
+    if STICKY_ASSIGNMENT:
+        previous = await _sticky_proxy_id(user_id)
+        if previous is not None and registry.is_available(previous):
+            current = registry.get(previous)
+            if not registry.is_overloaded(current, STICKY_MAX_LOAD):
+                metrics.inc("bot_sticky_lookups_total", result="hit")
+                return current
+        elif previous is not None:
+            # Прокси выключен, недоступен или удален
+            sticky.discard(user_id)
+
+    # Выбираем по реестру в памяти (без запроса к БД)
+    proxy = _pick_proxy(registry)
+
+    if current is not None and (
+        proxy is None or proxy["id"] == current["id"] or registry.is_overloaded(proxy, STICKY_MAX_LOAD)
+    ):
+        # Прежний прокси перегружен, но свободнее нет - пользователь остается на нем
+        metrics.inc("bot_sticky_lookups_total", result="kept")
+        return current
+
+    if proxy:
+        # record_usage увеличивает счетчик до своего первого await
+        await record_usage(user_id, proxy["id"])
+
+    if STICKY_ASSIGNMENT:
+        metrics.inc("bot_sticky_lookups_total", result="new" if previous is None else "reassigned")
+    return proxy
 
 async def record_usage(user_id: int, proxy_id: int):
     """
     Пытается зафиксировать факт использования прокси пользователем.
     Увеличивает общий счетчик прокси ТОЛЬКО если пользователь берет его впервые.
+    Возвращает True, если счетчик был увеличен.
+    Сама запись в БД откладывается до сброса буфера; счетчик в реестре растет сразу,
+    до первого await, а если связка уже есть в БД - уменьшается обратно.
     """
-    async with aiosqlite.connect(DB_NAME) as db:
-        try:
-            await db.execute(
-                "INSERT INTO user_proxy_relations (user_id, proxy_id) VALUES (?, ?)",
-                (user_id, proxy_id)
-            )
-            # Если запись уникальна - увеличиваем счетчик
-            await db.execute(
-                "UPDATE proxies SET usage_count = usage_count + 1 WHERE id = ?",
-                (proxy_id,)
-            )
-            await db.commit()
-        except aiosqlite.IntegrityError:
-            pass # Связка уже существует
+    if STICKY_ASSIGNMENT:
+        # Последний взятый прокси становится текущим (и для выбора вручную из списка)
+        sticky.put(user_id, proxy_id)
+
+    if write_buffer.has_relation(user_id, proxy_id):
+        return False # Связка уже ждет записи
+
+    write_buffer.add_relation(user_id, proxy_id)
+    _apply_usage(proxy_id)
+
+    async with pool.read() as db:
+        async with db.execute(
+            "SELECT 1 FROM user_proxy_relations WHERE user_id = ? AND proxy_id = ?",
+            (user_id, proxy_id)
+        ) as cursor:
+            exists = await cursor.fetchone() is not None
+
+    if exists:
+        # Связка уже существует. Если буфер успел начать запись, поправку внесет сам сброс
+        if write_buffer.discard_relation(user_id, proxy_id):
+            _apply_usage(proxy_id, -1)
+        return False
+    return True
 
 async def get_proxy_by_id(proxy_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM proxies WHERE id = ?", (proxy_id,)) as cursor:
-            return await cursor.fetchone()
+    return registry.get(proxy_id)
 
 async def toggle_proxy_status(proxy_id: int):
     """Переключает статус активности прокси"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with pool.write() as db:
         # Сначала получаем текущий статус
         async with db.execute("SELECT is_active FROM proxies WHERE id = ?", (proxy_id,)) as cursor:
             row = await cursor.fetchone()
@@ -165,26 +534,40 @@ async def toggle_proxy_status(proxy_id: int):
         
         new_status = 0 if current_status else 1
         await db.execute("UPDATE proxies SET is_active = ? WHERE id = ?", (new_status, proxy_id))
-        await db.commit()
-        return new_status
+
+    registry.update(proxy_id, is_active=new_status)
+    return new_status
 
 async def delete_proxy(proxy_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
+    # Отложенные выдачи этого прокси должны попасть в БД до удаления
+    await write_buffer.flush()
+    async with pool.write() as db:
         await db.execute("DELETE FROM proxies WHERE id = ?", (proxy_id,))
         await db.execute("DELETE FROM user_proxy_relations WHERE proxy_id = ?", (proxy_id,))
-        await db.commit()
+        await db.execute("DELETE FROM proxy_health WHERE proxy_id = ?", (proxy_id,))
+        await db.execute("DELETE FROM proxy_usage_hourly WHERE proxy_id = ?", (proxy_id,))
+
+    registry.remove(proxy_id)
+    activity.discard(proxy_id)
+    sticky.discard_proxy(proxy_id)
 
 async def reset_proxy_usage(proxy_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
+    await write_buffer.flush()
+    async with pool.write() as db:
         # Сбрасываем счетчик в таблице proxies
         await db.execute("UPDATE proxies SET usage_count = 0 WHERE id = ?", (proxy_id,))
         # Удаляем историю использования этим прокси
         await db.execute("DELETE FROM user_proxy_relations WHERE proxy_id = ?", (proxy_id,))
-        await db.commit()
+        await db.execute("DELETE FROM proxy_usage_hourly WHERE proxy_id = ?", (proxy_id,))
+
+    activity.discard(proxy_id)
+    registry.update(proxy_id, usage_count=0, active_users=0)
+    # Связи удалены: следующий запрос пользователей прокси снова запишет выдачу
+    sticky.discard_proxy(proxy_id)
 
 async def update_proxy(proxy_id: int, location: str, server: str, port: int, secret: str):
     unique_id = f"{server}:{port}"
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with pool.write() as db:
         try:
             await db.execute(
                 """
@@ -194,7 +577,79 @@ async def update_proxy(proxy_id: int, location: str, server: str, port: int, sec
                 """,
                 (location, server, port, secret, unique_id, proxy_id)
             )
-            await db.commit()
-            return True
         except aiosqlite.IntegrityError:
             return False
+
+    registry.update(
+        proxy_id, location=location, server=server, port=port,
+        secret=secret, unique_identifier=unique_id,
+    )
+    return True
+
+async def update_proxy_capacity(proxy_id: int, capacity: int, weight: float):
+    """Задает емкость (на сколько пользователей рассчитан прокси) и вес для балансировщика."""
+    async with pool.write() as db:
+        await db.execute(
+            "UPDATE proxies SET capacity = ?, weight = ? WHERE id = ?",
+            (capacity, weight, proxy_id)
+        )
+
+    registry.update(proxy_id, capacity=capacity, weight=weight)
+
+# --- Доступность прокси ---
+
+async def save_proxy_health(results):
+    """
+    Сохраняет результаты раунда проверок одной транзакцией и обновляет реестр.
+    results - список (proxy_id, rtt_ms, success_rate, is_healthy).
+    """
+    async with pool.write() as db:
+        await db.executemany(
+            """
+            INSERT INTO proxy_health (proxy_id, rtt_ms, success_rate, is_healthy, checked_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(proxy_id) DO UPDATE SET
+                rtt_ms = excluded.rtt_ms, success_rate = excluded.success_rate,
+                is_healthy = excluded.is_healthy, checked_at = excluded.checked_at
+            """,
+            results
+        )
+
+    for proxy_id, rtt_ms, success_rate, is_healthy in results:
+        registry.update(proxy_id, rtt_ms=rtt_ms, success_rate=success_rate, is_healthy=is_healthy)
+
+# --- Рассылки ---
+
+async def create_broadcast(
+    text: str, parse_mode: str = None, report_chat_id: int = None, report_message_id: int = None,
+    bot_id: int = PRIMARY_BOT_ID,
+):
+    async with pool.write() as db:
+        cursor = await db.execute(
+            """
+            INSERT INTO broadcasts (text, parse_mode, report_chat_id, report_message_id, bot_id)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (text, parse_mode, report_chat_id, report_message_id, bot_id)
+        )
+        return cursor.lastrowid
+
+async def get_next_broadcast():
+    """Самая старая незавершенная рассылка (в том числе прерванная рестартом)."""
+    async with pool.read() as db:
+        async with db.execute(
+            "SELECT * FROM broadcasts WHERE status != 'done' ORDER BY id LIMIT 1"
+        ) as cursor:
+            return await cursor.fetchone()
+
+async def save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int, status: str = "running"):
+    async with pool.write() as db:
+        await db.execute(
+            """
+            UPDATE broadcasts
+            SET last_user_id = ?, sent = ?, failed = ?, status = ?,
+                finished_at = CASE WHEN ? = 'done' THEN CURRENT_TIMESTAMP END
+            WHERE id = ?
+            """,
+            (last_user_id, sent, failed, status, status, broadcast_id)
+        )
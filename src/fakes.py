@@ -0,0 +1,335 @@
+"""
+Заглушка Telegram Bot API для локальной проверки бота без Telegram.
+
+Запуск: python -m src.fakes --port 8081 --webhook http://127.0.0.1:8080/webhook --secret XXX --users 100
+Бот при этом запускается с BOT_API_URL=http://127.0.0.1:8081 и BOT_MODE=webhook.
+С --redis-port 6380 рядом поднимается заглушка Redis для FSM_STORAGE=redis (REDIS_URL=redis://127.0.0.1:6380/0).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+from aiohttp import ClientSession, web
+
+FAKE_BOT_USER = {"id": 1000, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+
+def _chat_id(params: dict):
+    try:
+        return int(params.get("chat_id"))
+    except (TypeError, ValueError):
+        return None
+
+
+class FakeBotAPI:
+    """
+    aiohttp-сервер, отвечающий на методы Bot API (/bot<token>/<method>) успешными ответами.
+    Все вызовы складываются в calls как (method, params), чтобы их можно было проверить.
+    Умеет отправлять синтетические апдейты на вебхук бота.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081, delay: float = 0):
+        self.host = host
+        self.port = port
+        # Искусственная задержка ответа (секунды), чтобы имитировать сеть до Telegram
+        self.delay = delay
+        self.calls: list[tuple[str, dict]] = []
+        # Файлы для getFile и скачивания: file_id -> содержимое
+        self.files: dict[str, bytes] = {}
+        # Апдейты, которые бот получит через getUpdates (режим polling)
+        self.pending_updates: list[dict] = []
+        # Ошибки на отправку конкретным чатам: chat_id -> (error_code, description),
+        # например (403, "Forbidden: bot was blocked by the user")
+        self.chat_errors: dict[int, tuple[int, str]] = {}
+        # Содержимое отредактированных сообщений: (chat_id, message_id) -> (text, reply_markup);
+        # повторное редактирование тем же содержимым отклоняется, как в Telegram
+        self.contents: dict[tuple, tuple] = {}
+        self._message_ids = itertools.count(1)
+        self._runner: web.AppRunner | None = None
+
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self._handle)
+        self.app.router.add_get("/file/bot{token}/{file_id}", self._download)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls.append((method, params))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        error = self.chat_errors.get(_chat_id(params)) if method.lower() == "sendmessage" else None
+        if method.lower() == "editmessagetext" and not params.get("inline_message_id"):
+            error = self._check_modified(params)
+        if error:
+            code, description = error
+            return web.json_response({"ok": False, "error_code": code, "description": description}, status=code)
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    def _check_modified(self, params: dict):
+        key = (_chat_id(params), int(params.get("message_id") or 0))
+        content = (params.get("text"), params.get("reply_markup"))
+        if self.contents.get(key) == content:
+            return 400, (
+                "Bad Request: message is not modified: specified new message content and reply markup "
+                "are exactly the same as a current content and reply markup of the message"
+            )
+        self.contents[key] = content
+        return None
+
+    async def _download(self, request: web.Request) -> web.Response:
+        content = self.files.get(request.match_info["file_id"])
+        if content is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=content)
+
+    def _result(self, method: str, params: dict):
+        method = method.lower()
+        if method == "getme":
+            return FAKE_BOT_USER
+        if method in ("sendmessage", "editmessagetext"):
+            if params.get("inline_message_id"):
+                return True
+            return {
+                "message_id": int(params.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "from": FAKE_BOT_USER,
+                "text": params.get("text", ""),
+            }
+        if method == "getupdates":
+            offset = int(params.get("offset") or 0)
+            updates = [u for u in self.pending_updates if u["update_id"] >= offset]
+            self.pending_updates = updates
+            return updates
+        if method == "getfile":
+            file_id = params.get("file_id", "")
+            return {
+                "file_id": file_id, "file_unique_id": file_id,
+                "file_size": len(self.files.get(file_id, b"")), "file_path": file_id,
+            }
+        # answerCallbackQuery, setWebhook, deleteWebhook и прочее
+        return True
+
+    async def post_updates(self, webhook_url: str, updates, secret: str = None, concurrency: int = 10):
+        """Отправляет апдейты на вебхук так же, как это делает Telegram. Возвращает список HTTP-статусов."""
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async with ClientSession() as session:
+            async def post(update):
+                async with semaphore:
+                    async with session.post(webhook_url, json=update, headers=headers) as response:
+                        return response.status
+
+            return await asyncio.gather(*(post(update) for update in updates))
+
+
+class FakeRedis:
+    """
+    Заглушка сервера Redis (протокол RESP2) для проверки FSM_STORAGE=redis и THROTTLE_STORAGE=redis
+    без настоящего Redis. Понимает только команды, которые использует src/storage.py:
+    PING, AUTH, SELECT, GET, SET (EX/PX), DEL, EXISTS, INCRBYFLOAT, EXPIRE, TTL, FLUSHDB.
+    Все полученные команды складываются в commands.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6380):
+        self.host = host
+        self.port = port
+        self.commands: list[list[str]] = []
+        self._data: dict[bytes, bytes] = {}
+        self._expires: dict[bytes, float] = {}
+        self._server: asyncio.AbstractServer | None = None
+
+    @property
+    def url(self) -> str:
+        return f"redis://{self.host}:{self.port}/0"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        # Порт 0 - любой свободный (тесты)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readuntil(b"\r\n")
+                if not line.startswith(b"*"):
+                    break
+                args = []
+                for _ in range(int(line[1:-2])):
+                    length = int((await reader.readuntil(b"\r\n"))[1:-2])
+                    args.append((await reader.readexactly(length + 2))[:-2])
+                writer.write(self._execute(args))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _get(self, key: bytes):
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return self._data.get(key)
+
+    def _execute(self, args: list) -> bytes:
+        command, args = args[0].decode().upper(), args[1:]
+        self.commands.append([command] + [arg.decode(errors="replace") for arg in args])
+        if command in ("PING", "AUTH", "SELECT"):
+            return b"+PONG\r\n" if command == "PING" else b"+OK\r\n"
+        if command == "GET":
+            value = self._get(args[0])
+            return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+        if command == "SET":
+            key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+            self._data[key] = value
+            self._expires.pop(key, None)
+            for option, amount in zip(options, args[3:]):
+                if option in (b"EX", b"PX"):
+                    seconds = float(amount) / (1000 if option == b"PX" else 1)
+                    self._expires[key] = time.monotonic() + seconds
+            return b"+OK\r\n"
+        if command in ("DEL", "EXISTS"):
+            found = [key for key in args if self._get(key) is not None]
+            if command == "DEL":
+                for key in found:
+                    self._data.pop(key, None)
+                    self._expires.pop(key, None)
+            return b":%d\r\n" % len(found)
+        if command == "INCRBYFLOAT":
+            key = args[0]
+            value = float(self._get(key) or 0) + float(args[1])
+            self._data[key] = repr(value).encode()
+            return b"$%d\r\n%s\r\n" % (len(self._data[key]), self._data[key])
+        if command == "EXPIRE":
+            if self._get(args[0]) is None:
+                return b":0\r\n"
+            self._expires[args[0]] = time.monotonic() + int(args[1])
+            return b":1\r\n"
+        if command == "TTL":
+            if self._get(args[0]) is None:
+                return b":-2\r\n"
+            expires = self._expires.get(args[0])
+            return b":%d\r\n" % (-1 if expires is None else round(expires - time.monotonic()))
+        if command == "FLUSHDB":
+            self._data.clear()
+            self._expires.clear()
+            return b"+OK\r\n"
+        return b"-ERR unknown command '%s'\r\n" % command.encode()
+
+
+def make_user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+
+def make_message_update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": make_user(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+            if text.startswith("/") else [],
+        },
+    }
+
+
+def make_document_update(update_id: int, user_id: int, file_id: str, file_name: str, caption: str = None) -> dict:
+    update = make_message_update(update_id, user_id, "")
+    message = update["message"]
+    del message["text"], message["entities"]
+    message["document"] = {"file_id": file_id, "file_unique_id": file_id, "file_name": file_name}
+    if caption:
+        message["caption"] = caption
+    return update
+
+
+def make_callback_update(update_id: int, user_id: int, data: str, message_id: int = 1) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": make_user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": FAKE_BOT_USER,
+                "text": "Главное меню:",
+            },
+        },
+    }
+
+
+async def _cli(args):
+    api = FakeBotAPI(args.host, args.port)
+    await api.start()
+    print(f"Заглушка Bot API слушает {api.url}")
+    redis = None
+    if args.redis_port:
+        redis = FakeRedis(args.host, args.redis_port)
+        await redis.start()
+        print(f"Заглушка Redis слушает {redis.url}")
+
+    if args.webhook:
+        updates = []
+        for user_id in range(1, args.users + 1):
+            updates.append(make_message_update(len(updates) + 1, user_id, "/start"))
+            updates.append(make_callback_update(len(updates) + 1, user_id, "get_best_proxy"))
+        started = time.perf_counter()
+        statuses = await api.post_updates(args.webhook, updates, args.secret)
+        elapsed = time.perf_counter() - started
+        print(f"Отправлено {len(updates)} апдейтов за {elapsed:.2f} с, статусы: {sorted(set(statuses))}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(json.dumps([method for method, _ in api.calls[-10:]], ensure_ascii=False))
+        await api.stop()
+        if redis:
+            await redis.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--webhook", help="URL вебхука бота, на который отправить синтетические апдейты")
+    parser.add_argument("--secret", help="Секрет вебхука (WEBHOOK_SECRET)")
+    parser.add_argument("--users", type=int, default=10, help="Сколько пользователей нажмут /start и 'лучший прокси'")
+    parser.add_argument("--redis-port", type=int, default=0, help="Запустить и заглушку Redis на этом порту (REDIS_URL)")
+    try:
+        asyncio.run(_cli(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import time
+
+from src import database as db
+from src.config import HEALTH_INTERVAL, HEALTH_TIMEOUT, HEALTH_CONCURRENCY
+from src.registry import registry
+
+logger = logging.getLogger(__name__)
+
+# Сколько неудач подряд исключают прокси из выдачи и сколько успехов подряд возвращают его
+FAIL_THRESHOLD = 3
+RECOVER_THRESHOLD = 2
+# Вес последней проверки в скользящем среднем RTT и доле успешных проверок
+EWMA_ALPHA = 0.3
+
+
+class HealthProber:
+    """
+    Фоновая проверка доступности прокси: раз в interval секунд параллельно
+    (не больше concurrency соединений) открывает TCP-соединение с server:port.
+    RTT и доля успешных проверок сохраняются в proxy_health и в реестр;
+    недоступные прокси перестают выдаваться и возвращаются после восстановления.
+    """
+
+    def __init__(
+        self,
+        interval: float = HEALTH_INTERVAL,
+        timeout: float = HEALTH_TIMEOUT,
+        concurrency: int = HEALTH_CONCURRENCY,
+    ):
+        self.interval = interval
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # proxy_id -> [неудач подряд, успехов подряд]
+        self._streaks: dict[int, list[int]] = {}
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.check_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка проверки доступности прокси")
+            await asyncio.sleep(self.interval)
+
+    async def probe(self, server: str, port: int):
+        """RTT установки TCP-соединения в миллисекундах или None, если не удалось."""
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(server, port), self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                return None
+            rtt_ms = (time.perf_counter() - started) * 1000
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+            return rtt_ms
+
+    async def check_all(self):
+        """Один раунд проверки всех включенных прокси. Возвращает сохраненные результаты."""
+        proxies = registry.all(only_active=True)
+        if not proxies:
+            return []
+
+        rtts = await asyncio.gather(*(self.probe(p["server"], p["port"]) for p in proxies))
+        results = [self._evaluate(p, rtt) for p, rtt in zip(proxies, rtts)]
+        # Забываем серии удаленных и отключенных прокси
+        checked = {p["id"] for p in proxies}
+        for proxy_id in self._streaks.keys() - checked:
+            del self._streaks[proxy_id]
+        await db.save_proxy_health(results)
+        return results
+
+    def _evaluate(self, proxy: dict, rtt_ms):
+        proxy_id = proxy["id"]
+        streak = self._streaks.setdefault(proxy_id, [0, 0])
+        ok = rtt_ms is not None
+        if ok:
+            streak[0], streak[1] = 0, streak[1] + 1
+        else:
+            streak[0], streak[1] = streak[0] + 1, 0
+
+        success_rate = (1 - EWMA_ALPHA) * (proxy.get("success_rate") or 0) + EWMA_ALPHA * ok
+        if ok and proxy.get("rtt_ms") is not None:
+            rtt_ms = (1 - EWMA_ALPHA) * proxy["rtt_ms"] + EWMA_ALPHA * rtt_ms
+        elif not ok:
+            rtt_ms = proxy.get("rtt_ms")
+
+        healthy = proxy.get("is_healthy", 1)
+        if healthy and streak[0] >= FAIL_THRESHOLD:
+            healthy = 0
+            logger.warning("Прокси %s (%s:%s) недоступен, исключен из выдачи", proxy_id, proxy["server"], proxy["port"])
+        elif not healthy and streak[1] >= RECOVER_THRESHOLD:
+            healthy = 1
+            logger.info("Прокси %s (%s:%s) снова доступен", proxy_id, proxy["server"], proxy["port"])
+
+        return (proxy_id, rtt_ms, round(success_rate, 4), healthy)
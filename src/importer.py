@@ -0,0 +1,106 @@
+import codecs
+import re
+import urllib.parse
+from dataclasses import dataclass, field
+
+# Ссылка на прокси в любом месте строки: tg://proxy?... или https://t.me/proxy?...
+PROXY_LINK_RE = re.compile(r"(?:tg://proxy|(?:https?://)?(?:www\.)?t\.me/proxy)\?[^\s,;|\"']+", re.IGNORECASE)
+# Разделители между ссылкой и локацией в txt/csv
+SEPARATORS = " \t,;|\"'"
+SECRET_RE = re.compile(r"^[0-9A-Za-z_+/=-]+$")
+MAX_LOCATION_LENGTH = 64
+# Сколько номеров ошибочных строк показываем админу
+MAX_REPORTED_ERRORS = 10
+
+
+def parse_proxy_link(link: str):
+    """(server, port, secret) из ссылки tg://proxy или https://t.me/proxy, либо None."""
+    params = urllib.parse.parse_qs(urllib.parse.urlparse(link).query)
+    server = params.get("server", [""])[0].strip()
+    port = params.get("port", [""])[0].strip()
+    secret = params.get("secret", [""])[0].strip()
+
+    if not server or " " in server or not port.isdigit() or not SECRET_RE.match(secret):
+        return None
+    port = int(port)
+    if not 0 < port < 65536:
+        return None
+    return server, port, secret
+
+
+def parse_proxy_line(line: str, default_location: str = None):
+    """
+    Разбирает строку файла импорта. Ссылка может стоять до или после локации:
+    "Финляндия 🇫🇮, tg://proxy?..." или "https://t.me/proxy?...;Германия".
+    Возвращает dict прокси, None для ошибочной строки.
+    """
+    match = PROXY_LINK_RE.search(line)
+    if not match:
+        return None
+    parsed = parse_proxy_link(match.group(0))
+    if not parsed:
+        return None
+
+    location = (line[:match.start()] + " " + line[match.end():]).strip(SEPARATORS)
+    location = location or default_location
+    if not location or len(location) > MAX_LOCATION_LENGTH:
+        return None
+
+    server, port, secret = parsed
+    return {"location": location, "server": server, "port": port, "secret": secret}
+
+
+def iter_lines(chunks, encoding: str = "utf-8"):
+    """Склеивает строки из потока байтовых кусков, не держа весь файл в памяти."""
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    tail = ""
+    for chunk in chunks:
+        lines = (tail + decoder.decode(chunk)).splitlines(keepends=True)
+        tail = lines.pop() if lines and not lines[-1].endswith(("\n", "\r")) else ""
+        for line in lines:
+            yield line.rstrip("\r\n")
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+@dataclass
+class ImportResult:
+    proxies: list = field(default_factory=list)
+    duplicates: int = 0
+    invalid: int = 0
+    invalid_lines: list = field(default_factory=list)
+
+
+def collect_proxies(lines, known_identifiers: set, default_location: str = None) -> ImportResult:
+    """
+    Проверяет строки файла и отбрасывает повторы по unique_identifier (server:port) -
+    и уже известные базе, и повторяющиеся внутри файла.
+    Пустые строки и комментарии (#) пропускаются, как и заголовок CSV в первой строке.
+    """
+    result = ImportResult()
+    seen = set(known_identifiers)
+
+    for number, line in enumerate(lines, start=1):
+        text = line.strip().lstrip("﻿")
+        if not text or text.startswith("#"):
+            continue
+
+        proxy = parse_proxy_line(text, default_location)
+        if proxy is None:
+            if number == 1 and "proxy?" not in text:
+                continue  # заголовок CSV
+            result.invalid += 1
+            if len(result.invalid_lines) < MAX_REPORTED_ERRORS:
+                result.invalid_lines.append(number)
+            continue
+
+        identifier = f"{proxy['server']}:{proxy['port']}"
+        if identifier in seen:
+            result.duplicates += 1
+            continue
+        seen.add(identifier)
+        proxy["unique_identifier"] = identifier
+        result.proxies.append(proxy)
+
+    return result
@@ -1,38 +1,73 @@
 import asyncio
+import html
 import logging
+import multiprocessing
+import os
+import signal
 import sys
 import urllib.parse
-import time
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import CommandStart, Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from src.config import BOT_TOKEN, INITIAL_PROXIES, get_proxy_link, ADMIN_IDS
+from src.config import (
+    BOT_TOKENS, BOT_API_URL, INITIAL_PROXIES, get_proxy_link, ADMIN_IDS,
+    BOT_MODE, WEB_WORKERS, MULTI_WORKER, SYNC_INTERVAL, METRICS_HOST, METRICS_PORT, ACTIVE_WINDOW_HOURS,
+)
 from src import database as db
+from src.broadcast import BroadcastEngine
+from src.health import HealthProber
+from src.retention import RetentionJob
+from src.sync import RegistrySync
+from src.startup import StartupTimer
+from src.balancer import get_scorer
+from src import render
+from src import responses
+from src.metrics import MetricsMiddleware, instrument_module, start_metrics_server, format_stats
+from src.importer import collect_proxies, iter_lines
+from src.callbacks import Action, CallbackRouter, cb
+from src.middlewares import ThrottlingMiddleware
+from src.storage import create_storages
+from src.webhook import run_webhook
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+# Замеры фаз запуска и времени до первого ответа
+startup = StartupTimer()
 
 # Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-
-# --- Rate Limit Config ---
-RATE_LIMIT = 2.0 # seconds
-user_last_action = {}
-
-def check_rate_limit(user_id: int) -> bool:
-    now = time.time()
-    last_time = user_last_action.get(user_id, 0)
-    
-    if now - last_time < RATE_LIMIT:
-        return False # Too fast
-        
-    user_last_action[user_id] = now
-    return True
+# Все боты из BOT_TOKEN делят одну HTTP-сессию (пул соединений к Bot API), диспетчер и базу
+session = AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else AiohttpSession()
+bots = [Bot(token=token, session=session) for token in BOT_TOKENS]
+# Состояния диалогов и ведра антиспама переживают рестарт и общие для воркеров (FSM_STORAGE, THROTTLE_STORAGE)
+fsm_storage, throttle_store = create_storages()
+dp = Dispatcher(storage=fsm_storage)
+# Рассылки выполняет только воркер 0, поэтому при нескольких воркерах он опрашивает очередь
+broadcaster = BroadcastEngine(bots, poll_interval=SYNC_INTERVAL if MULTI_WORKER else None)
+prober = HealthProber()
+retention = RetentionJob()
+registry_sync = RegistrySync()
+
+dp.update.outer_middleware(startup.first_response_middleware)
+
+# --- Metrics ---
+# Замер времени обработки регистрируется первым, чтобы учитывать и отброшенный спам
+metrics_middleware = MetricsMiddleware()
+for observer in (dp.message, dp.callback_query):
+    observer.outer_middleware(metrics_middleware)
+    observer.middleware(MetricsMiddleware.resolve_handler)
+instrument_module(db)
+
+# --- Rate Limit ---
+# Спам отбрасывается до фильтров и хендлеров (см. src/middlewares.py)
+throttling = ThrottlingMiddleware(store=throttle_store)
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
 
 # States
 class AddProxyState(StatesGroup):
@@ -40,154 +75,125 @@ class AddProxyState(StatesGroup):
     waiting_for_location = State()
     confirm_notification = State()
 
+class ImportProxyState(StatesGroup):
+    waiting_for_file = State()
+    confirm_notification = State()
+
+class AdminSearchState(StatesGroup):
+    waiting_for_query = State()
+
 class EditProxyState(StatesGroup):
     waiting_for_new_location = State()
     waiting_for_new_link = State()
+    waiting_for_new_capacity = State()
+
+# Оценка прокси для админки (та же функция, что у стратегии score)
+score_proxy = get_scorer()
 
 # --- Middleware / Checks ---
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
+# --- Callbacks ---
+# Все кнопки разбираются одним хендлером: действие из callback_data -> хендлер (src/callbacks.py)
+callback_router = CallbackRouter(is_admin)
+
+@dp.callback_query()
+async def dispatch_callback(callback: types.CallbackQuery, **data):
+    await callback_router.dispatch(callback, **data)
+
+def new_proxy_notification(location, server, port, secret) -> str:
+    link = get_proxy_link(server, port, secret)
+    return (
+        f"🎉 <b>Добавлен новый прокси!</b>\n\n"
+        f"🌍 Локация: {html.escape(location or '')}\n"
+        f"🔗 <a href='{link}'>Подключиться сейчас</a>"
+    )
+
+def bulk_proxy_notification(count: int, locations: list) -> str:
+    return (
+        f"🎉 <b>Добавлено новых прокси: {count}</b>\n\n"
+        f"🌍 Локации: {html.escape(', '.join(locations))}\n"
+        f"Нажмите /start, чтобы получить лучший из них"
+    )
+
 # --- User Handlers ---
 
 @dp.message(CommandStart())
 async def command_start_handler(message: types.Message):
-    if not check_rate_limit(message.from_user.id):
-        return # Ignore spam
-
-    await db.add_user(message.from_user.id, message.from_user.username)
-    
-    kb = InlineKeyboardBuilder()
-    kb.button(text="🚀 Получить лучший прокси", callback_data="get_best_proxy")
-    kb.button(text="📋 Показать все прокси", callback_data="get_all_proxies")
-    
-    if is_admin(message.from_user.id):
-        kb.button(text="⚙️ Админ панель", callback_data="admin_panel")
-        
-    kb.adjust(1)
+    # Новый пользователь или вернувшийся после блокировки бота - снова получает рассылки
+    await db.add_user(message.from_user.id, message.from_user.username, bot_id=message.bot.id)
     
     await message.answer(
         f"Привет, {message.from_user.full_name}! 👋\n\n"
         "Я помогу тебе получить быстрый MTProxy.\n"
         "Я автоматически выберу наименее нагруженный сервер для тебя.",
-        reply_markup=kb.as_markup()
+        reply_markup=render.main_menu_markup(is_admin(message.from_user.id))
     )
 
-@dp.callback_query(F.data == "get_best_proxy")
+@callback_router.route(Action.BEST_PROXY)
 async def process_get_best_proxy(callback: types.CallbackQuery):
-    if not check_rate_limit(callback.from_user.id):
-        await callback.answer("⏳ Не спешите, подождите пару секунд...", show_alert=True)
-        return
-
     proxy = await db.get_least_loaded_proxy(callback.from_user.id)
     
     if not proxy:
         await callback.message.answer("😓 Нет доступных активных прокси.")
-        await callback.answer()
         return
 
     link = get_proxy_link(proxy['server'], proxy['port'], proxy['secret'])
     
     text = (
         f"<b>🚀 Рекомендуемый прокси:</b>\n"
-        f"🌍 Локация: {proxy['location']}\n"
+        f"🌍 Локация: {html.escape(proxy['location'] or '')}\n"
         f"👥 Сейчас пользуются: {proxy['usage_count']}\n\n"
         f"👇 Нажми кнопку ниже, чтобы подключиться"
     )
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔗 Подключиться", url=link)],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="start_menu")]
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=cb(Action.MAIN_MENU))]
     ])
 
-    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
-    await callback.answer()
-
-@dp.callback_query(F.data == "get_all_proxies")
-async def process_get_all_proxies(callback: types.CallbackQuery):
-    if not check_rate_limit(callback.from_user.id):
-        await callback.answer("⏳ Не спешите, подождите пару секунд...", show_alert=True)
-        return
+    await responses.edit_text(callback, text, parse_mode="HTML", reply_markup=kb)
 
-    proxies = await db.get_all_proxies(only_active=True)
+@callback_router.route(Action.PROXY_LIST)
+@callback_router.route(Action.PROXY_LIST_PREV)
+async def process_get_all_proxies(callback: types.CallbackQuery, payload):
+    # Страница списка; текст и клавиатура берутся из кэша, пока прокси не менялись
+    view = render.proxy_list_view(payload.id, backwards=payload.action == Action.PROXY_LIST_PREV)
     
-    if not proxies:
+    if not view:
         await callback.message.answer("Список активных прокси пуст.")
-        await callback.answer()
         return
 
-    text = "<b>📋 Все доступные прокси:</b>\n\n"
-    kb = InlineKeyboardBuilder()
-    
-    for p in proxies:
-        text += (
-            f"🌍 <b>{p['location']}</b>\n"
-            f"📊 Использований: {p['usage_count']}\n\n"
-        )
-        # Теперь кнопка ведет не на URL, а вызывает callback
-        kb.button(text=f"Connect {p['location']}", callback_data=f"user_connect_{p['id']}")
-
-    kb.button(text="🔙 Назад", callback_data="start_menu")
-    kb.adjust(1)
-    
-    await callback.message.edit_text(
+    text, markup = view
+    await responses.edit_text(
+        callback,
         text, 
         parse_mode="HTML", 
-        reply_markup=kb.as_markup(),
+        reply_markup=markup,
         disable_web_page_preview=True
     )
-    await callback.answer()
-
-@dp.callback_query(F.data.startswith("user_connect_"))
-async def process_user_connect_proxy(callback: types.CallbackQuery):
-    if not check_rate_limit(callback.from_user.id):
-        await callback.answer("⏳ Не спешите, подождите пару секунд...", show_alert=True)
-        return
 
-    try:
-        proxy_id = int(callback.data.split("_")[2])
-    except (ValueError, IndexError):
-        await callback.answer("Ошибка данных", show_alert=True)
+@callback_router.route(Action.CONNECT)
+async def process_user_connect_proxy(callback: types.CallbackQuery, payload):
+    proxy_id = payload.id
+    view = render.proxy_connect_view(proxy_id)
+    if not view:
+        await responses.answer(callback, "Прокси больше не доступен", show_alert=True)
         return
 
     # Записываем использование
     await db.record_usage(callback.from_user.id, proxy_id)
     
-    # Получаем данные
-    proxy = await db.get_proxy_by_id(proxy_id)
-    if not proxy or not proxy['is_active']:
-        await callback.answer("Прокси больше не доступен", show_alert=True)
-        return
+    text, markup = view
+    await responses.edit_text(callback, text, parse_mode="HTML", reply_markup=markup)
 
-    link = get_proxy_link(proxy['server'], proxy['port'], proxy['secret'])
-    
-    text = (
-        f"<b>🌍 Выбран прокси: {proxy['location']}</b>\n"
-        f"Вот ваша ссылка для подключения 👇"
-    )
-    
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔗 Подключиться", url=link)],
-        [InlineKeyboardButton(text="🔙 К списку", callback_data="get_all_proxies")]
-    ])
-    
-    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
-    await callback.answer()
-
-@dp.callback_query(F.data == "start_menu")
+@callback_router.route(Action.MAIN_MENU)
 async def process_back_to_menu(callback: types.CallbackQuery):
-    kb = InlineKeyboardBuilder()
-    kb.button(text="🚀 Получить лучший прокси", callback_data="get_best_proxy")
-    kb.button(text="📋 Показать все прокси", callback_data="get_all_proxies")
-    
-    if is_admin(callback.from_user.id):
-        kb.button(text="⚙️ Админ панель", callback_data="admin_panel")
-        
-    kb.adjust(1)
-    
-    await callback.message.edit_text(
+    await responses.edit_text(
+        callback,
         "Главное меню:",
-        reply_markup=kb.as_markup()
+        reply_markup=render.main_menu_markup(is_admin(callback.from_user.id))
     )
 
 # --- Admin Handlers ---
@@ -198,45 +204,53 @@ async def admin_command(message: types.Message):
         return
     await show_admin_panel(message)
 
-@dp.callback_query(F.data == "admin_panel")
-async def admin_panel_callback(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        await callback.answer("Нет прав", show_alert=True)
+@dp.message(Command("stats"))
+async def stats_command(message: types.Message):
+    if not is_admin(message.from_user.id):
         return
-    await show_admin_panel(callback.message, is_edit=True)
+    await message.answer(format_stats(), parse_mode="HTML")
 
-async def show_admin_panel(message: types.Message, is_edit=False):
-    users_count = await db.get_all_users_count()
-    proxies = await db.get_all_proxies(only_active=False)
-    active_count = sum(1 for p in proxies if p['is_active'])
+@callback_router.route(Action.ADMIN_PANEL, admin_only=True)
+async def admin_panel_callback(callback: types.CallbackQuery):
+    await show_admin_panel(callback)
+
+async def show_admin_panel(target: types.Message | CallbackQuery):
+    # Для кнопки панель заменяет сообщение с кнопкой, для команды приходит новым сообщением
+    message = target.message if isinstance(target, CallbackQuery) else target
+    # Пользователи - этого бота, прокси и выдачи - общие для всех ботов
+    stats = await db.get_stats(message.bot.id)
+    users_line = f"👥 Всего юзеров: {stats['users']} (заблокировали бота: {stats['inactive_users']})\n"
+    if len(bots) > 1:
+        users_line += f"🤖 Ботов: {len(bots)}, юзеров у всех: {await db.get_all_users_count()}\n"
     
     text = (
         f"<b>⚙️ Админ панель</b>\n\n"
-        f"👥 Всего юзеров: {users_count}\n"
-        f"🌍 Прокси всего: {len(proxies)} (Активных: {active_count})"
+        f"{users_line}"
+        f"🌍 Прокси всего: {stats['proxies']} (Активных: {stats['enabled']}, в выдаче: {stats['available']})\n"
+        f"🔗 Выдано прокси: {stats['assignments']}"
     )
     
     kb = InlineKeyboardBuilder()
-    kb.button(text="➕ Добавить прокси", callback_data="admin_add_proxy")
-    kb.button(text="📋 Управление прокси", callback_data="admin_manage_proxies")
-    kb.button(text="🔙 Назад в меню", callback_data="start_menu")
+    kb.button(text="➕ Добавить прокси", callback_data=cb(Action.ADD_PROXY))
+    kb.button(text="📥 Импорт из файла", callback_data=cb(Action.IMPORT))
+    kb.button(text="📋 Управление прокси", callback_data=cb(Action.MANAGE_LIST))
+    kb.button(text="🔙 Назад в меню", callback_data=cb(Action.MAIN_MENU))
     kb.adjust(1)
     
-    if is_edit:
-        await message.edit_text(text, parse_mode="HTML", reply_markup=kb.as_markup())
+    if message is not target:
+        await responses.edit_text(target, text, parse_mode="HTML", reply_markup=kb.as_markup())
     else:
         await message.answer(text, parse_mode="HTML", reply_markup=kb.as_markup())
 
 # --- Add Proxy Logic ---
 
-@dp.callback_query(F.data == "admin_add_proxy")
+@callback_router.route(Action.ADD_PROXY, admin_only=True)
 async def start_add_proxy(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.answer(
         "Отправьте мне ссылку на MTProxy.\n"
         "Формат: https://t.me/proxy?server=...&port=...&secret=..."
     )
     await state.set_state(AddProxyState.waiting_for_link)
-    await callback.answer()
 
 @dp.message(AddProxyState.waiting_for_link)
 async def process_proxy_link(message: types.Message, state: FSMContext):
@@ -279,8 +293,8 @@ async def process_proxy_location(message: types.Message, state: FSMContext):
 
     # Ask for notification
     kb = InlineKeyboardBuilder()
-    kb.button(text="📢 Разослать уведомление", callback_data="notify_yes")
-    kb.button(text="🔕 Не рассылать", callback_data="notify_no")
+    kb.button(text="📢 Разослать уведомление", callback_data=cb(Action.NOTIFY, 1))
+    kb.button(text="🔕 Не рассылать", callback_data=cb(Action.NOTIFY, 0))
     
     await state.update_data(location=location) # Save location for notification msg
     
@@ -290,163 +304,276 @@ async def process_proxy_location(message: types.Message, state: FSMContext):
     )
     await state.set_state(AddProxyState.confirm_notification)
 
-@dp.callback_query(F.data.startswith("notify_"))
-async def process_notification_choice(callback: types.CallbackQuery, state: FSMContext):
-    action = callback.data.split("_")[1]
+@callback_router.route(Action.NOTIFY, admin_only=True)
+async def process_notification_choice(callback: types.CallbackQuery, payload, state: FSMContext):
     data = await state.get_data()
     
-    if action == "yes":
-        await callback.message.edit_text("⏳ Рассылка уведомлений...")
-        link = get_proxy_link(data['server'], data['port'], data['secret'])
-        msg_text = (
-            f"🎉 <b>Добавлен новый прокси!</b>\n\n"
-            f"🌍 Локация: {data['location']}\n"
-            f"🔗 <a href='{link}'>Подключиться сейчас</a>"
-        )
-        
-        users = await db.get_all_users()
-        count = 0
-        for user_id in users:
-            try:
-                await bot.send_message(user_id, msg_text, parse_mode="HTML")
-                count += 1
-                await asyncio.sleep(0.05)
-            except Exception:
-                pass
+    if payload.id:
+        await responses.edit_text(callback, "⏳ Рассылка уведомлений поставлена в очередь...")
+        msg_text = new_proxy_notification(data['location'], data['server'], data['port'], data['secret'])
         
-        await callback.message.answer(f"✅ Рассылка завершена. Отправлено: {count}.")
+        # Рассылка идет в фоне, прогресс обновляется в этом же сообщении
+        await broadcaster.submit(
+            msg_text,
+            report_chat_id=callback.message.chat.id,
+            report_message_id=callback.message.message_id,
+            report_bot_id=callback.bot.id,
+        )
     else:
-        await callback.message.edit_text("✅ Прокси добавлен без рассылки.")
+        await responses.edit_text(callback, "✅ Прокси добавлен без рассылки.")
         
     await state.clear()
     await show_admin_panel(callback.message)
 
-# --- Manage Proxies Logic ---
+# --- Bulk Import ---
 
-@dp.callback_query(F.data == "admin_manage_proxies")
-async def list_proxies_admin(callback: types.CallbackQuery):
-    proxies = await db.get_all_proxies(only_active=False)
-    
-    if not proxies:
-        await callback.message.edit_text("Прокси нет.", reply_markup=InlineKeyboardBuilder().button(text="🔙 Назад", callback_data="admin_panel").as_markup())
+# Telegram отдает ботам файлы до 20 МБ
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024
+IMPORT_CHUNK_SIZE = 64 * 1024
+# Сколько разных локаций перечислять в общем уведомлении
+NOTIFY_MAX_LOCATIONS = 10
+
+async def ask_import_file(message: types.Message, state: FSMContext):
+    await message.answer(
+        "Отправьте файл .txt или .csv: по одному прокси на строку, ссылка tg://proxy или "
+        "https://t.me/proxy и локация через пробел, запятую или точку с запятой.\n"
+        "Например: <code>Финляндия 🇫🇮, tg://proxy?server=...&amp;port=443&amp;secret=...</code>\n"
+        "Подпись к файлу будет локацией для строк без нее. Отмена - /cancel.",
+        parse_mode="HTML"
+    )
+    await state.set_state(ImportProxyState.waiting_for_file)
+
+@dp.message(Command("import"))
+async def import_command(message: types.Message, state: FSMContext):
+    if not is_admin(message.from_user.id):
+        return
+    await ask_import_file(message, state)
+
+@callback_router.route(Action.IMPORT, admin_only=True)
+async def start_import_proxies(callback: types.CallbackQuery, state: FSMContext):
+    await ask_import_file(callback.message, state)
+
+@dp.message(ImportProxyState.waiting_for_file)
+async def process_import_file(message: types.Message, state: FSMContext):
+    document = message.document
+    if not document:
+        if message.text and message.text.startswith("/cancel"):
+            await state.clear()
+            await message.answer("Импорт отменен.")
+        else:
+            await message.answer("Нужен файл .txt или .csv. Отмена - /cancel.")
+        return
+
+    name = (document.file_name or "").lower()
+    if not name.endswith((".txt", ".csv")) and not (document.mime_type or "").startswith("text/"):
+        await message.answer("❌ Поддерживаются только файлы .txt и .csv.")
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await message.answer("❌ Файл больше 20 МБ.")
         return
 
-    text = "select_proxy_to_manage"
+    status = await message.answer("⏳ Читаю файл...")
+    file = await message.bot.download(document)
+    # Файл разбирается построчно кусками, без чтения и декодирования целиком
+    chunks = iter(lambda: file.read(IMPORT_CHUNK_SIZE), b"")
+    known = {p['unique_identifier'] for p in await db.get_all_proxies(only_active=False)}
+    # Разбор большого файла занимает секунды - в отдельном потоке, чтобы не держать цикл событий
+    result = await asyncio.to_thread(
+        collect_proxies, iter_lines(chunks), known, default_location=(message.caption or "").strip() or None
+    )
+
+    added = await db.add_proxies_bulk(result.proxies)
+    # Прокси, которые успели добавить параллельно, тоже повторы
+    duplicates = result.duplicates + len(result.proxies) - len(added)
+
+    text = (
+        f"<b>📥 Импорт завершен</b>\n\n"
+        f"✅ Добавлено: {len(added)}\n"
+        f"♻️ Уже были: {duplicates}\n"
+        f"⚠️ С ошибками: {result.invalid}"
+    )
+    if result.invalid_lines:
+        text += f" (строки {', '.join(map(str, result.invalid_lines))}{'...' if result.invalid > len(result.invalid_lines) else ''})"
+
+    if not added:
+        await status.edit_text(text, parse_mode="HTML")
+        await state.clear()
+        return
+
+    locations = list(dict.fromkeys(p['location'] for p in added))
+    if len(locations) > NOTIFY_MAX_LOCATIONS:
+        locations = locations[:NOTIFY_MAX_LOCATIONS] + ["..."]
+    await state.update_data(import_count=len(added), import_locations=locations)
     kb = InlineKeyboardBuilder()
-    
-    for p in proxies:
-        status_icon = "✅" if p['is_active'] else "❌"
-        # Кнопка ведет в меню управления конкретным прокси
-        label = f"{status_icon} {p['location']} | 👥 {p['usage_count']}"
-        kb.button(text=label, callback_data=f"manage_proxy_{p['id']}")
-    
-    kb.button(text="🔙 Назад", callback_data="admin_panel")
+    kb.button(text="📢 Разослать одно уведомление", callback_data=cb(Action.IMPORT_NOTIFY, 1))
+    kb.button(text="🔕 Не рассылать", callback_data=cb(Action.IMPORT_NOTIFY, 0))
     kb.adjust(1)
-    
-    await callback.message.edit_text("Выберите прокси для управления:", reply_markup=kb.as_markup())
+    await status.edit_text(text, parse_mode="HTML", reply_markup=kb.as_markup())
+    await state.set_state(ImportProxyState.confirm_notification)
+
+@callback_router.route(Action.IMPORT_NOTIFY, admin_only=True)
+async def process_import_notification_choice(callback: types.CallbackQuery, payload, state: FSMContext):
+    if await state.get_state() != ImportProxyState.confirm_notification.state:
+        return
+    data = await state.get_data()
+    await state.clear()
+
+    if payload.id:
+        await responses.edit_text(callback, "⏳ Рассылка уведомления поставлена в очередь...")
+        await broadcaster.submit(
+            bulk_proxy_notification(data['import_count'], data['import_locations']),
+            report_chat_id=callback.message.chat.id,
+            report_message_id=callback.message.message_id,
+            report_bot_id=callback.bot.id,
+        )
+    else:
+        await responses.edit_text(callback, "✅ Прокси добавлены без рассылки.")
+
+    await show_admin_panel(callback.message)
+
+# --- Manage Proxies Logic ---
+
+@callback_router.route(Action.MANAGE_LIST, admin_only=True)
+@callback_router.route(Action.MANAGE_LIST_PREV, admin_only=True)
+async def list_proxies_admin(callback: types.CallbackQuery, payload=None, state: FSMContext = None):
+    # Страница списка с фильтрами, которые админ выбрал раньше (хранятся в данных FSM)
+    filters = await state.get_data() if state else {}
+    text, markup = render.admin_proxy_list_view(
+        payload.id if payload else 0,
+        backwards=payload is not None and payload.action == Action.MANAGE_LIST_PREV,
+        status=filters.get('list_status', 0),
+        search=filters.get('list_search', ""),
+    )
+    await responses.edit_text(callback, text, parse_mode="HTML", reply_markup=markup)
+
+@callback_router.route(Action.MANAGE_FILTER, admin_only=True)
+async def filter_proxies_admin(callback: types.CallbackQuery, payload, state: FSMContext):
+    await state.update_data(list_status=payload.id)
+    await list_proxies_admin(callback, state=state)
+
+@callback_router.route(Action.MANAGE_SEARCH, admin_only=True)
+async def search_proxies_admin_start(callback: types.CallbackQuery, state: FSMContext):
+    await callback.message.answer("Введите часть названия локации или адреса сервера:")
+    await state.set_state(AdminSearchState.waiting_for_query)
+
+@dp.message(AdminSearchState.waiting_for_query)
+async def search_proxies_admin_finish(message: types.Message, state: FSMContext):
+    # Состояние снимается, а фильтры в данных остаются для следующих страниц
+    await state.set_state(None)
+    await state.update_data(list_search=(message.text or "").strip()[:32])
+    filters = await state.get_data()
+    text, markup = render.admin_proxy_list_view(
+        status=filters.get('list_status', 0), search=filters['list_search']
+    )
+    await message.answer(text, parse_mode="HTML", reply_markup=markup)
+
+@callback_router.route(Action.MANAGE_SEARCH_RESET, admin_only=True)
+async def search_proxies_admin_reset(callback: types.CallbackQuery, state: FSMContext):
+    await state.update_data(list_search="")
+    await list_proxies_admin(callback, state=state)
 
 async def refresh_proxy_view(callback: types.CallbackQuery, proxy_id: int):
     proxy = await db.get_proxy_by_id(proxy_id)
     
     if not proxy:
-        await callback.answer("Прокси не найден", show_alert=True)
+        await responses.answer(callback, "Прокси не найден", show_alert=True)
         await list_proxies_admin(callback)
         return
 
     link = get_proxy_link(proxy['server'], proxy['port'], proxy['secret'])
     status_text = "Активен ✅" if proxy['is_active'] else "Отключен ❌"
+    if proxy['rtt_ms'] is None:
+        health_text = "нет данных"
+    else:
+        health_icon = "🟢" if proxy['is_healthy'] else "🔴 исключен из выдачи,"
+        health_text = f"{health_icon} {proxy['rtt_ms']:.0f} мс, успешно {proxy['success_rate']:.0%}"
     
     text = (
-        f"⚙️ <b>Управление прокси: {proxy['location']}</b>\n\n"
+        f"⚙️ <b>Управление прокси: {html.escape(proxy['location'] or '')}</b>\n\n"
         f"🔗 Хост: {proxy['server']}:{proxy['port']}\n"
         f"🔑 Секрет: {proxy['secret'][:10]}...\n"
         f"📊 Статус: {status_text}\n"
-        f"👥 Использований: {proxy['usage_count']}\n"
+        f"🩺 Доступность: {health_text}\n"
+        f"👥 Использований: {proxy['usage_count']} из {proxy['capacity']} (вес {proxy['weight']:g})\n"
+        f"🕐 Новых выдач за {ACTIVE_WINDOW_HOURS} ч: {proxy['active_users']}\n"
+        f"🏅 Оценка балансировщика: {score_proxy(proxy):.3f}\n"
         f"🔗 <a href='{link}'>Ссылка подключения</a>"
     )
     
     kb = InlineKeyboardBuilder()
     # Toggle Status
     toggle_text = "🛑 Отключить" if proxy['is_active'] else "▶️ Включить"
-    kb.button(text=toggle_text, callback_data=f"toggle_proxy_{proxy['id']}")
+    kb.button(text=toggle_text, callback_data=cb(Action.TOGGLE, proxy['id']))
     
     # Edit buttons
-    kb.button(text="✏️ Изм. Локацию", callback_data=f"edit_loc_{proxy['id']}")
-    kb.button(text="✏️ Изм. Данные (ссылку)", callback_data=f"edit_link_{proxy['id']}")
+    kb.button(text="✏️ Изм. Локацию", callback_data=cb(Action.EDIT_LOCATION, proxy['id']))
+    kb.button(text="✏️ Изм. Данные (ссылку)", callback_data=cb(Action.EDIT_LINK, proxy['id']))
+    kb.button(text="⚖️ Емкость и вес", callback_data=cb(Action.EDIT_CAPACITY, proxy['id']))
     
     # Reset Stats
-    kb.button(text="🔄 Сброс статистики", callback_data=f"reset_stats_{proxy['id']}")
+    kb.button(text="🔄 Сброс статистики", callback_data=cb(Action.RESET_ASK, proxy['id']))
     
     # Delete
-    kb.button(text="🗑 Удалить", callback_data=f"delete_proxy_confirm_{proxy['id']}")
+    kb.button(text="🗑 Удалить", callback_data=cb(Action.DELETE_ASK, proxy['id']))
     
-    kb.button(text="🔙 К списку", callback_data="admin_manage_proxies")
-    kb.adjust(2, 2, 1, 1) # Grid layout
+    kb.button(text="🔙 К списку", callback_data=cb(Action.MANAGE_LIST))
+    kb.adjust(2, 2, 1, 1, 1) # Grid layout
     
-    try:
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb.as_markup(), disable_web_page_preview=True)
-    except Exception:
-        await callback.answer()
+    await responses.edit_text(callback, text, parse_mode="HTML", reply_markup=kb.as_markup(), disable_web_page_preview=True)
 
-@dp.callback_query(F.data.startswith("manage_proxy_"))
-async def show_proxy_details(callback: types.CallbackQuery):
-    proxy_id = int(callback.data.split("_")[2])
-    await refresh_proxy_view(callback, proxy_id)
+@callback_router.route(Action.MANAGE, admin_only=True)
+async def show_proxy_details(callback: types.CallbackQuery, payload):
+    await refresh_proxy_view(callback, payload.id)
 
 # --- Toggle Status ---
-@dp.callback_query(F.data.startswith("toggle_proxy_"))
-async def toggle_proxy(callback: types.CallbackQuery):
-    proxy_id = int(callback.data.split("_")[2])
+@callback_router.route(Action.TOGGLE, admin_only=True)
+async def toggle_proxy(callback: types.CallbackQuery, payload):
+    proxy_id = payload.id
     await db.toggle_proxy_status(proxy_id)
     await refresh_proxy_view(callback, proxy_id)
 
 # --- Delete Proxy ---
-@dp.callback_query(F.data.startswith("delete_proxy_confirm_"))
-async def confirm_delete_proxy(callback: types.CallbackQuery):
-    proxy_id = int(callback.data.split("_")[3])
+@callback_router.route(Action.DELETE_ASK, admin_only=True)
+async def confirm_delete_proxy(callback: types.CallbackQuery, payload):
+    proxy_id = payload.id
     kb = InlineKeyboardBuilder()
-    kb.button(text="🗑 ДА, УДАЛИТЬ", callback_data=f"delete_proxy_final_{proxy_id}")
-    kb.button(text="🔙 Нет, отмена", callback_data=f"manage_proxy_{proxy_id}")
+    kb.button(text="🗑 ДА, УДАЛИТЬ", callback_data=cb(Action.DELETE, proxy_id))
+    kb.button(text="🔙 Нет, отмена", callback_data=cb(Action.MANAGE, proxy_id))
     
-    await callback.message.edit_text("❓ Вы уверены, что хотите удалить этот прокси? Это действие необратимо.", reply_markup=kb.as_markup())
+    await responses.edit_text(callback, "❓ Вы уверены, что хотите удалить этот прокси? Это действие необратимо.", reply_markup=kb.as_markup())
 
-@dp.callback_query(F.data.startswith("delete_proxy_final_"))
-async def final_delete_proxy(callback: types.CallbackQuery):
-    proxy_id = int(callback.data.split("_")[3])
+@callback_router.route(Action.DELETE, admin_only=True)
+async def final_delete_proxy(callback: types.CallbackQuery, payload):
+    proxy_id = payload.id
     await db.delete_proxy(proxy_id)
-    await callback.answer("Прокси удален.")
+    await responses.answer(callback, "Прокси удален.")
     await list_proxies_admin(callback)
 
 # --- Reset Stats ---
-@dp.callback_query(F.data.startswith("reset_stats_"))
-async def reset_proxy_stats_handler(callback: types.CallbackQuery):
-    # Check if this is actually the confirm action caught by the prefix filter
-    if "confirm" in callback.data:
-        return # Skip this handler, let the next one handle it (or use better naming)
-        
-    proxy_id = int(callback.data.split("_")[2])
+@callback_router.route(Action.RESET_ASK, admin_only=True)
+async def reset_proxy_stats_handler(callback: types.CallbackQuery, payload):
+    proxy_id = payload.id
     kb = InlineKeyboardBuilder()
-    kb.button(text="✅ Да, сбросить", callback_data=f"confirm_reset_stats_{proxy_id}")
-    kb.button(text="🔙 Отмена", callback_data=f"manage_proxy_{proxy_id}")
+    kb.button(text="✅ Да, сбросить", callback_data=cb(Action.RESET, proxy_id))
+    kb.button(text="🔙 Отмена", callback_data=cb(Action.MANAGE, proxy_id))
     
-    await callback.message.edit_text("❓ Сбросить счетчик использований? История выдачи этому пользователям также будет очищена.", reply_markup=kb.as_markup())
+    await responses.edit_text(callback, "❓ Сбросить счетчик использований? История выдачи этому пользователям также будет очищена.", reply_markup=kb.as_markup())
 
-@dp.callback_query(F.data.startswith("confirm_reset_stats_"))
-async def confirm_reset_stats(callback: types.CallbackQuery):
-    proxy_id = int(callback.data.split("_")[3])
+@callback_router.route(Action.RESET, admin_only=True)
+async def confirm_reset_stats(callback: types.CallbackQuery, payload):
+    proxy_id = payload.id
     await db.reset_proxy_usage(proxy_id)
-    await callback.answer("Статистика сброшена.")
+    await responses.answer(callback, "Статистика сброшена.")
     await refresh_proxy_view(callback, proxy_id)
 
 # --- Edit Proxy ---
 
-@dp.callback_query(F.data.startswith("edit_loc_"))
-async def edit_proxy_location_start(callback: types.CallbackQuery, state: FSMContext):
-    proxy_id = int(callback.data.split("_")[2])
+@callback_router.route(Action.EDIT_LOCATION, admin_only=True)
+async def edit_proxy_location_start(callback: types.CallbackQuery, payload, state: FSMContext):
+    proxy_id = payload.id
     await state.update_data(proxy_id=proxy_id)
     await callback.message.answer("Введите новое название локации:")
     await state.set_state(EditProxyState.waiting_for_new_location)
-    await callback.answer()
 
 @dp.message(EditProxyState.waiting_for_new_location)
 async def edit_proxy_location_finish(message: types.Message, state: FSMContext):
@@ -463,16 +590,15 @@ async def edit_proxy_location_finish(message: types.Message, state: FSMContext):
     
     # Show menu again (need temporary msg or user manually navigates)
     kb = InlineKeyboardBuilder()
-    kb.button(text="🔙 Вернуться к прокси", callback_data=f"manage_proxy_{proxy_id}")
+    kb.button(text="🔙 Вернуться к прокси", callback_data=cb(Action.MANAGE, proxy_id))
     await message.answer("Перейти назад:", reply_markup=kb.as_markup())
 
-@dp.callback_query(F.data.startswith("edit_link_"))
-async def edit_proxy_link_start(callback: types.CallbackQuery, state: FSMContext):
-    proxy_id = int(callback.data.split("_")[2])
+@callback_router.route(Action.EDIT_LINK, admin_only=True)
+async def edit_proxy_link_start(callback: types.CallbackQuery, payload, state: FSMContext):
+    proxy_id = payload.id
     await state.update_data(proxy_id=proxy_id)
     await callback.message.answer("Отправьте новую ссылку на прокси (заменит host, port, secret):")
     await state.set_state(EditProxyState.waiting_for_new_link)
-    await callback.answer()
 
 @dp.message(EditProxyState.waiting_for_new_link)
 async def edit_proxy_link_finish(message: types.Message, state: FSMContext):
@@ -503,56 +629,181 @@ async def edit_proxy_link_finish(message: types.Message, state: FSMContext):
         
     await state.clear()
     kb = InlineKeyboardBuilder()
-    kb.button(text="🔙 Вернуться к прокси", callback_data=f"manage_proxy_{proxy_id}")
+    kb.button(text="🔙 Вернуться к прокси", callback_data=cb(Action.MANAGE, proxy_id))
+    await message.answer("Перейти назад:", reply_markup=kb.as_markup())
+
+@callback_router.route(Action.EDIT_CAPACITY, admin_only=True)
+async def edit_proxy_capacity_start(callback: types.CallbackQuery, payload, state: FSMContext):
+    proxy_id = payload.id
+    await state.update_data(proxy_id=proxy_id)
+    await callback.message.answer(
+        "Введите емкость прокси (на сколько пользователей он рассчитан) и, через пробел, вес.\n"
+        "Например: 500 1.5"
+    )
+    await state.set_state(EditProxyState.waiting_for_new_capacity)
+
+@dp.message(EditProxyState.waiting_for_new_capacity)
+async def edit_proxy_capacity_finish(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    proxy_id = data['proxy_id']
+    
+    try:
+        parts = message.text.split()
+        capacity = int(parts[0])
+        proxy = await db.get_proxy_by_id(proxy_id)
+        weight = float(parts[1]) if len(parts) > 1 else proxy['weight']
+        if capacity <= 0 or weight <= 0:
+            raise ValueError("Bad values")
+        
+        await db.update_proxy_capacity(proxy_id, capacity, weight)
+        await message.answer(f"✅ Емкость: {capacity}, вес: {weight:g}")
+    except (ValueError, IndexError, TypeError):
+        await message.answer("❌ Нужны положительные числа, например: 500 1.5")
+    
+    await state.clear()
+    kb = InlineKeyboardBuilder()
+    kb.button(text="🔙 Вернуться к прокси", callback_data=cb(Action.MANAGE, proxy_id))
     await message.answer("Перейти назад:", reply_markup=kb.as_markup())
 
 
 async def check_new_proxies_and_notify():
     """Проверяет конфиг и добавляет новые прокси, рассылая уведомления."""
-    new_proxies_added = []
-    
-    for p in INITIAL_PROXIES:
-        is_new = await db.add_proxy_if_new(
-            p['location'], 
-            p['server'], 
-            p['port'], 
-            p['secret']
-        )
-        if is_new:
-            new_proxies_added.append(p)
+    # Все прокси из конфига добавляются одной транзакцией; существующие пропускаются
+    new_proxies_added = await db.add_proxies_bulk([
+        {**p, "unique_identifier": f"{p['server']}:{p['port']}"} for p in INITIAL_PROXIES
+    ])
             
-    if new_proxies_added:
-        users = await db.get_all_users()
-        for p in new_proxies_added:
-            link = get_proxy_link(p['server'], p['port'], p['secret'])
-            msg_text = (
-                f"🎉 <b>Добавлен новый прокси!</b>\n\n"
-                f"🌍 Локация: {p['location']}\n"
-                f"🔗 <a href='{link}'>Подключиться сейчас</a>"
-            )
-            print(f"Рассылка уведомления о {p['location']} для {len(users)} пользователей...")
-            for user_id in users:
-                try:
-                    await bot.send_message(user_id, msg_text, parse_mode="HTML")
-                    await asyncio.sleep(0.05) 
-                except Exception as e:
-                    print(f"Не удалось отправить пользователю {user_id}: {e}")
-
-async def main():
-    # Инициализируем БД
-    await db.init_db()
-    
-    # Проверяем новые прокси из конфига (на всякий случай)
-    await check_new_proxies_and_notify()
-    
-    print("Бот запущен!")
-    await dp.start_polling(bot)
+    for p in new_proxies_added:
+        msg_text = new_proxy_notification(p['location'], p['server'], p['port'], p['secret'])
+        print(f"Рассылка уведомления о {p['location']} поставлена в очередь")
+        await broadcaster.submit(msg_text)
+
+async def run_startup_job(name: str, job):
+    """Запускает одну фоновую задачу (функцию или корутину); ее сбой логируется и не мешает остальным."""
+    try:
+        result = job()
+        if asyncio.iscoroutine(result):
+            await result
+    except Exception:
+        logging.exception("Фоновая задача %s не запустилась", name)
+
+async def start_metrics(worker_index: int):
+    background["metrics_runner"] = await start_metrics_server(METRICS_HOST, METRICS_PORT + worker_index)
+
+async def start_deferred_jobs(worker_index: int):
+    """
+    Фоновые задачи, которые не нужны для первого ответа: запускаются,
+    когда бот уже принимает апдейты.
+    """
+    # Основной процесс (воркер 0) отвечает за рассылки и прокси из конфига
+    primary = worker_index == 0
+
+    # Прокси из конфига - первыми: их не должен пропустить сбой задач ниже.
+    # Уведомления лягут в очередь рассылок и уйдут, когда запустится broadcaster
+    if primary:
+        with startup.phase("config_proxies"):
+            await run_startup_job("config_proxies", check_new_proxies_and_notify)
+
+    with startup.phase("background_jobs"):
+        # Обработчик очереди рассылок (продолжит прерванные рестартом)
+        if primary:
+            await run_startup_job("broadcaster", broadcaster.start)
+        # Реестр прокси у каждого процесса свой, поэтому проверки идут в каждом воркере
+        await run_startup_job("prober", prober.start)
+        # Окно активных выдач сдвигается в каждом воркере, старые связи сворачивает только основной
+        retention.compact = primary
+        await run_startup_job("retention", retention.start)
+        # Правки прокси из админки, сделанные в другом воркере
+        if MULTI_WORKER:
+            await run_startup_job("registry_sync", registry_sync.start)
+
+        if METRICS_PORT:
+            await run_startup_job("metrics", lambda: start_metrics(worker_index))
+
+def log_task_failure(task: asyncio.Task):
+    """done-callback: исключение фоновой задачи иначе никто не прочитает."""
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("Фоновая задача %s завершилась с ошибкой", task.get_name(), exc_info=task.exception())
+
+# Ссылки на фоновые задачи и серверы, которые нужно остановить при выходе
+background = {}
+
+async def on_startup(worker_index: int):
+    startup.mark("listening")
+    deferred = asyncio.create_task(start_deferred_jobs(worker_index), name="deferred_jobs")
+    deferred.add_done_callback(log_task_failure)
+    background["deferred"] = deferred
+
+dp.startup.register(on_startup)
+
+async def main(worker_index: int = 0):
+    # Основной процесс (воркер 0) регистрирует вебхук
+    primary = worker_index == 0
+    dp["worker_index"] = worker_index
+
+    try:
+        # Пул соединений открыт всё время работы
+        with startup.phase("db_open"):
+            await db.pool.open()
+        # При актуальной версии схемы - одно чтение user_version
+        with startup.phase("schema"):
+            await db.ensure_schema()
+        with startup.phase("warm_up"):
+            await db.warm_up()
+            render.warm_up()
+        db.write_buffer.start()
+
+        # Рассылки, проверки и прокси из конфига стартуют в on_startup, не задерживая прием апдейтов
+        print(f"Бот запущен! Режим: {BOT_MODE}, воркер {worker_index}")
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bots, primary=primary)
+        else:
+            await dp.start_polling(*bots)
+    finally:
+        deferred = background.pop("deferred", None)
+        if deferred and not deferred.done():
+            deferred.cancel()
+        metrics_runner = background.pop("metrics_runner", None)
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await prober.stop()
+        await retention.stop()
+        await registry_sync.stop()
+        await broadcaster.stop()
+        # FSM-хранилище закрывает сам диспетчер при остановке; повторное закрытие ничего не делает
+        await fsm_storage.close()
+        await throttle_store.close()
+        await db.close_db()
+        await session.close()
+
+def run_worker(worker_index: int):
+    try:
+        asyncio.run(main(worker_index))
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
+    workers = []
     try:
-        if not BOT_TOKEN:
+        if not BOT_TOKENS:
             print("ОШИБКА: BOT_TOKEN не найден в .env файле!")
         else:
+            # В режиме вебхука дополнительные воркеры слушают тот же порт
+            if MULTI_WORKER:
+                ctx = multiprocessing.get_context("spawn")
+                for i in range(1, WEB_WORKERS):
+                    worker = ctx.Process(target=run_worker, args=(i,), daemon=True)
+                    worker.start()
+                    workers.append(worker)
             asyncio.run(main())
     except KeyboardInterrupt:
         print("Бот остановлен")
+    finally:
+        # Даем воркерам корректно закрыть БД, зависших добиваем
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGINT)
+        for worker in workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
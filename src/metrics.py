@@ -0,0 +1,203 @@
+import functools
+import inspect
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм (секунды)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Сколько последних замеров храним для точных перцентилей в /stats
+RECENT_SAMPLES = 2048
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count", "recent")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value: float):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q: float) -> float:
+        """Перцентиль по последним RECENT_SAMPLES замерам."""
+        if not self.recent:
+            return 0.0
+        samples = sorted(self.recent)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class Metrics:
+    """Гистограммы и счетчики в памяти процесса с выводом в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.help: dict[str, str] = {}
+
+    def observe(self, name: str, value: float, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def describe(self, name: str, text: str):
+        self.help[name] = text
+
+    def render(self) -> str:
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            self._header(lines, name, "counter")
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{_labels(key)} {value:g}")
+
+        for name, series in sorted(self.histograms.items()):
+            self._header(lines, name, "histogram")
+            for key, histogram in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(key, le=f'{bound:g}')} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(key, le='+Inf')} {histogram.count}")
+                lines.append(f"{name}_sum{_labels(key)} {histogram.sum:.6f}")
+                lines.append(f"{name}_count{_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines: list, name: str, kind: str):
+        if name in self.help:
+            lines.append(f"# HELP {name} {self.help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+def _labels(key: tuple, **extra) -> str:
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "Время обработки апдейта (включая фильтры и middleware)")
+metrics.describe("bot_db_query_seconds", "Время выполнения функций src/database.py")
+metrics.describe("bot_db_wait_seconds", "Ожидание соединения с БД по ролям пула (reader, writer и т.п.)")
+metrics.describe("bot_broadcast_messages_total", "Сообщения рассылок по результату")
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Outer-middleware: замеряет полное время обработки апдейта.
+    Имя хендлера узнается через resolve_handler, который нужно повесить
+    как обычный (inner) middleware: outer-middleware срабатывает до выбора хендлера.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        route = data["metrics_route"] = ["unhandled"]
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=route[0])
+
+    @staticmethod
+    async def resolve_handler(handler, event, data):
+        route = data.get("metrics_route")
+        if route is not None:
+            route[0] = data["handler"].callback.__name__
+        return await handler(event, data)
+
+
+def instrument_module(module, metric: str = "bot_db_query_seconds"):
+    """Оборачивает все публичные корутины модуля замером времени (метка query = имя функции)."""
+    for name, func in list(vars(module).items()):
+        if name.startswith("_") or not inspect.iscoroutinefunction(func):
+            continue
+        if getattr(func, "__module__", None) != module.__name__ or hasattr(func, "__wrapped__"):
+            continue
+        setattr(module, name, _timed(func, metric))
+
+
+def _timed(func, metric: str):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            metrics.observe(metric, time.perf_counter() - started, query=func.__name__)
+    return wrapper
+
+
+def format_stats(top: int = 10) -> str:
+    """Краткая сводка p50/p99 для команды /stats."""
+    lines = ["<b>📈 Статистика</b>"]
+    for title, name, label in (
+        ("Хендлеры", "bot_handler_seconds", "handler"),
+        ("Запросы к БД", "bot_db_query_seconds", "query"),
+    ):
+        series = metrics.histograms.get(name, {})
+        lines.append(f"\n<b>{title}</b> (p50 / p99, мс, число):")
+        if not series:
+            lines.append("нет данных")
+        busiest = sorted(series.items(), key=lambda item: item[1].count, reverse=True)[:top]
+        for key, histogram in busiest:
+            lines.append(
+                f"<code>{dict(key).get(label)}</code>: {histogram.quantile(0.5) * 1000:.1f} / "
+                f"{histogram.quantile(0.99) * 1000:.1f}, {histogram.count}"
+            )
+
+    broadcast = metrics.counters.get("bot_broadcast_messages_total", {})
+    if broadcast:
+        totals = ", ".join(f"{dict(key)['status']}: {value:g}" for key, value in sorted(broadcast.items()))
+        lines.append(f"\n<b>Рассылки</b>: {totals}")
+    return "\n".join(lines)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        body=metrics.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner | None:
+    """Поднимает эндпоинт /metrics. Если порт занят, пишет предупреждение и возвращает None."""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        await runner.cleanup()
+        logger.warning("Эндпоинт метрик %s:%s не запущен: %s", host, port, e)
+        return None
+    return runner
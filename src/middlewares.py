@@ -0,0 +1,120 @@
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from src.callbacks import Action, decode
+from src.config import ADMIN_IDS, THROTTLE_RATE, THROTTLE_BURST, THROTTLE_MAX_USERS
+
+# Стоимость действий в токенах. Ключ - команда ("/start") или действие кнопки (src/callbacks.py).
+# Всё, чего нет в таблице, стоит DEFAULT_COST.
+DEFAULT_COST = 1.0
+ROUTE_COSTS = {
+    "/start": 1.0,
+    Action.BEST_PROXY: 2.0,  # выдача прокси пишет в БД
+    Action.PROXY_LIST: 1.0,
+    Action.PROXY_LIST_PREV: 1.0,
+    Action.CONNECT: 1.0,
+    Action.MAIN_MENU: 0.5,
+}
+
+
+class TokenBucketStore:
+    """
+    Token bucket на каждого пользователя в одном OrderedDict.
+    Хранит не больше max_size записей (вытесняются самые давно активные),
+    а записи, не трогавшиеся дольше ttl, удаляются - их ведро к этому
+    времени всё равно полностью наполнилось бы.
+    """
+
+    def __init__(self, rate: float, capacity: float, max_size: int = THROTTLE_MAX_USERS):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_size = max_size
+        self.ttl = capacity / rate
+        self._buckets: OrderedDict[int, list] = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    async def acquire(self, key: int, cost: float) -> bool:
+        """Общий интерфейс с хранилищами ведер в src/storage.py."""
+        return self.consume(key, cost)
+
+    async def close(self):
+        pass
+
+    def consume(self, key: int, cost: float, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.capacity, now]
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        allowed = bucket[0] >= cost
+        if allowed:
+            bucket[0] -= cost
+
+        self._evict(now)
+        return allowed
+
+    def _evict(self, now: float):
+        buckets = self._buckets
+        while len(buckets) > self.max_size:
+            buckets.popitem(last=False)
+        # Самые старые записи в начале; проверяем пару штук за вызов
+        for _ in range(2):
+            if not buckets:
+                break
+            key, (_, updated) = next(iter(buckets.items()))
+            if now - updated < self.ttl:
+                break
+            del buckets[key]
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Outer-middleware для сообщений и callback-запросов.
+    Отбрасывает апдейты пользователя, у которого кончились токены, еще до
+    фильтров и хендлеров (а значит, до любых запросов к БД). Админов не ограничивает.
+    Ведра по умолчанию в памяти процесса; общее для процессов хранилище - см. src/storage.py.
+    """
+
+    def __init__(
+        self, rate: float = THROTTLE_RATE, burst: float = THROTTLE_BURST, costs: dict = None, store=None
+    ):
+        self.store = TokenBucketStore(rate, burst) if store is None else store
+        self.costs = ROUTE_COSTS if costs is None else costs
+
+    def route_cost(self, event: TelegramObject) -> float:
+        if isinstance(event, CallbackQuery):
+            payload = decode(event.data)
+            route = payload.action if payload else None
+        elif isinstance(event, Message) and event.text and event.text.startswith("/"):
+            route = event.text.split(maxsplit=1)[0].split("@", 1)[0]
+        else:
+            return DEFAULT_COST
+
+        return self.costs.get(route, DEFAULT_COST)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or user.id in ADMIN_IDS:
+            return await handler(event, data)
+
+        if not await self.store.acquire(user.id, self.route_cost(event)):
+            if isinstance(event, CallbackQuery):
+                await event.answer("⏳ Не спешите, подождите пару секунд...", show_alert=True)
+            return None # Ignore spam
+
+        return await handler(event, data)
@@ -0,0 +1,306 @@
+import logging
+
+from src.config import PRIMARY_BOT_ID
+
+logger = logging.getLogger(__name__)
+
+# Версия схемы хранится в PRAGMA user_version.
+# Шаги применяются по порядку, каждый в своей транзакции; номер шага = индекс в MIGRATIONS + 1.
+# Базы, созданные до появления миграций, имеют версию 0: шаги написаны так,
+# чтобы спокойно проходить по уже существующим таблицам и столбцам.
+
+
+async def _has_column(db, table: str, column: str) -> bool:
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        return any(row[1] == column for row in await cursor.fetchall())
+
+
+async def _add_column(db, table: str, column: str, definition: str):
+    if not await _has_column(db, table, column):
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+async def m001_base_schema(db):
+    # Таблица пользователей
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Таблица прокси
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS proxies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            location TEXT,
+            server TEXT,
+            port INTEGER,
+            secret TEXT,
+            usage_count INTEGER DEFAULT 0,
+            unique_identifier TEXT UNIQUE,
+            is_active BOOLEAN DEFAULT 1
+        )
+    """)
+    # Самые старые базы были без is_active
+    await _add_column(db, "proxies", "is_active", "BOOLEAN DEFAULT 1")
+
+    # Таблица связей (кто какой прокси взял)
+    # Хранит историю, чтобы не накручивать счетчик одним юзером
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_proxy_relations (
+            user_id INTEGER,
+            proxy_id INTEGER,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, proxy_id)
+        )
+    """)
+
+
+async def m002_broadcasts(db):
+    # Очередь рассылок. last_user_id - контрольная точка для продолжения после рестарта
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            status TEXT DEFAULT 'pending',
+            last_user_id INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            report_chat_id INTEGER,
+            report_message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """)
+
+
+async def m003_proxy_health(db):
+    # Результаты TCP-проверок доступности прокси (см. src/health.py)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS proxy_health (
+            proxy_id INTEGER PRIMARY KEY,
+            rtt_ms REAL,
+            success_rate REAL DEFAULT 1,
+            is_healthy BOOLEAN DEFAULT 1,
+            checked_at TIMESTAMP
+        )
+    """)
+
+
+async def m004_proxy_capacity(db):
+    await _add_column(db, "proxies", "capacity", "INTEGER DEFAULT 100")
+    await _add_column(db, "proxies", "weight", "REAL DEFAULT 1.0")
+
+
+async def m005_hot_query_indexes(db):
+    # Выдаваемые прокси по нагрузке: WHERE is_active = 1 ORDER BY usage_count
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_proxies_active_usage ON proxies (is_active, usage_count)"
+    )
+    # Связи по прокси (delete_proxy, reset_proxy_usage, подсчеты) - покрывающий индекс
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_relations_proxy ON user_proxy_relations (proxy_id, user_id)"
+    )
+    # Незавершенные рассылки: частичный индекс, совпадающий с условием get_next_broadcast
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_broadcasts_unfinished ON broadcasts (id) WHERE status != 'done'"
+    )
+    await db.execute("ANALYZE")
+
+
+async def m006_usage_rollups(db):
+    # Почасовая статистика выдач: сюда сворачиваются старые связи (см. compact_relations)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS proxy_usage_hourly (
+            proxy_id INTEGER,
+            hour INTEGER,
+            assignments INTEGER DEFAULT 0,
+            PRIMARY KEY (proxy_id, hour)
+        ) WITHOUT ROWID
+    """)
+    # Связи по времени: окно активных выдач и поиск старых строк для сворачивания
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_relations_timestamp ON user_proxy_relations (timestamp, proxy_id)"
+    )
+
+
+async def m007_stats_counters(db):
+    # Счетчики, которые дорого считать COUNT(*): поддерживаются триггерами.
+    # Итоги по прокси ведет реестр в памяти (src/registry.py)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    await db.execute("INSERT OR REPLACE INTO stats (name, value) SELECT 'users', COUNT(*) FROM users")
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_insert AFTER INSERT ON users
+        BEGIN UPDATE stats SET value = value + 1 WHERE name = 'users'; END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_delete AFTER DELETE ON users
+        BEGIN UPDATE stats SET value = value - 1 WHERE name = 'users'; END
+    """)
+
+
+async def m008_user_liveness(db):
+    # Пользователь заблокировал бота или удалил аккаунт: рассылки его пропускают,
+    # пока он снова не нажмет /start. inactive_reason - класс ошибки отправки (forbidden, chat_not_found)
+    await _add_column(db, "users", "is_active", "INTEGER NOT NULL DEFAULT 1")
+    await _add_column(db, "users", "inactive_since", "TIMESTAMP")
+    await _add_column(db, "users", "inactive_reason", "TEXT")
+    # Обход активных пользователей по user_id (рассылки): частичный индекс без неактивных
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users (user_id) WHERE is_active = 1")
+    await db.execute(
+        "INSERT OR REPLACE INTO stats (name, value) SELECT 'inactive_users', COUNT(*) FROM users WHERE is_active = 0"
+    )
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_inactive_update AFTER UPDATE OF is_active ON users
+        WHEN OLD.is_active != NEW.is_active
+        BEGIN UPDATE stats SET value = value + OLD.is_active - NEW.is_active WHERE name = 'inactive_users'; END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_inactive_delete AFTER DELETE ON users
+        WHEN OLD.is_active = 0
+        BEGIN UPDATE stats SET value = value - 1 WHERE name = 'inactive_users'; END
+    """)
+
+
+async def m009_bot_users(db):
+    # Несколько ботов в одной базе: пользователь хранится отдельно для каждого бота
+    # (свои дата регистрации и блокировка), существующие записи относятся к основному боту.
+    # Связи с прокси общие: балансировщик видит нагрузку от всех ботов
+    for trigger in (
+        "trg_users_count_insert", "trg_users_count_delete",
+        "trg_users_inactive_update", "trg_users_inactive_delete",
+    ):
+        await db.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    await db.execute("DROP INDEX IF EXISTS idx_users_active")
+    await db.execute("ALTER TABLE users RENAME TO users_old")
+    await db.execute("""
+        CREATE TABLE users (
+            bot_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active INTEGER NOT NULL DEFAULT 1,
+            inactive_since TIMESTAMP,
+            inactive_reason TEXT,
+            PRIMARY KEY (bot_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("""
+        INSERT INTO users (bot_id, user_id, username, joined_at, is_active, inactive_since, inactive_reason)
+        SELECT ?, user_id, username, joined_at, is_active, inactive_since, inactive_reason FROM users_old
+    """, (PRIMARY_BOT_ID,))
+    await db.execute("DROP TABLE users_old")
+    await db.execute("CREATE INDEX idx_users_active ON users (bot_id, user_id) WHERE is_active = 1")
+
+    # Счетчики по ботам: users:<bot_id> и inactive_users:<bot_id>
+    await db.execute("DELETE FROM stats WHERE name IN ('users', 'inactive_users')")
+    await db.execute("""
+        INSERT INTO stats (name, value)
+        SELECT 'users:' || bot_id, COUNT(*) FROM users GROUP BY bot_id
+        UNION ALL
+        SELECT 'inactive_users:' || bot_id, SUM(is_active = 0) FROM users GROUP BY bot_id
+    """)
+    await db.execute("""
+        CREATE TRIGGER trg_users_count_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO stats (name, value) VALUES ('users:' || NEW.bot_id, 1)
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER trg_users_count_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE stats SET value = value - 1 WHERE name = 'users:' || OLD.bot_id;
+            UPDATE stats SET value = value - 1 WHERE name = 'inactive_users:' || OLD.bot_id AND OLD.is_active = 0;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER trg_users_inactive_update AFTER UPDATE OF is_active ON users
+        WHEN OLD.is_active != NEW.is_active
+        BEGIN
+            INSERT INTO stats (name, value) VALUES ('inactive_users:' || NEW.bot_id, OLD.is_active - NEW.is_active)
+            ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+        END
+    """)
+
+    # Рассылка выполняется от имени одного бота
+    await _add_column(db, "broadcasts", "bot_id", "INTEGER")
+    await db.execute("UPDATE broadcasts SET bot_id = ? WHERE bot_id IS NULL", (PRIMARY_BOT_ID,))
+
+
+async def m010_proxies_version(db):
+    # Версия списка прокси: растет при любом изменении, кроме роста usage_count при выдаче.
+    # Воркеры сравнивают ее со своей и перечитывают реестр (src/sync.py)
+    await db.execute("INSERT OR IGNORE INTO stats (name, value) VALUES ('proxies_version', 0)")
+    bump = "BEGIN UPDATE stats SET value = value + 1 WHERE name = 'proxies_version'; END"
+    await db.execute(f"CREATE TRIGGER trg_proxies_version_insert AFTER INSERT ON proxies {bump}")
+    await db.execute(f"CREATE TRIGGER trg_proxies_version_delete AFTER DELETE ON proxies {bump}")
+    await db.execute(f"""
+        CREATE TRIGGER trg_proxies_version_update
+        AFTER UPDATE OF location, server, port, secret, is_active, capacity, weight ON proxies {bump}
+    """)
+    # Сброс статистики (обычная выдача счетчик только увеличивает)
+    await db.execute(f"""
+        CREATE TRIGGER trg_proxies_version_reset AFTER UPDATE OF usage_count ON proxies
+        WHEN NEW.usage_count < OLD.usage_count {bump}
+    """)
+
+
+MIGRATIONS = [
+    m001_base_schema,
+    m002_broadcasts,
+    m003_proxy_health,
+    m004_proxy_capacity,
+    m005_hot_query_indexes,
+    m006_usage_rollups,
+    m007_stats_counters,
+    m008_user_liveness,
+    m009_bot_users,
+    m010_proxies_version,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def get_schema_version(db) -> int:
+    async with db.execute("PRAGMA user_version") as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def migrate(db) -> int:
+    """
+    Применяет недостающие миграции. Возвращает, сколько шагов выполнил этот вызов.
+
+    Каждый шаг - отдельная транзакция BEGIN IMMEDIATE, и версия перечитывается уже внутри нее:
+    несколько процессов (WEB_WORKERS), стартующих на одной базе, ждут друг друга
+    (busy_timeout), а не выполняют один и тот же шаг дважды.
+    """
+    done = 0
+    while True:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            version = await get_schema_version(db)
+            if version > SCHEMA_VERSION:
+                raise RuntimeError(
+                    f"Версия схемы БД ({version}) новее, чем знает бот ({SCHEMA_VERSION}). Обновите бота."
+                )
+            if version == SCHEMA_VERSION:
+                await db.rollback()
+                return done
+
+            step = MIGRATIONS[version]
+            logger.info("Миграция БД %s: %s", version + 1, step.__name__)
+            await step(db)
+            await db.execute(f"PRAGMA user_version = {version + 1}")
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        done += 1
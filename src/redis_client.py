@@ -0,0 +1,115 @@
+import asyncio
+import urllib.parse
+
+
+class RedisError(Exception):
+    """Ошибка, которую вернул сервер (ответ "-ERR ...")."""
+
+
+def encode_command(*args) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        elif isinstance(arg, float):
+            data = repr(arg).encode()
+        else:
+            data = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    """Один ответ в формате RESP2. Ошибка сервера возвращается как RedisError, а не выбрасывается."""
+    line = await reader.readuntil(b"\r\n")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body.decode()
+    if kind == b"-":
+        return RedisError(body.decode())
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        length = int(body)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        length = int(body)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"Неожиданный ответ сервера: {line!r}")
+
+
+class RedisClient:
+    """
+    Минимальный клиент протокола Redis (RESP2) на asyncio, без внешних зависимостей.
+    Держит до max_connections соединений; команда или пачка команд (pipeline)
+    занимает одно соединение на время запроса. Понимает адреса вида
+    redis://[:password@]host[:port][/db].
+    """
+
+    def __init__(self, url: str, max_connections: int = 4, timeout: float = 5.0):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = urllib.parse.unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def _connect(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            writer.write(b"".join(encode_command(*command) for command in setup))
+            for _ in setup:
+                reply = await read_reply(reader)
+                if isinstance(reply, RedisError):
+                    writer.close()
+                    raise reply
+        return reader, writer
+
+    @staticmethod
+    async def _read_replies(reader: asyncio.StreamReader, count: int) -> list:
+        return [await read_reply(reader) for _ in range(count)]
+
+    async def pipeline(self, commands) -> list:
+        """Отправляет команды одной пачкой и возвращает ответы в том же порядке."""
+        commands = list(commands)
+        async with self._slots:
+            conn = self._idle.pop() if self._idle else await self._connect()
+            reader, writer = conn
+            try:
+                writer.write(b"".join(encode_command(*command) for command in commands))
+                await writer.drain()
+                replies = await asyncio.wait_for(self._read_replies(reader, len(commands)), self.timeout)
+            except BaseException:
+                # Соединение в неизвестном состоянии - закрываем, следующее откроется заново
+                writer.close()
+                raise
+            self._idle.append(conn)
+
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    async def execute(self, *args):
+        return (await self.pipeline([args]))[0]
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
@@ -0,0 +1,266 @@
+import bisect
+import heapq
+
+from src.config import BALANCE_LOAD
+
+# Поле прокси, по которому считается нагрузка (BALANCE_LOAD)
+LOAD_FIELDS = {
+    "lifetime": "usage_count",
+    "window": "active_users",
+}
+
+
+def get_load_field(name: str = BALANCE_LOAD) -> str:
+    try:
+        return LOAD_FIELDS[name]
+    except KeyError:
+        raise ValueError(
+            f"Неизвестная мера нагрузки '{name}'. Доступны: {', '.join(LOAD_FIELDS)}"
+        ) from None
+
+
+class ProxyRegistry:
+    """
+    Копия таблицы proxies в памяти процесса.
+    Активные и доступные (is_healthy) прокси дополнительно лежат в куче по (нагрузка, id),
+    поэтому наименее нагруженный прокси выбирается за O(log n) без запроса к БД.
+
+    Устаревшие записи кучи не удаляются сразу: у каждой записи есть отметка,
+    и при выборке записи со старой отметкой просто выбрасываются.
+    Все методы синхронные, поэтому между ними не может вклиниться другая корутина.
+
+    Нагрузка - поле load_field: usage_count (выдачи за всё время) или active_users
+    (выдачи за скользящее окно, см. src/activity.py).
+
+    version увеличивается при любом изменении прокси, кроме счетчиков usage_count и active_users
+    (они меняются на каждой выдаче), и служит ключом кэша отрисовки (src/render.py).
+
+    Итоги для админки (всего, включенных, доступных прокси и сумма usage_count)
+    ведутся при каждом изменении и читаются за O(1) через counts().
+    """
+
+    def __init__(self, load_field: str = "usage_count"):
+        self.load_field = load_field
+        self._proxies: dict[int, dict] = {}
+        self._heap: list[tuple[int, int, int]] = []
+        self._stamps: dict[int, int] = {}
+        self._next_stamp = 0
+        # Активные id в списке для выбора случайного прокси за O(1)
+        self._active: list[int] = []
+        self._active_pos: dict[int, int] = {}
+        self._enabled_count = 0
+        self._total_usage = 0
+        # Ключи (location, id) по порядку для постраничных списков; пересобираются при смене version
+        self._sorted: list[tuple[str, int]] = []
+        self._sorted_version = -1
+        self.version = 0
+
+    def __len__(self):
+        return len(self._proxies)
+
+    def load(self, rows):
+        """Полностью заменяет содержимое реестра строками из БД."""
+        self._proxies = {row["id"]: {"active_users": 0, **row} for row in rows}
+        self._heap = []
+        self._stamps = {}
+        self._active = []
+        self._active_pos = {}
+        self._enabled_count = 0
+        self._total_usage = 0
+        for proxy_id, proxy in self._proxies.items():
+            self._account(proxy, 1)
+            self._reindex(proxy_id)
+        self.version += 1
+
+    def _account(self, proxy, sign: int):
+        """Добавляет (sign=1) или убирает (sign=-1) прокси из итогов."""
+        if proxy["is_active"]:
+            self._enabled_count += sign
+        self._total_usage += sign * proxy["usage_count"]
+
+    def counts(self) -> dict:
+        return {
+            "proxies": len(self._proxies),
+            "enabled": self._enabled_count,
+            "available": len(self._active),
+            "assignments": self._total_usage,
+        }
+
+    @staticmethod
+    def _is_eligible(proxy) -> bool:
+        # Прокси выдается, если он включен админом и не исключен проверкой доступности
+        return bool(proxy["is_active"]) and bool(proxy.get("is_healthy", 1))
+
+    def _reindex(self, proxy_id: int):
+        proxy = self._proxies.get(proxy_id)
+        if proxy is None or not self._is_eligible(proxy):
+            # Запись в куче (если была) станет устаревшей
+            self._stamps.pop(proxy_id, None)
+            self._discard_active(proxy_id)
+            return
+
+        if proxy_id not in self._active_pos:
+            self._active_pos[proxy_id] = len(self._active)
+            self._active.append(proxy_id)
+
+        self._next_stamp += 1
+        self._stamps[proxy_id] = self._next_stamp
+        heapq.heappush(self._heap, (proxy[self.load_field], proxy_id, self._next_stamp))
+
+        # Не даем куче разрастаться из-за устаревших записей
+        if len(self._heap) > 2 * len(self._stamps) + 64:
+            self._heap = [entry for entry in self._heap if self._stamps.get(entry[1]) == entry[2]]
+            heapq.heapify(self._heap)
+
+    def _discard_active(self, proxy_id: int):
+        pos = self._active_pos.pop(proxy_id, None)
+        if pos is None:
+            return
+        last = self._active.pop()
+        if last != proxy_id:
+            self._active[pos] = last
+            self._active_pos[last] = pos
+
+    def get(self, proxy_id: int):
+        proxy = self._proxies.get(proxy_id)
+        return dict(proxy) if proxy else None
+
+    def all(self, only_active=True):
+        proxies = [
+            dict(p) for p in self._proxies.values()
+            if p["is_active"] or not only_active
+        ]
+        proxies.sort(key=lambda p: (p["location"] or "", p["id"]))
+        return proxies
+
+    @staticmethod
+    def sort_key(proxy) -> tuple[str, int]:
+        return proxy["location"] or "", proxy["id"]
+
+    def _sorted_keys(self) -> list[tuple[str, int]]:
+        if self._sorted_version != self.version:
+            self._sorted = sorted(self.sort_key(p) for p in self._proxies.values())
+            self._sorted_version = self.version
+        return self._sorted
+
+    def page(self, cursor: int = 0, backwards: bool = False, limit: int = 10, match=None):
+        """
+        Страница прокси в порядке (location, id) - keyset-пагинация по отсортированным ключам:
+        после прокси cursor или, если backwards, перед ним (cursor=0 - с начала).
+        match(proxy) -> bool отбирает прокси (фильтры, поиск).
+        Возвращает (прокси, есть_раньше, есть_дальше).
+        """
+        keys = self._sorted_keys()
+        anchor = self._proxies.get(cursor) if cursor else None
+        if anchor is None:
+            start, backwards = 0, False
+        elif backwards:
+            start = bisect.bisect_left(keys, self.sort_key(anchor))
+        else:
+            start = bisect.bisect_right(keys, self.sort_key(anchor))
+
+        def matching(indexes):
+            for i in indexes:
+                proxy = self._proxies[keys[i][1]]
+                if match is None or match(proxy):
+                    yield proxy
+
+        if backwards:
+            found = []
+            for proxy in matching(range(start - 1, -1, -1)):
+                found.append(proxy)
+                if len(found) > limit:
+                    break
+            has_before = len(found) > limit
+            items = found[:limit][::-1]
+            has_after = next(matching(range(start, len(keys))), None) is not None
+        else:
+            found = []
+            for proxy in matching(range(start, len(keys))):
+                found.append(proxy)
+                if len(found) > limit:
+                    break
+            has_after = len(found) > limit
+            items = found[:limit]
+            has_before = start > 0 and next(matching(range(start - 1, -1, -1)), None) is not None
+
+        return [dict(p) for p in items], has_before, has_after
+
+    def active_ids(self) -> list[int]:
+        """Id выдаваемых прокси (в произвольном порядке). Не изменяйте список."""
+        return self._active
+
+    def iter_active(self):
+        """Выдаваемые прокси без копирования - только для чтения."""
+        proxies = self._proxies
+        return (proxies[proxy_id] for proxy_id in self._active)
+
+    def is_available(self, proxy_id: int) -> bool:
+        """Прокси есть в реестре и сейчас выдается (включен и доступен)."""
+        return proxy_id in self._active_pos
+
+    def is_overloaded(self, proxy: dict, max_load: float) -> bool:
+        """Нагрузка прокси достигла max_load * capacity."""
+        return proxy[self.load_field] >= max_load * max(proxy.get("capacity") or 1, 1)
+
+    def usage(self, proxy_id: int) -> int:
+        """Нагрузка прокси (значение load_field)."""
+        return self._proxies[proxy_id][self.load_field]
+
+    def least_loaded(self):
+        """Выдаваемый прокси с наименьшей нагрузкой или None."""
+        heap = self._heap
+        while heap:
+            _, proxy_id, stamp = heap[0]
+            if self._stamps.get(proxy_id) == stamp:
+                return dict(self._proxies[proxy_id])
+            heapq.heappop(heap)
+        return None
+
+    def upsert(self, proxy: dict):
+        old = self._proxies.get(proxy["id"])
+        if old is not None:
+            self._account(old, -1)
+        proxy = self._proxies[proxy["id"]] = {"active_users": 0, **proxy}
+        self._account(proxy, 1)
+        self._reindex(proxy["id"])
+        self.version += 1
+
+    def update(self, proxy_id: int, **fields):
+        proxy = self._proxies.get(proxy_id)
+        if proxy is None:
+            return
+        self._account(proxy, -1)
+        proxy.update(fields)
+        self._account(proxy, 1)
+        self._reindex(proxy_id)
+        self.version += 1
+
+    def add_usage(self, proxy_id: int, delta: int = 1):
+        proxy = self._proxies.get(proxy_id)
+        if proxy is None:
+            return
+        proxy["usage_count"] += delta
+        proxy["active_users"] += delta
+        self._total_usage += delta
+        self._reindex(proxy_id)
+
+    def set_active_users(self, totals: dict):
+        """Обновляет active_users всех прокси по итогам окна (отсутствующие в totals - 0)."""
+        for proxy_id, proxy in self._proxies.items():
+            value = totals.get(proxy_id, 0)
+            if proxy["active_users"] != value:
+                proxy["active_users"] = value
+                if self.load_field == "active_users":
+                    self._reindex(proxy_id)
+
+    def remove(self, proxy_id: int):
+        proxy = self._proxies.pop(proxy_id, None)
+        if proxy is not None:
+            self._account(proxy, -1)
+        self._stamps.pop(proxy_id, None)
+        self._discard_active(proxy_id)
+        self.version += 1
+
+
+registry = ProxyRegistry(get_load_field())
@@ -0,0 +1,193 @@
+import html
+import time
+from functools import lru_cache
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from src.callbacks import Action, cb
+from src.config import RENDER_CACHE_TTL, get_proxy_link
+from src.registry import registry
+
+
+class RenderCache:
+    """
+    Кэш готовых текстов и клавиатур.
+    Запись действительна, пока не изменилась версия реестра прокси и не истек ttl.
+    ttl нужен только для счетчиков использований: они не меняют версию реестра.
+    """
+
+    def __init__(self, ttl: float = RENDER_CACHE_TTL, max_size: int = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: dict = {}
+
+    def get(self, key, build):
+        version = registry.version
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version and entry[1] > now:
+            return entry[2]
+
+        value = build()
+        if len(self._entries) >= self.max_size:
+            self._entries.clear()
+        self._entries[key] = (version, now + self.ttl, value)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+
+cache = RenderCache()
+
+
+@lru_cache(maxsize=None)
+def main_menu_markup(is_admin: bool) -> InlineKeyboardMarkup:
+    """Клавиатура главного меню не зависит от данных - собирается один раз."""
+    kb = InlineKeyboardBuilder()
+    kb.button(text="🚀 Получить лучший прокси", callback_data=cb(Action.BEST_PROXY))
+    kb.button(text="📋 Показать все прокси", callback_data=cb(Action.PROXY_LIST))
+
+    if is_admin:
+        kb.button(text="⚙️ Админ панель", callback_data=cb(Action.ADMIN_PANEL))
+
+    kb.adjust(1)
+    return kb.as_markup()
+
+
+def warm_up():
+    """Заранее собирает главное меню и список прокси, чтобы первые ответы не ждали отрисовки."""
+    main_menu_markup(False)
+    main_menu_markup(True)
+    proxy_list_view()
+
+
+# Сколько прокси на одной странице списка
+PAGE_SIZE = 10
+
+# Фильтры админского списка по статусу: код в callback_data -> (подпись, условие)
+STATUS_FILTERS = {
+    0: ("Все", None),
+    1: ("✅ Вкл", lambda p: bool(p["is_active"])),
+    2: ("❌ Выкл", lambda p: not p["is_active"]),
+}
+
+
+def _nav_buttons(proxies, has_before: bool, has_after: bool, forward: Action, backward: Action):
+    buttons = []
+    if has_before:
+        buttons.append(InlineKeyboardButton(text="◀️", callback_data=cb(backward, proxies[0]["id"])))
+    if has_after:
+        buttons.append(InlineKeyboardButton(text="▶️", callback_data=cb(forward, proxies[-1]["id"])))
+    return buttons
+
+
+def proxy_list_view(cursor: int = 0, backwards: bool = False):
+    """
+    (text, markup) страницы списка активных прокси или None, если список пуст.
+    Страница начинается после прокси cursor (или заканчивается перед ним, если backwards).
+    """
+    return cache.get(("proxy_list", cursor, backwards), lambda: _build_proxy_list(cursor, backwards))
+
+
+def _build_proxy_list(cursor: int, backwards: bool):
+    proxies, has_before, has_after = registry.page(
+        cursor, backwards, PAGE_SIZE, match=lambda p: bool(p["is_active"])
+    )
+    if not proxies:
+        # Курсор мог указывать на конец списка, который с тех пор сократился
+        return _build_proxy_list(0, False) if cursor else None
+
+    lines = ["<b>📋 Все доступные прокси:</b>\n\n"]
+    kb = InlineKeyboardBuilder()
+
+    for p in proxies:
+        lines.append(
+            f"🌍 <b>{html.escape(p['location'] or '')}</b>\n"
+            f"📊 Использований: {p['usage_count']}\n\n"
+        )
+        # Кнопка ведет не на URL, а вызывает callback
+        kb.row(InlineKeyboardButton(text=f"Connect {p['location']}", callback_data=cb(Action.CONNECT, p['id'])))
+
+    nav = _nav_buttons(proxies, has_before, has_after, Action.PROXY_LIST, Action.PROXY_LIST_PREV)
+    if nav:
+        kb.row(*nav)
+    kb.row(InlineKeyboardButton(text="🔙 Назад", callback_data=cb(Action.MAIN_MENU)))
+    return "".join(lines), kb.as_markup()
+
+
+def admin_proxy_list_view(cursor: int = 0, backwards: bool = False, status: int = 0, search: str = ""):
+    """(text, markup) страницы админского списка прокси с фильтром по статусу и поиском."""
+    key = ("admin_proxy_list", cursor, backwards, status, search)
+    return cache.get(key, lambda: _build_admin_proxy_list(cursor, backwards, status, search))
+
+
+def _build_admin_proxy_list(cursor: int, backwards: bool, status: int, search: str):
+    back = InlineKeyboardButton(text="🔙 Назад", callback_data=cb(Action.ADMIN_PANEL))
+    if not len(registry):
+        return "Прокси нет.", InlineKeyboardMarkup(inline_keyboard=[[back]])
+
+    status_label, status_match = STATUS_FILTERS.get(status, STATUS_FILTERS[0])
+    needle = search.lower()
+
+    def match(p):
+        if status_match and not status_match(p):
+            return False
+        return not needle or needle in (p["location"] or "").lower() or needle in p["server"].lower()
+
+    proxies, has_before, has_after = registry.page(cursor, backwards, PAGE_SIZE, match=match)
+    if not proxies and cursor:
+        return _build_admin_proxy_list(0, False, status, search)
+
+    lines = ["Выберите прокси для управления:" if proxies else "Ничего не найдено."]
+    if status:
+        lines.append(f"Статус: {status_label}")
+    if search:
+        lines.append(f"🔍 Поиск: «{html.escape(search)}»")
+
+    kb = InlineKeyboardBuilder()
+    for p in proxies:
+        status_icon = "✅" if p['is_active'] else "❌"
+        # Кнопка ведет в меню управления конкретным прокси
+        label = f"{status_icon} {p['location']} | 👥 {p['usage_count']}"
+        kb.row(InlineKeyboardButton(text=label, callback_data=cb(Action.MANAGE, p['id'])))
+
+    nav = _nav_buttons(proxies, has_before, has_after, Action.MANAGE_LIST, Action.MANAGE_LIST_PREV)
+    if nav:
+        kb.row(*nav)
+    kb.row(*(
+        InlineKeyboardButton(
+            text=f"• {label}" if code == status else label,
+            callback_data=cb(Action.MANAGE_FILTER, code),
+        )
+        for code, (label, _) in STATUS_FILTERS.items()
+    ))
+    search_row = [InlineKeyboardButton(text="🔍 Поиск", callback_data=cb(Action.MANAGE_SEARCH))]
+    if search:
+        search_row.append(InlineKeyboardButton(text="✖️ Сбросить поиск", callback_data=cb(Action.MANAGE_SEARCH_RESET)))
+    kb.row(*search_row)
+    kb.row(back)
+    return "\n".join(lines), kb.as_markup()
+
+
+def proxy_connect_view(proxy_id: int):
+    """(text, markup) со ссылкой на конкретный прокси или None, если он недоступен."""
+    return cache.get(("proxy_connect", proxy_id), lambda: _build_proxy_connect(proxy_id))
+
+
+def _build_proxy_connect(proxy_id: int):
+    proxy = registry.get(proxy_id)
+    if not proxy or not proxy['is_active']:
+        return None
+
+    link = get_proxy_link(proxy['server'], proxy['port'], proxy['secret'])
+    text = (
+        f"<b>🌍 Выбран прокси: {html.escape(proxy['location'] or '')}</b>\n"
+        f"Вот ваша ссылка для подключения 👇"
+    )
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔗 Подключиться", url=link)],
+        [InlineKeyboardButton(text="🔙 К списку", callback_data=cb(Action.PROXY_LIST))]
+    ])
+    return text, kb
@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import CallbackQuery, Message
+
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+metrics.describe("bot_message_edits_total", "Редактирования сообщений по результату (unchanged - запрос не отправлялся)")
+
+# Сколько последних отредактированных сообщений помнить
+FINGERPRINT_CACHE_SIZE = 50000
+
+
+def is_not_modified(error: TelegramBadRequest) -> bool:
+    return "message is not modified" in error.message
+
+
+def fingerprint(text: str, parse_mode=None, reply_markup=None, disable_web_page_preview=None) -> bytes:
+    """Отпечаток того, что бот показывает в сообщении: текст, разметка и клавиатура."""
+    markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup is not None else ""
+    source = f"{parse_mode}\0{disable_web_page_preview}\0{markup}\0{text}"
+    return hashlib.blake2b(source.encode(), digest_size=16).digest()
+
+
+class MessageFingerprints:
+    """
+    Отпечатки последнего содержимого сообщений бота: (бот, чат, сообщение) -> отпечаток.
+    Хранит не больше max_size записей, вытесняются самые давно редактированные.
+    Сообщение, которого нет в кэше (после рестарта или вытеснения), просто редактируется.
+    """
+
+    def __init__(self, max_size: int = FINGERPRINT_CACHE_SIZE):
+        self.max_size = max_size
+        self._fingerprints: OrderedDict[tuple, bytes] = OrderedDict()
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def matches(self, key: tuple, value: bytes) -> bool:
+        if self._fingerprints.get(key) != value:
+            return False
+        self._fingerprints.move_to_end(key)
+        return True
+
+    def put(self, key: tuple, value: bytes):
+        self._fingerprints[key] = value
+        self._fingerprints.move_to_end(key)
+        while len(self._fingerprints) > self.max_size:
+            self._fingerprints.popitem(last=False)
+
+    def forget(self, key: tuple):
+        self._fingerprints.pop(key, None)
+
+
+def skip_unchanged() -> bool:
+    """
+    Можно ли верить отпечаткам этого процесса. С несколькими воркерами сообщение мог
+    отредактировать другой процесс, и тогда редактируем всегда.
+    """
+    # Настройки читаются при вызове, а не при импорте модуля: src.bench импортирует
+    # src.callbacks до того, как подготовит окружение для src.config
+    from src.config import MULTI_WORKER
+    return not MULTI_WORKER
+
+
+fingerprints = MessageFingerprints()
+# id callback-запросов, на которые уже ответили в текущей обработке (см. CallbackRouter.dispatch)
+_answered: set[str] = set()
+
+
+async def answer(callback: CallbackQuery, text: str = None, show_alert: bool = False):
+    """Ответ на callback-запрос (убирает часики на кнопке). Повторный вызов ничего не делает."""
+    if callback.id in _answered:
+        return
+    _answered.add(callback.id)
+    await callback.answer(text, show_alert=show_alert)
+
+
+async def finish(callback: CallbackQuery):
+    """Отвечает на callback, если хендлер этого не сделал, и забывает его id."""
+    try:
+        if callback.id not in _answered:
+            await callback.answer()
+    except TelegramBadRequest as e:
+        # Запрос устарел (хендлер работал дольше, чем Telegram ждет ответа)
+        logger.debug("Не удалось ответить на callback %s: %s", callback.id, e)
+    finally:
+        _answered.discard(callback.id)
+
+
+async def edit_text(
+    target: CallbackQuery | Message,
+    text: str,
+    parse_mode=None,
+    reply_markup=None,
+    disable_web_page_preview=None,
+):
+    """
+    Редактирует сообщение, если его содержимое действительно меняется.
+    Для callback-запроса ответ на него уходит параллельно с редактированием,
+    а если редактировать нечего - только ответ. Если skip_unchanged() ложно,
+    запрос уходит всегда, а "message is not modified" считается успехом.
+    """
+    callback = target if isinstance(target, CallbackQuery) else None
+    message = callback.message if callback else target
+    key = (message.bot.id, message.chat.id, message.message_id)
+    value = fingerprint(text, parse_mode, reply_markup, disable_web_page_preview)
+
+    skip = skip_unchanged()
+    if skip and fingerprints.matches(key, value):
+        metrics.inc("bot_message_edits_total", result="unchanged")
+        if callback:
+            await answer(callback)
+        return
+
+    async def edit():
+        try:
+            await message.edit_text(
+                text, parse_mode=parse_mode, reply_markup=reply_markup,
+                disable_web_page_preview=disable_web_page_preview,
+            )
+            result = "edited"
+        except TelegramBadRequest as e:
+            if not is_not_modified(e):
+                fingerprints.forget(key)
+                raise
+            result = "not_modified"
+        if skip:
+            fingerprints.put(key, value)
+        metrics.inc("bot_message_edits_total", result=result)
+
+    if callback and callback.id not in _answered:
+        await asyncio.gather(edit(), answer(callback))
+    else:
+        await edit()
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+
+from src import database as db
+from src.config import RELATION_RETENTION_DAYS, RETENTION_INTERVAL, RETENTION_BATCH
+
+logger = logging.getLogger(__name__)
+
+# Пауза между пачками, чтобы выдача прокси успевала получить соединение на запись
+BATCH_PAUSE = 0.05
+
+
+class RetentionJob:
+    """
+    Фоновое обслуживание статистики выдач раз в interval секунд:
+    сдвигает окно активных выдач (active_users) и, если compact=True, сворачивает
+    связи старше retention_days дней в почасовую статистику небольшими транзакциями.
+    """
+
+    def __init__(
+        self,
+        interval: float = RETENTION_INTERVAL,
+        retention_days: int = RELATION_RETENTION_DAYS,
+        batch_size: int = RETENTION_BATCH,
+        compact: bool = True,
+    ):
+        self.interval = interval
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.compact = compact
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка обслуживания статистики выдач")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> int:
+        """Один проход. Возвращает число свернутых связей."""
+        db.expire_activity()
+        if not self.compact or self.retention_days <= 0:
+            return 0
+
+        total = 0
+        while True:
+            moved = await db.compact_relations(self.retention_days, self.batch_size)
+            total += moved
+            if moved < self.batch_size:
+                break
+            await asyncio.sleep(BATCH_PAUSE)
+
+        if total:
+            logger.info("Свернуто связей старше %s дн.: %s", self.retention_days, total)
+        return total
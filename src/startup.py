@@ -0,0 +1,55 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram.types import TelegramObject
+
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+metrics.describe("bot_startup_seconds", "Длительность фаз запуска бота")
+
+
+class StartupTimer:
+    """
+    Замеры фаз запуска: каждая фаза пишется в лог и в метрику bot_startup_seconds.
+    Время до первого ответа (от создания таймера до первого обработанного апдейта)
+    логируется один раз через first_response_middleware.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self.first_response: float | None = None
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.phases[name] = elapsed
+            metrics.observe("bot_startup_seconds", elapsed, phase=name)
+            logger.info("Запуск: %s за %.1f мс", name, elapsed * 1000)
+
+    def mark(self, name: str):
+        """Отметка момента (от создания таймера), например начала приема апдейтов."""
+        elapsed = time.perf_counter() - self.started
+        self.phases[name] = elapsed
+        logger.info("Запуск: %s через %.1f мс после старта", name, elapsed * 1000)
+
+    async def first_response_middleware(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        result = await handler(event, data)
+        if self.first_response is None:
+            self.first_response = time.perf_counter() - self.started
+            metrics.observe("bot_startup_seconds", self.first_response, phase="first_response")
+            logger.info("Первый ответ через %.1f мс после старта", self.first_response * 1000)
+        return result
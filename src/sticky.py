@@ -0,0 +1,46 @@
+from collections import OrderedDict
+
+from src.config import MULTI_WORKER, STICKY_CACHE_SIZE
+from src.metrics import metrics
+
+metrics.describe("bot_sticky_lookups_total", "Поиск закрепленного прокси пользователя по результату")
+
+
+class StickyAssignments:
+    """
+    Текущий прокси каждого пользователя (режим STICKY_ASSIGNMENT) в одном OrderedDict.
+    Хранит не больше max_size записей, вытесняются самые давно обращавшиеся;
+    вытесненный пользователь при следующем запросе подгружается из user_proxy_relations.
+    """
+
+    def __init__(self, max_size: int = STICKY_CACHE_SIZE):
+        self.max_size = max_size
+        self._assignments: OrderedDict[int, int] = OrderedDict()
+
+    def __len__(self):
+        return len(self._assignments)
+
+    def get(self, user_id: int):
+        proxy_id = self._assignments.get(user_id)
+        if proxy_id is not None:
+            self._assignments.move_to_end(user_id)
+        return proxy_id
+
+    def put(self, user_id: int, proxy_id: int):
+        self._assignments[user_id] = proxy_id
+        self._assignments.move_to_end(user_id)
+        while len(self._assignments) > self.max_size:
+            self._assignments.popitem(last=False)
+
+    def discard(self, user_id: int):
+        self._assignments.pop(user_id, None)
+
+    def discard_proxy(self, proxy_id: int):
+        """Забывает всех пользователей прокси (удаление, сброс статистики). Полный проход - только для админки."""
+        for user_id in [u for u, p in self._assignments.items() if p == proxy_id]:
+            del self._assignments[user_id]
+
+
+# У каждого воркера WEB_WORKERS был бы свой кэш, и закрепления процессов разошлись бы:
+# при MULTI_WORKER кэш пуст, и прокси пользователя всегда ищется в буфере записи и БД
+sticky = StickyAssignments(0 if MULTI_WORKER else STICKY_CACHE_SIZE)
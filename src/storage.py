@@ -0,0 +1,377 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from src.config import (
+    FSM_STORAGE, THROTTLE_STORAGE, STORAGE_PATH, REDIS_URL, FSM_TTL, MULTI_WORKER,
+    STORAGE_FLUSH_INTERVAL, STORAGE_CLEANUP_INTERVAL, THROTTLE_RATE, THROTTLE_BURST,
+)
+from src.database import ConnectionPool
+from src.middlewares import TokenBucketStore
+from src.redis_client import RedisClient
+
+logger = logging.getLogger(__name__)
+
+# Поле записи FSM, которое не менялось с последнего сброса
+_UNSET = object()
+
+
+def _state_name(state: StateType):
+    return state.state if isinstance(state, State) else state
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM aiogram в отдельном файле SQLite (WAL), общем для всех процессов на машине.
+
+    Изменения копятся в памяти и раз в flush_interval секунд пишутся одной транзакцией:
+    обработчик обычно меняет и состояние, и данные, а update_data вызывается по нескольку раз.
+    Чтения сначала смотрят несохраненные изменения, поэтому процесс видит свои записи сразу,
+    а другие процессы - после сброса.
+
+    Ключ включает id бота: у одного админа в разных ботах (BOT_TOKEN - список) свои диалоги.
+    Записи старше ttl секунд с последнего изменения считаются отсутствующими
+    и удаляются раз в cleanup_interval секунд. Здесь же лежат ведра антиспама (SQLiteTokenBuckets).
+
+    aiogram читает состояние на каждом апдейте, а диалоги есть только у админов. Если файлом
+    пользуется один процесс (shared=False), хранилище помнит ключи, у которых есть запись,
+    и для остальных отвечает "нет состояния" без запроса к БД.
+    """
+
+    def __init__(
+        self,
+        path: str = STORAGE_PATH,
+        ttl: int = FSM_TTL,
+        flush_interval: float = STORAGE_FLUSH_INTERVAL,
+        cleanup_interval: float = STORAGE_CLEANUP_INTERVAL,
+        key_builder: KeyBuilder = None,
+        shared: bool = MULTI_WORKER,
+    ):
+        self.pool = ConnectionPool(path, role_prefix="storage_")
+        self.shared = shared
+        # Ключи, у которых есть строка в fsm (только при shared=False)
+        self._keys: set[str] = set()
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cleanup_interval = cleanup_interval
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True)
+        # ключ -> [state, data], _UNSET - поле не менялось
+        self._pending: dict[str, list] = {}
+        # Изменения, которые сейчас записываются в БД
+        self._inflight: dict[str, list] = {}
+        self._dirty = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._stopping = False
+        self._task: asyncio.Task | None = None
+        # Через сколько секунд ведро антиспама полностью наполняется и его можно удалить
+        self.throttle_ttl = 0.0
+
+    async def open(self):
+        if self.pool.is_open:
+            return
+        async with self._open_lock:
+            if self.pool.is_open:
+                return
+            await self.pool.open()
+            async with self.pool.write() as db:
+                await db.execute("""
+                    CREATE TABLE IF NOT EXISTS fsm (
+                        key TEXT PRIMARY KEY,
+                        state TEXT,
+                        data TEXT,
+                        expires_at REAL NOT NULL
+                    ) WITHOUT ROWID
+                """)
+                await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_expires ON fsm (expires_at)")
+                await db.execute("""
+                    CREATE TABLE IF NOT EXISTS throttle (
+                        key TEXT PRIMARY KEY,
+                        tokens REAL NOT NULL,
+                        updated_at REAL NOT NULL
+                    ) WITHOUT ROWID
+                """)
+                await db.execute("CREATE INDEX IF NOT EXISTS idx_throttle_updated ON throttle (updated_at)")
+                if not self.shared:
+                    async with db.execute("SELECT key FROM fsm WHERE expires_at > ?", (time.time(),)) as cursor:
+                        self._keys = {row[0] for row in await cursor.fetchall()}
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        # Хранилище может быть общим для FSM и антиспама: повторный close ничего не делает,
+        # а обращение после close снова откроет соединения
+        if self._task is not None:
+            # Задача завершается по флагу, а не cancel() - как у WriteBuffer.stop
+            self._stopping = True
+            self._dirty.set()
+            await self._task
+            self._task = None
+            self._stopping = False
+        if self.pool.is_open:
+            await self.flush()
+            await self.pool.close()
+
+    async def _run(self):
+        next_cleanup = time.monotonic() + self.cleanup_interval
+        # Флаг проверяется перед каждым ожиданием: close() мог выставить _dirty,
+        # пока задача спала flush_interval, и clear() ниже его уже снял
+        while not self._stopping:
+            try:
+                async with asyncio.timeout(max(0.0, next_cleanup - time.monotonic())):
+                    await self._dirty.wait()
+            except TimeoutError:
+                pass
+            if self._stopping:
+                return
+            if self._dirty.is_set():
+                # Даем обработчику дописать остальные изменения, чтобы сбросить их вместе
+                await asyncio.sleep(self.flush_interval)
+            self._dirty.clear()
+            try:
+                await self.flush()
+                if time.monotonic() >= next_cleanup:
+                    next_cleanup = time.monotonic() + self.cleanup_interval
+                    await self.cleanup()
+            except Exception:
+                logger.exception("Не удалось записать хранилище FSM, повторим позже")
+
+    def _stage(self, key: StorageKey, index: int, value):
+        entry = self._pending.setdefault(self.key_builder.build(key), [_UNSET, _UNSET])
+        entry[index] = value
+        self._dirty.set()
+
+    async def _current(self, key: StorageKey, index: int):
+        name = self.key_builder.build(key)
+        for changes in (self._pending, self._inflight):
+            entry = changes.get(name)
+            if entry is not None and entry[index] is not _UNSET:
+                return entry[index]
+
+        await self.open()
+        if not self.shared and name not in self._keys:
+            return None
+        async with self.pool.read() as db:
+            async with db.execute(
+                "SELECT state, data FROM fsm WHERE key = ? AND expires_at > ?", (name, time.time())
+            ) as cursor:
+                row = await cursor.fetchone()
+        if row is None:
+            return None
+        if index == 0:
+            return row["state"]
+        return json.loads(row["data"]) if row["data"] else None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self.open()
+        self._stage(key, 0, _state_name(state))
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return await self._current(key, 0)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self.open()
+        self._stage(key, 1, dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return dict(await self._current(key, 1) or {})
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            self._inflight = pending
+            try:
+                await self._write(pending)
+            except BaseException:
+                # Возвращаем несохраненное; более новые изменения того же ключа важнее
+                for name, (state, data) in pending.items():
+                    entry = self._pending.setdefault(name, [_UNSET, _UNSET])
+                    if entry[0] is _UNSET:
+                        entry[0] = state
+                    if entry[1] is _UNSET:
+                        entry[1] = data
+                raise
+            finally:
+                self._inflight = {}
+
+    async def _write(self, pending: dict):
+        expires_at = time.time() + self.ttl
+        deleted, states, data = [], [], []
+        for name, (state, values) in pending.items():
+            # state.clear(): и состояние, и данные сброшены - запись больше не нужна
+            if state is None and values == {}:
+                deleted.append((name,))
+                continue
+            if state is not _UNSET:
+                states.append((name, state, expires_at))
+            if values is not _UNSET:
+                data.append((name, json.dumps(values, ensure_ascii=False), expires_at))
+
+        async with self.pool.write() as db:
+            if deleted:
+                await db.executemany("DELETE FROM fsm WHERE key = ?", deleted)
+            if states:
+                await db.executemany("""
+                    INSERT INTO fsm (key, state, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at
+                """, states)
+            if data:
+                await db.executemany("""
+                    INSERT INTO fsm (key, data, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at
+                """, data)
+
+        if not self.shared:
+            self._keys.difference_update(name for name, in deleted)
+            self._keys.update(name for name, _, _ in states + data)
+
+    async def cleanup(self) -> int:
+        """Удаляет истекшие диалоги и давно полные ведра антиспама. Возвращает число удаленных диалогов."""
+        now = time.time()
+        async with self.pool.write() as db:
+            cursor = await db.execute("DELETE FROM fsm WHERE expires_at <= ?", (now,))
+            removed = cursor.rowcount
+            if self.throttle_ttl:
+                await db.execute("DELETE FROM throttle WHERE updated_at < ?", (now - self.throttle_ttl,))
+        if removed:
+            logger.info("Удалено устаревших диалогов FSM: %s", removed)
+        return removed
+
+
+class SQLiteTokenBuckets:
+    """
+    Token bucket на пользователя в таблице throttle хранилища SQLiteStorage:
+    ведро общее для всех процессов, списание - один атомарный UPSERT.
+    Время - time.time(), так как монотонные часы у процессов разные.
+    """
+
+    def __init__(self, storage: SQLiteStorage, rate: float, capacity: float):
+        self.storage = storage
+        self.rate = rate
+        self.capacity = capacity
+        storage.throttle_ttl = max(storage.throttle_ttl, capacity / rate)
+
+    async def acquire(self, key: int, cost: float) -> bool:
+        await self.storage.open()
+        async with self.storage.pool.write() as db:
+            # Строка обновляется, только если после пополнения хватает токенов
+            cursor = await db.execute("""
+                INSERT INTO throttle (key, tokens, updated_at) VALUES (:key, :capacity - :cost, :now)
+                ON CONFLICT (key) DO UPDATE SET
+                    tokens = MIN(:capacity, tokens + (:now - updated_at) * :rate) - :cost,
+                    updated_at = :now
+                WHERE MIN(:capacity, tokens + (:now - updated_at) * :rate) >= :cost
+            """, {"key": str(key), "capacity": self.capacity, "cost": cost, "now": time.time(), "rate": self.rate})
+            return cursor.rowcount > 0
+
+    async def close(self):
+        await self.storage.close()
+
+
+class RedisStorage(BaseStorage):
+    """
+    Хранилище FSM на сервере с протоколом Redis: состояние и данные - отдельные ключи
+    со сроком жизни ttl секунд, который продлевается при каждой записи.
+    """
+
+    def __init__(self, client: RedisClient, ttl: int = FSM_TTL, key_builder: KeyBuilder = None):
+        self.client = client
+        self.ttl = ttl
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        name = self.key_builder.build(key, "state")
+        state = _state_name(state)
+        if state is None:
+            await self.client.execute("DEL", name)
+        else:
+            await self.client.execute("SET", name, state, "EX", self.ttl)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        value = await self.client.execute("GET", self.key_builder.build(key, "state"))
+        return value.decode() if value is not None else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        name = self.key_builder.build(key, "data")
+        if not data:
+            await self.client.execute("DEL", name)
+        else:
+            await self.client.execute("SET", name, json.dumps(dict(data), ensure_ascii=False), "EX", self.ttl)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        value = await self.client.execute("GET", self.key_builder.build(key, "data"))
+        return json.loads(value) if value is not None else {}
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+class RedisTokenBuckets:
+    """
+    Антиспам на сервере Redis без Lua-скриптов: фиксированное окно длиной capacity / rate секунд,
+    за которое пользователь может потратить не больше capacity токенов (INCRBYFLOAT + EXPIRE).
+    На границе окон возможен всплеск до 2 * capacity - для антиспама это допустимо.
+    """
+
+    def __init__(self, client: RedisClient, rate: float, capacity: float, prefix: str = "throttle"):
+        self.client = client
+        self.capacity = capacity
+        self.window = capacity / rate
+        self.prefix = prefix
+
+    async def acquire(self, key: int, cost: float) -> bool:
+        slot = int(time.time() // self.window)
+        name = f"{self.prefix}:{key}:{slot}"
+        spent, _ = await self.client.pipeline([
+            ("INCRBYFLOAT", name, cost),
+            ("EXPIRE", name, math.ceil(self.window) + 1),
+        ])
+        return float(spent) <= self.capacity
+
+    async def close(self):
+        await self.client.close()
+
+
+def create_storages(fsm_backend: str = FSM_STORAGE, throttle_backend: str = THROTTLE_STORAGE):
+    """
+    Хранилище FSM для Dispatcher и хранилище ведер для ThrottlingMiddleware.
+    Бэкенды: memory, sqlite или redis; одинаковые бэкенды делят файл или пул соединений.
+    """
+    shared = {}
+
+    def sqlite():
+        if "sqlite" not in shared:
+            shared["sqlite"] = SQLiteStorage()
+        return shared["sqlite"]
+
+    def redis():
+        if "redis" not in shared:
+            shared["redis"] = RedisClient(REDIS_URL)
+        return shared["redis"]
+
+    fsm_factories = {
+        "memory": MemoryStorage,
+        "sqlite": sqlite,
+        "redis": lambda: RedisStorage(redis()),
+    }
+    throttle_factories = {
+        "memory": lambda: TokenBucketStore(THROTTLE_RATE, THROTTLE_BURST),
+        "sqlite": lambda: SQLiteTokenBuckets(sqlite(), THROTTLE_RATE, THROTTLE_BURST),
+        "redis": lambda: RedisTokenBuckets(redis(), THROTTLE_RATE, THROTTLE_BURST),
+    }
+    for name, backend, factories in (
+        ("FSM_STORAGE", fsm_backend, fsm_factories),
+        ("THROTTLE_STORAGE", throttle_backend, throttle_factories),
+    ):
+        if backend not in factories:
+            raise ValueError(f"Неизвестное хранилище {name}='{backend}'. Доступны: {', '.join(factories)}")
+
+    return fsm_factories[fsm_backend](), throttle_factories[throttle_backend]()
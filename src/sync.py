@@ -0,0 +1,58 @@
+import asyncio
+import logging
+
+from src import database as db
+from src.config import SYNC_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class RegistrySync:
+    """
+    Синхронизация реестра прокси между воркерами (WEB_WORKERS > 1).
+    Раз в interval секунд читает версию списка прокси из stats (ее ведут триггеры m010)
+    и, если прокси правили (в том числе в другом процессе), перечитывает реестр из БД.
+    Кэш отрисовки сбрасывается сам: при перезагрузке реестра меняется registry.version.
+    """
+
+    def __init__(self, interval: float = SYNC_INTERVAL):
+        self.interval = interval
+        self.version: int | None = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        if self.interval > 0 and self._task is None:
+            # Реестр только что загружен - запоминаем, какой версии он соответствует
+            self.version = await db.get_proxies_version()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Не удалось синхронизировать реестр прокси")
+
+    async def run_once(self) -> bool:
+        """Один проход. True, если реестр перечитан."""
+        version = await db.get_proxies_version()
+        if version == self.version:
+            return False
+        # Версию запоминаем до чтения: правка во время чтения вызовет еще одну перезагрузку
+        self.version = version
+        await db.reload_registry()
+        logger.info("Реестр прокси перечитан (версия %s)", version)
+        return True
@@ -0,0 +1,57 @@
+import asyncio
+import logging
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from src.config import WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEB_HOST, WEB_PORT, WEB_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+def webhook_path(bot: Bot, bots: list[Bot]) -> str:
+    """Один бот - WEBHOOK_PATH, несколько - WEBHOOK_PATH/<id бота>."""
+    return WEBHOOK_PATH if len(bots) == 1 else f"{WEBHOOK_PATH.rstrip('/')}/{bot.id}"
+
+
+def build_app(dp: Dispatcher, bots: list[Bot]) -> web.Application:
+    """aiohttp-приложение с обработчиком вебхука каждого бота. Запросы без верного секрета отклоняются."""
+    app = web.Application()
+    for bot in bots:
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(
+            app, path=webhook_path(bot, bots)
+        )
+    setup_application(app, dp, bots=bots)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bots: list[Bot], primary: bool = True):
+    """
+    Поднимает веб-сервер и ждет апдейты до отмены.
+    При нескольких воркерах все они слушают один порт (SO_REUSEPORT),
+    а регистрирует и снимает вебхуки только основной воркер.
+    """
+    runner = web.AppRunner(build_app(dp, bots))
+    await runner.setup()
+    site = web.TCPSite(runner, WEB_HOST, WEB_PORT, reuse_port=WEB_WORKERS > 1)
+    await site.start()
+    logger.info("Вебхук слушает %s:%s%s (ботов: %s)", WEB_HOST, WEB_PORT, WEBHOOK_PATH, len(bots))
+
+    if primary:
+        allowed_updates = dp.resolve_used_update_types()
+        await asyncio.gather(*(
+            bot.set_webhook(
+                f"{WEBHOOK_BASE_URL.rstrip('/')}{webhook_path(bot, bots)}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=allowed_updates,
+            )
+            for bot in bots
+        ))
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        if primary:
+            await asyncio.gather(*(bot.delete_webhook() for bot in bots), return_exceptions=True)
+        await runner.cleanup()
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+from collections import Counter
+from contextlib import asynccontextmanager
+
+from src.config import WRITE_FLUSH_INTERVAL, WRITE_FLUSH_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBuffer:
+    """
+    Отложенная запись частых мелких изменений: новые пользователи и связи
+    пользователь-прокси копятся в памяти и раз в interval секунд (или при
+    накоплении max_pending записей) сбрасываются в БД одной транзакцией.
+
+    Правило "каждый пользователь считается у прокси один раз" сохраняется:
+    связи сначала пишутся во временную таблицу, и usage_count увеличивается
+    только на число действительно новых связей.
+    """
+
+    def __init__(self, pool, interval: float = WRITE_FLUSH_INTERVAL, max_pending: int = WRITE_FLUSH_SIZE):
+        self.pool = pool
+        self.interval = interval
+        self.max_pending = max_pending
+        # (bot_id, user_id) -> username
+        self._users: dict[tuple[int, int], str] = {}
+        self._relations: set[tuple[int, int]] = set()
+        # Связи, которые сейчас записываются в БД
+        self._inflight: set[tuple[int, int]] = set()
+        # Последний прокси каждого пользователя среди несохраненных связей (для STICKY_ASSIGNMENT)
+        self._latest: dict[int, int] = {}
+        self._inflight_latest: dict[int, int] = {}
+        self._flush_lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._stopping = False
+        self._task: asyncio.Task | None = None
+        # Колбэк для исправления оптимистичных счетчиков: (proxy_id, delta)
+        self.on_usage_correction = None
+
+    def __len__(self):
+        return len(self._users) + len(self._relations)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновый сброс и дописывает всё, что накопилось."""
+        if self._task is not None:
+            # Не cancel(): wait_for на Python 3.11 может проглотить отмену, если событие
+            # только что установлено, и цикл продолжит работать. Задача завершается сама по флагу
+            self._stopping = True
+            self._full.set()
+            await self._task
+            self._task = None
+            self._stopping = False
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                async with asyncio.timeout(self.interval):
+                    await self._full.wait()
+            except TimeoutError:
+                pass
+            self._full.clear()
+            if self._stopping:
+                return
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Не удалось сбросить буфер записи, повторим позже")
+
+    def _check_size(self):
+        if len(self) >= self.max_pending:
+            self._full.set()
+
+    def add_user(self, bot_id: int, user_id: int, username: str = None):
+        self._users.setdefault((bot_id, user_id), username)
+        self._check_size()
+
+    def has_relation(self, user_id: int, proxy_id: int) -> bool:
+        key = (user_id, proxy_id)
+        return key in self._relations or key in self._inflight
+
+    def add_relation(self, user_id: int, proxy_id: int):
+        self._relations.add((user_id, proxy_id))
+        self._latest[user_id] = proxy_id
+        self._check_size()
+
+    def latest_relation(self, user_id: int) -> int | None:
+        """Прокси из последней несохраненной связки пользователя (в БД ее еще нет)."""
+        proxy_id = self._latest.get(user_id)
+        return proxy_id if proxy_id is not None else self._inflight_latest.get(user_id)
+
+    def discard_relation(self, user_id: int, proxy_id: int) -> bool:
+        """Убирает связку, которая еще не начала записываться. True, если она была в очереди."""
+        key = (user_id, proxy_id)
+        if key not in self._relations:
+            return False
+        self._relations.discard(key)
+        if self._latest.get(user_id) == proxy_id:
+            del self._latest[user_id]
+        return True
+
+    async def flush(self):
+        async with self._flush_lock:
+            corrections = await self._flush_locked()
+        self._correct(corrections)
+
+    @asynccontextmanager
+    async def flushed(self):
+        """
+        Сбрасывает буфер и не дает начать следующий сброс до конца блока:
+        внутри блока в БД есть всё, кроме связок из pending_usage().
+        """
+        async with self._flush_lock:
+            self._correct(await self._flush_locked())
+            yield
+
+    def pending_usage(self) -> Counter:
+        """Сколько несохраненных связок у каждого прокси (уже учтены в счетчиках реестра)."""
+        return Counter(proxy_id for _, proxy_id in self._relations | self._inflight)
+
+    def _correct(self, corrections: dict):
+        if self.on_usage_correction:
+            for proxy_id, delta in corrections.items():
+                self.on_usage_correction(proxy_id, delta)
+
+    async def _flush_locked(self) -> dict:
+        if not len(self):
+            return {}
+
+        users, self._users = self._users, {}
+        relations, self._relations = self._relations, set()
+        latest, self._latest = self._latest, {}
+        self._inflight, self._inflight_latest = relations, latest
+        try:
+            return await self._write(users, relations)
+        except BaseException:
+            # Возвращаем несохраненное в буфер, чтобы не потерять
+            for key, username in users.items():
+                self._users.setdefault(key, username)
+            self._relations |= relations
+            for user_id, proxy_id in latest.items():
+                self._latest.setdefault(user_id, proxy_id)
+            raise
+        finally:
+            self._inflight, self._inflight_latest = set(), {}
+
+    async def _write(self, users: dict, relations: set) -> dict:
+        """Пишет пачку одной транзакцией. Возвращает поправки к счетчикам реестра."""
+        optimistic: dict[int, int] = {}
+        for _, proxy_id in relations:
+            optimistic[proxy_id] = optimistic.get(proxy_id, 0) + 1
+
+        async with self.pool.write() as db:
+            if users:
+                # /start снова делает активным пользователя, которого рассылка пометила неактивным
+                await db.executemany("""
+                    INSERT INTO users (bot_id, user_id, username) VALUES (?, ?, ?)
+                    ON CONFLICT (bot_id, user_id) DO UPDATE
+                    SET is_active = 1, inactive_since = NULL, inactive_reason = NULL
+                    WHERE is_active = 0
+                """, [(bot_id, user_id, username) for (bot_id, user_id), username in users.items()])
+            if not relations:
+                return {}
+
+            await db.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS pending_relations (
+                    user_id INTEGER, proxy_id INTEGER, PRIMARY KEY (user_id, proxy_id)
+                )
+            """)
+            await db.executemany(
+                "INSERT OR IGNORE INTO pending_relations (user_id, proxy_id) VALUES (?, ?)",
+                relations
+            )
+            # Сколько связей действительно новые (их еще нет в user_proxy_relations)
+            async with db.execute("""
+                SELECT s.proxy_id, COUNT(*) FROM pending_relations s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM user_proxy_relations r
+                    WHERE r.user_id = s.user_id AND r.proxy_id = s.proxy_id
+                )
+                GROUP BY s.proxy_id
+            """) as cursor:
+                new_counts = dict(await cursor.fetchall())
+
+            await db.executemany(
+                "UPDATE proxies SET usage_count = usage_count + ? WHERE id = ?",
+                [(count, proxy_id) for proxy_id, count in new_counts.items()]
+            )
+            await db.execute("""
+                INSERT OR IGNORE INTO user_proxy_relations (user_id, proxy_id)
+                SELECT user_id, proxy_id FROM pending_relations
+            """)
+            await db.execute("DELETE FROM pending_relations")
+
+        return {
+            proxy_id: new_counts.get(proxy_id, 0) - count
+            for proxy_id, count in optimistic.items()
+            if new_counts.get(proxy_id, 0) != count
+        }
@@ -0,0 +1,42 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Настройки читаются при импорте src.config, поэтому окружение готовим до импорта бота
+_tmp = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ.update(
+    DB_PATH=os.path.join(_tmp, "test.db"),
+    STORAGE_PATH=os.path.join(_tmp, "test_storage.db"),
+    BOT_TOKEN="123456:test",
+    ADMIN_IDS="",
+    METRICS_PORT="0",
+    HEALTH_INTERVAL="0",
+    BALANCE_STRATEGY="least_loaded",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def run():
+    """Один цикл событий на все тесты: пул и буфер записи модуля database живут между тестами."""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture
+def db(run):
+    """Пустая база: init_db перед тестом, close_db и удаление файлов после."""
+    from src import database
+
+    run(database.init_db())
+    yield database
+    run(database.close_db())
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(database.DB_NAME + suffix)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,82 @@
+import asyncio
+
+
+async def _add_proxies(db, count: int) -> list[int]:
+    for i in range(count):
+        await db.add_proxy_if_new(f"Test {i}", f"10.0.0.{i}", 443, f"secret{i}")
+    return [p["id"] for p in await db.get_all_proxies()]
+
+
+async def _db_usage(db) -> dict:
+    async with db.pool.read() as conn:
+        async with conn.execute("SELECT id, usage_count FROM proxies") as cursor:
+            return dict(await cursor.fetchall())
+
+
+def test_parallel_assignments_are_balanced(db, run):
+    async def scenario():
+        proxy_ids = await _add_proxies(db, 3)
+        users = range(1, 301)
+        proxies = await asyncio.gather(*(db.get_least_loaded_proxy(user_id) for user_id in users))
+        await db.write_buffer.flush()
+        return proxy_ids, proxies, await _db_usage(db)
+
+    proxy_ids, proxies, usage = run(scenario())
+
+    assert all(proxy is not None for proxy in proxies)
+    # Каждый параллельный вызов видел счетчики предыдущих: нагрузка делится поровну
+    assert usage == {proxy_id: 100 for proxy_id in proxy_ids}
+    assert {p["id"]: p["usage_count"] for p in db.registry.all(False)} == usage
+
+
+def test_parallel_assignments_count_user_once(db, run):
+    async def scenario():
+        await _add_proxies(db, 1)
+        await asyncio.gather(*(db.get_least_loaded_proxy(7) for _ in range(50)))
+        await db.write_buffer.flush()
+        # Связка уже в БД: повторные запросы не увеличивают счетчик ни в реестре, ни в БД
+        await asyncio.gather(*(db.get_least_loaded_proxy(7) for _ in range(50)))
+        await db.write_buffer.flush()
+        return await _db_usage(db)
+
+    usage = run(scenario())
+
+    assert list(usage.values()) == [1]
+    assert [p["usage_count"] for p in db.registry.all(False)] == [1]
+
+
+def test_reload_registry_keeps_buffered_usage(db, run):
+    async def scenario():
+        proxy_ids = await _add_proxies(db, 2)
+        await asyncio.gather(*(db.get_least_loaded_proxy(user_id) for user_id in range(1, 11)))
+        await db.write_buffer.flush()
+        # Часть выдач еще в буфере, а другой процесс выключил прокси
+        await asyncio.gather(*(db.get_least_loaded_proxy(user_id) for user_id in range(11, 21)))
+        async with db.pool.write() as conn:
+            await conn.execute("UPDATE proxies SET is_active = 0 WHERE id = ?", (proxy_ids[0],))
+        await db.reload_registry()
+        return proxy_ids
+
+    proxy_ids = run(scenario())
+
+    proxies = {p["id"]: p for p in db.registry.all(False)}
+    assert proxies[proxy_ids[0]]["is_active"] == 0
+    assert sum(p["usage_count"] for p in proxies.values()) == 20
+
+
+def test_sticky_user_keeps_unflushed_proxy(db, run, monkeypatch):
+    monkeypatch.setattr(db, "STICKY_ASSIGNMENT", True)
+
+    async def scenario():
+        await _add_proxies(db, 2)
+        first = await db.get_least_loaded_proxy(1)
+        # Связка еще в буфере, а пользователь вытеснен из кэша (или пришел в другой воркер)
+        db.sticky.discard(1)
+        second = await db.get_least_loaded_proxy(1)
+        await db.write_buffer.flush()
+        return first, second, await _db_usage(db)
+
+    first, second, usage = run(scenario())
+
+    assert second["id"] == first["id"]
+    assert sum(usage.values()) == 1
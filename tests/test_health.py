@@ -0,0 +1,56 @@
+import asyncio
+
+from src.health import FAIL_THRESHOLD, HealthProber
+
+
+async def _listen():
+    server = await asyncio.start_server(lambda reader, writer: writer.close(), "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def _closed_port() -> int:
+    # Порт, который только что освободили: на нем никто не слушает
+    server, port = await _listen()
+    server.close()
+    await server.wait_closed()
+    return port
+
+
+def test_probe_measures_open_port_and_fails_on_closed(run):
+    async def scenario():
+        server, port = await _listen()
+        prober = HealthProber(timeout=2)
+        try:
+            return await prober.probe("127.0.0.1", port), await prober.probe("127.0.0.1", await _closed_port())
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    open_rtt, closed_rtt = run(scenario())
+
+    assert open_rtt is not None and open_rtt >= 0
+    assert closed_rtt is None
+
+
+def test_check_all_excludes_unreachable_proxy(db, run):
+    async def scenario():
+        server, port = await _listen()
+        await db.add_proxy_if_new("Up", "127.0.0.1", port, "secret1")
+        await db.add_proxy_if_new("Down", "127.0.0.1", await _closed_port(), "secret2")
+        prober = HealthProber(timeout=2)
+        try:
+            for _ in range(FAIL_THRESHOLD):
+                await prober.check_all()
+        finally:
+            server.close()
+            await server.wait_closed()
+        async with db.pool.read() as conn:
+            async with conn.execute("SELECT proxy_id, is_healthy FROM proxy_health") as cursor:
+                saved = dict(await cursor.fetchall())
+        return {p["location"]: p for p in db.registry.all(False)}, saved
+
+    proxies, saved = run(scenario())
+
+    assert proxies["Up"]["is_healthy"] == 1 and proxies["Up"]["rtt_ms"] is not None
+    assert proxies["Down"]["is_healthy"] == 0
+    assert saved == {proxies["Up"]["id"]: 1, proxies["Down"]["id"]: 0}
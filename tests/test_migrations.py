@@ -0,0 +1,62 @@
+import asyncio
+
+import aiosqlite
+import pytest
+
+from src.database import apply_pragmas
+from src.migrations import SCHEMA_VERSION, get_schema_version, migrate
+
+
+async def _plan(conn, query: str, params=()) -> str:
+    async with conn.execute(f"EXPLAIN QUERY PLAN {query}", params) as cursor:
+        return " | ".join(row[3] for row in await cursor.fetchall())
+
+
+@pytest.mark.parametrize("query, params, index", [
+    # Выдача по нагрузке среди включенных прокси
+    ("SELECT id FROM proxies WHERE is_active = 1 ORDER BY usage_count LIMIT 1", (), "idx_proxies_active_usage"),
+    # delete_proxy / reset_proxy_usage
+    ("DELETE FROM user_proxy_relations WHERE proxy_id = ?", (1,), "idx_relations_proxy"),
+    ("SELECT user_id FROM user_proxy_relations WHERE proxy_id = ?", (1,), "idx_relations_proxy"),
+    # get_next_broadcast
+    ("SELECT * FROM broadcasts WHERE status != 'done' ORDER BY id LIMIT 1", (), "idx_broadcasts_unfinished"),
+    # Окно активных выдач (load_activity) и сворачивание старых связей
+    ("SELECT proxy_id FROM user_proxy_relations WHERE timestamp >= ?", ("2024-01-01",), "idx_relations_timestamp"),
+    # Страницы получателей рассылки
+    (
+        "SELECT user_id FROM users INDEXED BY idx_users_active "
+        "WHERE bot_id = ? AND is_active = 1 AND user_id > ? ORDER BY user_id LIMIT 100",
+        (1, 0), "idx_users_active",
+    ),
+])
+def test_hot_queries_use_indexes(db, run, query, params, index):
+    async def plan():
+        async with db.pool.read() as conn:
+            return await _plan(conn, query, params)
+
+    detail = run(plan())
+    assert index in detail
+    assert "USE TEMP B-TREE" not in detail
+
+
+def test_concurrent_migrate_runs_each_step_once(run, tmp_path):
+    path = str(tmp_path / "migrate.db")
+
+    async def worker():
+        conn = await aiosqlite.connect(path)
+        try:
+            await apply_pragmas(conn)
+            return await migrate(conn)
+        finally:
+            await conn.close()
+
+    async def scenario():
+        # Как несколько воркеров WEB_WORKERS, стартующих на пустой базе
+        steps = await asyncio.gather(*(worker() for _ in range(4)))
+        async with aiosqlite.connect(path) as conn:
+            return steps, await get_schema_version(conn)
+
+    steps, version = run(scenario())
+
+    assert sum(steps) == SCHEMA_VERSION
+    assert version == SCHEMA_VERSION
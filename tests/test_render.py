@@ -0,0 +1,17 @@
+from src import render
+from src.importer import parse_proxy_line
+
+
+def test_location_is_escaped_in_html_views(db, run):
+    # Локация из строки CSV попадает в текст с parse_mode=HTML как есть
+    proxy = parse_proxy_line("A & <b>B, tg://proxy?server=10.0.0.1&port=443&secret=abc")
+
+    async def scenario():
+        await db.add_proxy_if_new(proxy["location"], proxy["server"], proxy["port"], proxy["secret"])
+        return (await db.get_all_proxies())[0]["id"]
+
+    proxy_id = run(scenario())
+
+    for text, _ in (render.proxy_list_view(), render.proxy_connect_view(proxy_id)):
+        assert "A &amp; &lt;b&gt;B" in text
+        assert "<b>B" not in text
@@ -0,0 +1,31 @@
+from types import SimpleNamespace
+
+import pytest
+
+from src import responses
+
+
+class FakeMessage:
+    def __init__(self, message_id: int):
+        self.bot = SimpleNamespace(id=1)
+        self.chat = SimpleNamespace(id=10)
+        self.message_id = message_id
+        self.edits = 0
+
+    async def edit_text(self, text, **kwargs):
+        self.edits += 1
+
+
+@pytest.mark.parametrize("skip_unchanged, edits", [(True, 1), (False, 2)])
+def test_edit_text_skips_unchanged_only_in_single_process(run, monkeypatch, skip_unchanged, edits):
+    monkeypatch.setattr(responses, "skip_unchanged", lambda: skip_unchanged)
+    message = FakeMessage(message_id=100 + edits)
+
+    async def scenario():
+        await responses.edit_text(message, "Меню")
+        # Другой воркер мог изменить сообщение между этими вызовами
+        await responses.edit_text(message, "Меню")
+
+    run(scenario())
+
+    assert message.edits == edits
@@ -0,0 +1,77 @@
+from aiogram.fsm.storage.base import StorageKey
+
+from src.fakes import FakeRedis
+from src.redis_client import RedisClient
+from src.storage import RedisStorage, RedisTokenBuckets, SQLiteStorage
+
+
+def _key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+def test_storage_skips_reads_for_keys_without_state(run, tmp_path):
+    path = str(tmp_path / "storage.db")
+
+    async def scenario():
+        writer = SQLiteStorage(path, shared=True)
+        await writer.set_state(_key(1), "Admin:broadcast")
+        await writer.flush()
+        await writer.close()
+
+        storage = SQLiteStorage(path, shared=False)
+        try:
+            # Ключ из БД подхвачен при открытии
+            loaded = await storage.get_state(_key(1))
+            reads = []
+            storage.pool.read = lambda: reads.append(1)
+            empty = await storage.get_state(_key(2)), await storage.get_data(_key(2))
+            del storage.pool.read
+
+            await storage.set_data(_key(2), {"step": 1})
+            await storage.flush()
+            saved = await storage.get_data(_key(2))
+            await storage.set_state(_key(1), None)
+            await storage.set_data(_key(1), {})
+            await storage.flush()
+            cleared = await storage.get_state(_key(1))
+            return loaded, reads, empty, saved, cleared, storage._keys
+        finally:
+            await storage.close()
+
+    loaded, reads, empty, saved, cleared, keys = run(scenario())
+
+    assert loaded == "Admin:broadcast"
+    assert reads == []
+    assert empty == (None, {})
+    assert saved == {"step": 1}
+    assert cleared is None
+    assert keys == {"fsm:1:2:2"}
+
+
+def test_redis_storage_and_buckets_on_fake_redis(run):
+    async def scenario():
+        server = FakeRedis(port=0)
+        await server.start()
+        client = RedisClient(server.url)
+        storage = RedisStorage(client, ttl=60)
+        buckets = RedisTokenBuckets(client, rate=1, capacity=2)
+        try:
+            await storage.set_state(_key(1), "Admin:broadcast")
+            await storage.set_data(_key(1), {"step": 1})
+            saved = await storage.get_state(_key(1)), await storage.get_data(_key(1))
+            await storage.set_state(_key(1), None)
+            await storage.set_data(_key(1), {})
+            cleared = await storage.get_state(_key(1)), await storage.get_data(_key(1))
+            # Ведро на 2 токена: третий запрос в том же окне отклоняется
+            allowed = [await buckets.acquire(7, 1) for _ in range(3)]
+            return saved, cleared, allowed, server.commands
+        finally:
+            await client.close()
+            await server.stop()
+
+    saved, cleared, allowed, commands = run(scenario())
+
+    assert saved == ("Admin:broadcast", {"step": 1})
+    assert cleared == (None, {})
+    assert allowed == [True, True, False]
+    assert ["SET", "fsm:1:1:1:state", "Admin:broadcast", "EX", "60"] in commands
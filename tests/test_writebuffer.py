@@ -0,0 +1,15 @@
+import asyncio
+
+
+def test_stop_after_full_buffer_returns(db, run):
+    async def scenario():
+        for i in range(3):
+            await db.add_proxy_if_new(f"Test {i}", f"10.0.0.{i}", 443, f"secret{i}")
+        # 500 выдач заполняют буфер (WRITE_FLUSH_SIZE) и будят фоновый сброс прямо перед stop()
+        await asyncio.gather(*(db.get_least_loaded_proxy(user_id) for user_id in range(1, 501)))
+        await asyncio.wait_for(db.write_buffer.stop(), 5)
+        async with db.pool.read() as conn:
+            async with conn.execute("SELECT SUM(usage_count) FROM proxies") as cursor:
+                return (await cursor.fetchone())[0]
+
+    assert run(scenario()) == 500